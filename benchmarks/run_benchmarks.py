@@ -0,0 +1,257 @@
+"""
+Throughput benchmarks for every pipeline stage on synthetic HCP-shaped data.
+
+Each (stage, cohort size) measurement runs in a fresh process so that peak
+RSS and I/O counters belong to that stage alone. Results are written as JSON
+and compared against a stored baseline:
+
+    python benchmarks/run_benchmarks.py --data /scratch/bench --cohort-sizes 1 4
+    python benchmarks/run_benchmarks.py --data /scratch/bench --save-baseline benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --data /scratch/bench --baseline benchmarks/baseline.json
+
+Stages that shell out (``fsl_registration``) use the stub executables in
+``benchmarks/stubs`` unless ``--real-tools`` is given.
+"""
+import argparse
+import cProfile
+import json
+import multiprocessing
+import os
+import platform
+import pstats
+import resource
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import nibabel as nib  # noqa: E402
+import numpy as np  # noqa: E402
+from nibabel.affines import voxel_sizes  # noqa: E402
+import synthetic  # noqa: E402
+from utils import hcp_paths  # noqa: E402
+from utils.cifti_utils import open_dense_time_series, save_volume, separate_cifti, volume_columns  # noqa: E402
+from utils.connectivity_utils import run_connectivity  # noqa: E402
+from utils.extract_utils import gather_voxel_time_series, load_coordinates  # noqa: E402
+from utils.parcel_utils import average_parcels  # noqa: E402
+from utils.resample_utils import resample_image_isotropic  # noqa: E402
+from utils.store_utils import write_time_series  # noqa: E402
+from utils.telemetry_utils import io_counters  # noqa: E402
+from utils.warp_utils import apply_dense_sampling_operator, cached_sampling_operator  # noqa: E402
+
+
+def stage_cifti_separation(hcp_dir, subject_name, phase, direction):
+    separate_cifti(hcp_paths.dtseries_path(os.path.join(hcp_dir, subject_name), subject_name, phase, direction))
+
+
+def stage_registration(hcp_dir, subject_name, phase, direction):
+    subject_dir = os.path.join(hcp_dir, subject_name)
+    dataobj, brain_models, series = open_dense_time_series(
+        hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
+    )
+    columns, flat_voxels = volume_columns(brain_models)
+    operator, out_shape, out_affine = cached_sampling_operator(
+        os.path.join(hcp_dir, '.sampling_cache'), tuple(brain_models.volume_shape), brain_models.affine,
+        voxel_sizes(brain_models.affine), hcp_paths.t1_ref_path(subject_dir),
+        hcp_paths.warp_path(subject_dir, subject_name), voxel_size=3, in_voxels=flat_voxels,
+    )
+    registered = apply_dense_sampling_operator(operator, dataobj, columns, out_shape, chunk_size=100)
+    save_volume({'volume': registered, 'affine': out_affine, 'tr': series.step},
+                hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction))
+
+
+def stage_downsampling(hcp_dir, subject_name, phase, direction):
+    """The in-process flirt replacement of the FSL path, on a warped run at synthetic.WARPED_VOXEL mm."""
+    img = nib.load(synthetic.warped_volume_path(os.path.join(hcp_dir, subject_name), phase, direction))
+    resample_image_isotropic(img, voxel_size=3)
+
+
+def stage_average_partition_timeseries(hcp_dir, subject_name, phase, direction):
+    subject_dir = os.path.join(hcp_dir, subject_name)
+    separated = separate_cifti(hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction), volume=False)
+    for hemisphere, key in [('L', 'cortex_left'), ('R', 'cortex_right')]:
+        average_parcels(separated[key], {
+            parcellation: hcp_paths.label_gii_path(subject_dir, subject_name, hemisphere, parcellation)
+            for parcellation in ['aparc.a2009s', 'aparc']
+        })
+
+
+def stage_striatum_gather(hcp_dir, subject_name, phase, direction):
+    subject_dir = os.path.join(hcp_dir, subject_name)
+    img = nib.load(hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction))
+    gather_voxel_time_series(img.dataobj, {
+        h: load_coordinates(hcp_paths.coords_path(subject_dir, h)) for h in hcp_paths.HEMISPHERES
+    })
+
+
+def stage_output_writing(hcp_dir, subject_name, phase, direction):
+    run_dir = hcp_paths.output_dir(os.path.join(hcp_dir, subject_name), phase, direction)
+    rng = np.random.default_rng(0)
+    write_time_series(run_dir, 'bench_striatum_L', rng.standard_normal((1500, 1200), dtype=np.float32))
+    write_time_series(run_dir, 'bench_cortex_L', rng.standard_normal((75, 1200), dtype=np.float32),
+                      label_ids=np.arange(1, 76))
+
+
+def stage_connectivity(hcp_dir, subject_name, phase, direction):
+    rng = np.random.default_rng(0)
+    striatum = {h: rng.standard_normal((1500, 1200), dtype=np.float32) for h in hcp_paths.HEMISPHERES}
+    cortex = {
+        parcellation: {h: (np.arange(1, n + 1), [str(i) for i in range(n)],
+                           rng.standard_normal((n, 1200), dtype=np.float32)) for h in hcp_paths.HEMISPHERES}
+        for parcellation, n in [('aparc.a2009s', 75), ('aparc', 35)]
+    }
+    run_connectivity(striatum, cortex)
+
+
+def stage_fsl_registration(hcp_dir, subject_name, phase, direction):
+    """The legacy external-tool path of fmri_to_individual_space_registration.process_fMRI."""
+    import fmri_to_individual_space_registration as registration
+    registration.register_with_fsl = True
+    registration.downsample_with_flirt = True
+    registration.process_fMRI(subject_name, direction, phase, os.path.join(hcp_dir, subject_name))
+
+
+# Ordered so that every stage finds the files written by the stages before it
+STAGES = {
+    'cifti_separation': stage_cifti_separation,
+    'registration': stage_registration,
+    'downsampling': stage_downsampling,
+    'average_partition_timeseries': stage_average_partition_timeseries,
+    'striatum_gather': stage_striatum_gather,
+    'output_writing': stage_output_writing,
+    'connectivity': stage_connectivity,
+    'fsl_registration': stage_fsl_registration,
+}
+DEFAULT_STAGES = [name for name in STAGES if name != 'fsl_registration']
+
+
+def measure(stage, hcp_dir, subjects, runs, profile_dir, queue):
+    """Child process body: run ``stage`` over the cohort and report its resource usage."""
+    func = STAGES[stage]
+    profiler = cProfile.Profile() if profile_dir else None
+    io_before = io_counters()
+    cpu_before = time.process_time()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_before = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    for subject_name in subjects:
+        for phase, direction in runs:
+            func(hcp_dir, subject_name, phase, direction)
+    if profiler:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f'{stage}_{len(subjects)}.prof'))
+    wall = time.perf_counter() - wall_before
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_after = io_counters()
+    num_runs = len(subjects) * len(runs)
+    queue.put({
+        'stage': stage,
+        'cohort_size': len(subjects),
+        'runs': num_runs,
+        'wall_s': wall,
+        'wall_per_run_s': wall / num_runs,
+        'cpu_s': time.process_time() - cpu_before
+                 + (children.ru_utime + children.ru_stime) - (children_before.ru_utime + children_before.ru_stime),
+        'peak_rss_mb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children.ru_maxrss) / 1024,
+        'bytes_read': io_after[2] - io_before[2],
+        'bytes_written': io_after[3] - io_before[3],
+        'disk_bytes_read': io_after[0] - io_before[0],
+        'disk_bytes_written': io_after[1] - io_before[1],
+    })
+
+
+def run_benchmarks(hcp_dir, stages, cohort_sizes, runs, profile_dir=None):
+    """Measure every stage at every cohort size, each in a fresh spawned process."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for cohort_size in cohort_sizes:
+        subjects = synthetic.generate_cohort(hcp_dir, cohort_size)
+        for stage in stages:
+            queue = context.Queue()
+            process = context.Process(target=measure, args=(stage, hcp_dir, subjects, runs, profile_dir, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            print(f"{stage:<30} n={cohort_size:<4} {result['wall_s']:8.2f} s  {result['peak_rss_mb']:8.0f} MB")
+            results.append(result)
+    return results
+
+
+def compare(results, baseline, wall_tolerance=0.2, rss_tolerance=0.2):
+    """
+    Regressions of ``results`` against ``baseline``.
+
+    Returns
+    -------
+    list of str
+        One message per (stage, cohort size, metric) slower or larger than the
+        baseline by more than the tolerance.
+    """
+    reference = {(r['stage'], r['cohort_size']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = reference.get((result['stage'], result['cohort_size']))
+        if base is None:
+            continue
+        for metric, tolerance in [('wall_per_run_s', wall_tolerance), ('peak_rss_mb', rss_tolerance)]:
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{result['stage']} n={result['cohort_size']}: {metric} {result[metric]:.3f} "
+                    f"> baseline {base[metric]:.3f} (+{tolerance:.0%})"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic HCP data")
+    parser.add_argument('--data', required=True, help="Directory for the synthetic cohort (reused across runs)")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=DEFAULT_STAGES)
+    parser.add_argument('--cohort-sizes', nargs='+', type=int, default=[1, 4])
+    parser.add_argument('--runs', type=int, default=1, choices=[1, 2, 3, 4], help="Runs per subject")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="Baseline JSON to compare against")
+    parser.add_argument('--save-baseline', help="Also write the results as a new baseline")
+    parser.add_argument('--wall-tolerance', type=float, default=0.2)
+    parser.add_argument('--rss-tolerance', type=float, default=0.2)
+    parser.add_argument('--profile-dir', help="Write a cProfile dump per stage and cohort size")
+    parser.add_argument('--real-tools', action='store_true', help="Use the installed FSL/wb_command, not the stubs")
+    args = parser.parse_args(argv)
+
+    if not args.real_tools:
+        os.environ['PATH'] = os.path.join(BENCHMARK_DIR, 'stubs') + os.pathsep + os.environ['PATH']
+
+    results = run_benchmarks(args.data, args.stages, args.cohort_sizes, hcp_paths.RUNS[:args.runs], args.profile_dir)
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.profile_dir:
+        for name in sorted(os.listdir(args.profile_dir)):
+            print(f"\n== {name}")
+            pstats.Stats(os.path.join(args.profile_dir, name)).sort_stats('cumulative').print_stats(8)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.wall_tolerance, args.rss_tolerance)
+        for message in regressions:
+            print(f"REGRESSION: {message}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Stand-ins for the FSL and Connectome Workbench commands used by the scripts.
+
+Each stub accepts the exact command lines the pipeline issues and produces
+equivalent outputs with the in-process implementations from ``utils``, so
+the benchmark suite can exercise the external-tool code paths on a machine
+without FSL or wb_command. Put ``benchmarks/stubs`` first on PATH to use them.
+"""
+import os
+import sys
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils.cifti_utils import (  # noqa: E402
+    CORTEX_LEFT, CORTEX_RIGHT, save_metric, save_volume, separate_cifti,
+)
+from utils.resample_utils import resample_image_isotropic  # noqa: E402
+from utils.warp_utils import apply_warp  # noqa: E402
+
+
+def _options(args):
+    """Parse '--key=value' options into a dict."""
+    return dict(arg[2:].split('=', 1) for arg in args if arg.startswith('--') and '=' in arg)
+
+
+def wb_command(args):
+    """wb_command -cifti-separate <in> COLUMN [-volume-all <out>] [-metric <STRUCTURE> <out>]..."""
+    if args[0] != '-cifti-separate':
+        raise SystemExit(f"wb_command stub: unsupported operation {args[0]}")
+    dtseries = args[1]
+    volume_out = args[args.index('-volume-all') + 1] if '-volume-all' in args else None
+    metrics = {args[i + 1]: args[i + 2] for i, arg in enumerate(args) if arg == '-metric'}
+    separated = separate_cifti(dtseries, surfaces=bool(metrics), volume=volume_out is not None)
+    if volume_out:
+        save_volume(separated, volume_out)
+    for structure, output_file in metrics.items():
+        key = {'CORTEX_LEFT': 'cortex_left', 'CORTEX_RIGHT': 'cortex_right'}[structure]
+        full_name = {'CORTEX_LEFT': CORTEX_LEFT, 'CORTEX_RIGHT': CORTEX_RIGHT}[structure]
+        save_metric(separated[key], full_name, output_file)
+
+
+def applywarp(args):
+    """applywarp --ref=<ref> --in=<in> --warp=<warp> --out=<out> [--interp=trilinear|nn]"""
+    opts = _options(args)
+    interp = 'nearest' if opts.get('interp') == 'nn' else 'trilinear'
+    apply_warp(opts['in'], opts['ref'], opts['warp'], _with_extension(opts['out']), interp=interp)
+
+
+def flirt(args):
+    """flirt -ref <ref> -in <in> -o <out> -applyisoxfm <size> -interp nearestneighbour"""
+    opts = {args[i]: args[i + 1] for i in range(0, len(args) - 1) if args[i].startswith('-')}
+    img = resample_image_isotropic(nib.load(opts['-in']), voxel_size=float(opts['-applyisoxfm']))
+    nib.save(img, _with_extension(opts['-o']))
+
+
+def fslsplit(args):
+    """fslsplit <in> <prefix> -t"""
+    img = nib.load(args[0])
+    data = np.asanyarray(img.dataobj)
+    for t in range(data.shape[-1]):
+        nib.save(nib.Nifti1Image(data[..., t], img.affine, img.header), _with_extension(f'{args[1]}{t:04d}'))
+
+
+def fslmerge(args):
+    """fslmerge -t <out> <in>..."""
+    images = [nib.load(path) for path in args[2:]]
+    data = np.stack([np.asanyarray(img.dataobj) for img in images], axis=-1)
+    nib.save(nib.Nifti1Image(data, images[0].affine, images[0].header), _with_extension(args[1]))
+
+
+def _with_extension(path):
+    """FSL appends the FSLOUTPUTTYPE extension to output names given without an image extension."""
+    extension = '.nii' if os.environ.get('FSLOUTPUTTYPE') == 'NIFTI' else '.nii.gz'
+    return path if path.endswith(('.nii', '.nii.gz')) else path + extension
+
+
+TOOLS = {
+    'wb_command': wb_command,
+    'applywarp': applywarp,
+    'flirt': flirt,
+    'fslsplit': fslsplit,
+    'fslmerge': fslmerge,
+}
+
+
+def main(tool, args):
+    TOOLS[tool](args)
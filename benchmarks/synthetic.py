@@ -0,0 +1,238 @@
+"""
+Synthetic HCP-shaped fixtures for the benchmark suite.
+
+Generates one subject with the files the pipeline reads, laid out as in the
+HCP tree (see utils.hcp_paths), and links further subjects to it:
+
+- a 91,282-grayordinate dtseries (29,696 + 29,716 cortical vertices on
+  fs_LR32k, 31,870 subcortical voxels on the 2mm MNI grid) per run,
+- fs_LR32k aparc / aparc.a2009s '.label.gii' files,
+- an FSL displacement-field warp on a 0.7mm ACPC grid,
+- a 3mm T1 reference,
+- 'coords_for_fdt_matrix2' files for both hemispheres,
+- a warped 4D volume per run on a 2mm ACPC grid, standing in for the
+  applywarp output that the FSL path downsamples to 3mm.
+"""
+import argparse
+import os
+import sys
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import hcp_paths  # noqa: E402
+from utils.stream_utils import NiftiStreamWriter  # noqa: E402
+
+NUM_SURFACE_VERTICES = 32492
+NUM_CORTEX_VERTICES = {'CortexLeft': 29696, 'CortexRight': 29716}
+NUM_SUBCORTICAL_VOXELS = 31870
+MNI_SHAPE = (91, 109, 91)
+MNI_AFFINE = np.array([[-2, 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72], [0, 0, 0, 1]], dtype=float)
+ACPC_SHAPE = (260, 311, 260)
+ACPC_VOXEL = 0.7
+TR = 0.72
+WARPED_VOXEL = 2.0
+FSL_FNIRT_DISPLACEMENT_FIELD = 2006
+
+
+def acpc_affine(voxel_size):
+    """
+    Radiological ACPC grid at any resolution.
+
+    Voxel 0 sits at the same world position on every grid, so the FSL mm
+    frames (voxel * pixdim) of the warp, the 3mm reference and the 0.7mm
+    grid coincide, as they do for images derived with flirt -applyisoxfm.
+    """
+    affine = np.diag([-voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = [ACPC_SHAPE[0] * ACPC_VOXEL / 2, -ACPC_SHAPE[1] * ACPC_VOXEL / 2, -ACPC_SHAPE[2] * ACPC_VOXEL / 2]
+    return affine
+
+
+def subcortical_mask(rng):
+    """Boolean MNI mask with exactly NUM_SUBCORTICAL_VOXELS voxels around the centre."""
+    grid = np.indices(MNI_SHAPE).reshape(3, -1).T
+    centre = np.array(MNI_SHAPE) / 2
+    distance = np.linalg.norm((grid - centre) / [1.0, 1.3, 1.0], axis=1) + rng.random(len(grid)) * 1e-3
+    mask = np.zeros(int(np.prod(MNI_SHAPE)), dtype=bool)
+    mask[np.argsort(distance)[:NUM_SUBCORTICAL_VOXELS]] = True
+    return mask.reshape(MNI_SHAPE)
+
+
+def brain_model_axis(rng):
+    """BrainModelAxis with HCP's grayordinate counts."""
+    axes = []
+    for structure, count in NUM_CORTEX_VERTICES.items():
+        mask = np.zeros(NUM_SURFACE_VERTICES, dtype=bool)
+        mask[np.sort(rng.choice(NUM_SURFACE_VERTICES, count, replace=False))] = True
+        axes.append(nib.cifti2.BrainModelAxis.from_mask(mask, name=structure))
+    volume_mask = subcortical_mask(rng)
+    left = volume_mask.copy()
+    left[MNI_SHAPE[0] // 2:] = False
+    right = volume_mask & ~left
+    axes.append(nib.cifti2.BrainModelAxis.from_mask(left, affine=MNI_AFFINE, name='putamen_left'))
+    axes.append(nib.cifti2.BrainModelAxis.from_mask(right, affine=MNI_AFFINE, name='putamen_right'))
+    brain_models = axes[0]
+    for axis in axes[1:]:
+        brain_models = brain_models + axis
+    return brain_models
+
+
+def write_dtseries(path, brain_models, num_timepoints, rng):
+    """Dense time series with a slow common signal plus noise."""
+    series = nib.cifti2.SeriesAxis(start=0, step=TR, size=num_timepoints, unit='SECOND')
+    signal = np.sin(np.linspace(0, 20 * np.pi, num_timepoints, dtype=np.float32))[:, None]
+    data = (100 + 5 * signal + rng.standard_normal((num_timepoints, len(brain_models)), dtype=np.float32))
+    img = nib.Cifti2Image(data, nib.cifti2.Cifti2Header.from_axes((series, brain_models)))
+    img.nifti_header.set_intent('ConnDenseSeries')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nib.save(img, path)
+
+
+def write_label_gii(path, num_labels, rng):
+    """Label GIFTI of contiguous vertex blocks with a label table; label 0 is the medial wall."""
+    bounds = np.sort(rng.choice(np.arange(1, NUM_SURFACE_VERTICES), num_labels - 1, replace=False))
+    labels = np.searchsorted(bounds, np.arange(NUM_SURFACE_VERTICES), side='right').astype(np.int32) + 1
+    labels[rng.random(NUM_SURFACE_VERTICES) < 0.08] = 0
+
+    table = nib.gifti.GiftiLabelTable()
+    for key in range(num_labels + 1):
+        label = nib.gifti.GiftiLabel(key, *rng.random(3), 1.0)
+        label.label = '???' if key == 0 else f'parcel_{key}'
+        table.labels.append(label)
+    darray = nib.gifti.GiftiDataArray(labels, intent='NIFTI_INTENT_LABEL', datatype='NIFTI_TYPE_INT32')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nib.save(nib.gifti.GiftiImage(labeltable=table, darrays=[darray]), path)
+
+
+def write_t1_3mm(path):
+    """3mm reference on the ACPC field of view."""
+    shape = tuple(int(np.floor(n * ACPC_VOXEL / 3 + 0.5)) for n in ACPC_SHAPE)
+    img = nib.Nifti1Image(np.ones(shape, dtype=np.float32), acpc_affine(3.0))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nib.save(img, path)
+    return img
+
+
+def write_warp(path, warp_shape=ACPC_SHAPE, warp_voxel=ACPC_VOXEL):
+    """
+    Smooth relative displacement field (mm) from ACPC to MNI.
+
+    The constant part moves the ACPC field of view onto the MNI one; a few mm
+    of sinusoidal deformation on top keeps the interpolation non-trivial.
+    """
+    grid = np.indices(warp_shape, dtype=np.float32)
+    field = np.empty(warp_shape + (3,), dtype=np.float32)
+    mni_extent = np.array(MNI_SHAPE) * 2.0
+    acpc_extent = np.array(warp_shape) * warp_voxel
+    for axis in range(3):
+        field[..., axis] = (mni_extent[axis] - acpc_extent[axis]) / 2 + 2.0 * np.sin(grid[(axis + 1) % 3] / 15.0)
+    img = nib.Nifti1Image(field, acpc_affine(warp_voxel))
+    img.header['intent_code'] = FSL_FNIRT_DISPLACEMENT_FIELD
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nib.save(img, path)
+
+
+def warped_volume_path(subject_dir, phase, direction):
+    """Synthetic applywarp output of one run, read by the downsampling benchmark."""
+    return os.path.join(subject_dir, 'benchmark', f'Atlas_in_T1w_REST{phase}_{direction}.nii')
+
+
+def write_warped_volume(path, num_timepoints, rng, chunk_size=50):
+    """4D volume on the ACPC field of view at WARPED_VOXEL mm, written a chunk of time points at a time."""
+    shape = tuple(int(np.floor(n * ACPC_VOXEL / WARPED_VOXEL + 0.5)) for n in ACPC_SHAPE)
+    base = 100 + rng.standard_normal(shape, dtype=np.float32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with NiftiStreamWriter(path, shape + (num_timepoints,), acpc_affine(WARPED_VOXEL), tr=TR) as writer:
+        for start in range(0, num_timepoints, chunk_size):
+            t = np.arange(start, min(start + chunk_size, num_timepoints), dtype=np.float32)
+            writer.write(base[..., None] + 5 * np.sin(t / 10))
+
+
+def write_warped_volumes(subject_dir, subject_name, runs, rng):
+    """Warped volumes of the runs that have a dtseries and no warped volume yet, as long as their dtseries."""
+    for phase, direction in runs:
+        dtseries = hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
+        path = warped_volume_path(subject_dir, phase, direction)
+        if os.path.exists(dtseries) and not os.path.exists(path):
+            write_warped_volume(path, nib.load(dtseries).shape[0], rng)
+
+
+def write_coords(path, t1_shape, num_voxels, hemisphere, rng):
+    """probtrackx-style coordinates inside the central striatal box of one hemisphere."""
+    centre = np.array(t1_shape) // 2
+    x_range = (centre[0] - 12, centre[0] - 2) if hemisphere == 'L' else (centre[0] + 2, centre[0] + 12)
+    box = np.array([x_range, (centre[1] - 8, centre[1] + 8), (centre[2] - 6, centre[2] + 6)])
+    candidates = np.stack(np.meshgrid(*[np.arange(lo, hi) for lo, hi in box], indexing='ij'), -1).reshape(-1, 3)
+    coords = candidates[np.sort(rng.choice(len(candidates), min(num_voxels, len(candidates)), replace=False))]
+    columns = np.column_stack([coords, np.zeros(len(coords), dtype=int), np.arange(len(coords))])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savetxt(path, columns, fmt='%d')
+
+
+def generate_subject(hcp_dir, subject_name, num_timepoints=1200, runs=hcp_paths.RUNS, small_warp=False,
+                     num_coords=1500, seed=0):
+    """Write every fixture file of one synthetic subject."""
+    rng = np.random.default_rng(seed)
+    subject_dir = os.path.join(hcp_dir, subject_name)
+    brain_models = brain_model_axis(rng)
+    for phase, direction in runs:
+        write_dtseries(hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction),
+                       brain_models, num_timepoints, rng)
+    for hemisphere in hcp_paths.HEMISPHERES:
+        write_label_gii(hcp_paths.label_gii_path(subject_dir, subject_name, hemisphere, 'aparc'), 35, rng)
+        write_label_gii(hcp_paths.label_gii_path(subject_dir, subject_name, hemisphere, 'aparc.a2009s'), 75, rng)
+    t1 = write_t1_3mm(hcp_paths.t1_ref_path(subject_dir))
+    if small_warp:
+        write_warp(hcp_paths.warp_path(subject_dir, subject_name), warp_shape=t1.shape, warp_voxel=3.0)
+    else:
+        write_warp(hcp_paths.warp_path(subject_dir, subject_name))
+    for hemisphere in hcp_paths.HEMISPHERES:
+        write_coords(hcp_paths.coords_path(subject_dir, hemisphere), t1.shape, num_coords, hemisphere, rng)
+    write_warped_volumes(subject_dir, subject_name, runs, rng)
+    return subject_dir
+
+
+def link_subject(hcp_dir, template_name, subject_name):
+    """Create another subject whose input files are symlinks to the template subject's."""
+    template_dir = os.path.join(hcp_dir, template_name)
+    for root, _, files in os.walk(template_dir):
+        rel_root = os.path.relpath(root, template_dir).replace(template_name, subject_name)
+        if rel_root.startswith('fMRI'):
+            continue
+        for name in files:
+            if name.endswith('.h5') or name.endswith('.npy') or name == 'fMRI_downsampled_3mm.nii.gz':
+                continue
+            target_dir = os.path.join(hcp_dir, subject_name, rel_root)
+            os.makedirs(target_dir, exist_ok=True)
+            link = os.path.join(target_dir, name.replace(template_name, subject_name))
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(root, name), link)
+
+
+def generate_cohort(hcp_dir, num_subjects, **kwargs):
+    """One generated subject plus ``num_subjects - 1`` linked copies; returns the subject names."""
+    subjects = [f'9{index:05d}' for index in range(num_subjects)]
+    if not os.path.isdir(os.path.join(hcp_dir, subjects[0])):
+        generate_subject(hcp_dir, subjects[0], **kwargs)
+    else:
+        # Fixture directories generated before the warped volumes existed
+        write_warped_volumes(os.path.join(hcp_dir, subjects[0]), subjects[0], kwargs.get('runs', hcp_paths.RUNS),
+                             np.random.default_rng(kwargs.get('seed', 0)))
+    for subject_name in subjects[1:]:
+        link_subject(hcp_dir, subjects[0], subject_name)
+    return subjects
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic HCP-shaped cohort")
+    parser.add_argument('hcp_dir')
+    parser.add_argument('--subjects', type=int, default=1)
+    parser.add_argument('--timepoints', type=int, default=1200)
+    parser.add_argument('--small-warp', action='store_true', help="3mm warp grid instead of the 0.7mm ACPC grid")
+    args = parser.parse_args(argv)
+    subjects = generate_cohort(args.hcp_dir, args.subjects, num_timepoints=args.timepoints, small_warp=args.small_warp)
+    print(f"Generated {len(subjects)} subjects in {args.hcp_dir}")
+
+
+if __name__ == "__main__":
+    main()
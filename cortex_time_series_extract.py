@@ -1,202 +1,348 @@
 import os
-import subprocess
 import logging
+import time
 import nibabel as nib
 import numpy as np
-from multiprocessing import Pool, cpu_count
-
-# Set paths
-hcp_dir = '/home/test/lmq/data/HCP'
+from multiprocessing import Pool
+from utils import parcel_utils
+from utils import script_config as config
+from utils import telemetry_utils as telemetry
+from utils.catalog_utils import DatasetCatalog, group_runs
+from utils import hcp_paths
+from utils.hcp_paths import RUNS
+from utils.io_utils import atomic_output
+from utils.manifest_utils import RunManifest, drop_failed_upstream, record_runs, stale_runs
+from utils.cifti_utils import CORTEX_LEFT, CORTEX_RIGHT, open_dense_time_series, separate_cifti, surface_time_series
+from utils.parcel_utils import ParcelTimeSeries, average_parcels
+from utils.qc_utils import time_series_qc, write_qc
+from utils.store_utils import provenance, write_time_series
+from utils.stream_utils import iter_time_chunks
+
+# The HCP directory, worker count, manifest, catalog, telemetry and external tool
+# settings are shared by the three scripts in utils/script_config.py
+
+# Use `wb_command -cifti-separate` and read the .func.gii files back instead of
+# separating the dense time series in memory (kept for byte-for-byte comparison)
+separate_with_wb_command = False
+
+# Output backend: 'auto' (HDF5 if h5py is installed, else NPY), 'hdf5', 'npy' or 'csv'
+output_format = 'auto'
+
+# FreeSurfer parcellations averaged per run ('{subject}.{L,R}.<name>.32k_fs_LR.label.gii')
+parcellations = ['aparc.a2009s', 'aparc']
+
+# Average each run in chunks of this many time points so that only one chunk of the
+# vertex x time matrix is in memory (None separates the whole run at once)
+stream_chunk_size = None
+
+# Additional parcellations: name -> label GIFTI path template with {subject} and {hemisphere}
+extra_label_files = {}
+
+# Node-local scratch directory where parcel operators are published once and
+# memory-mapped by every worker (None keeps a private copy per worker)
+operator_cache_dir = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def run_command(command):
-    """Run a shell command with error handling."""
-    try:
-        subprocess.run(command, shell=True, check=True)
-        logging.info(f"Command succeeded: {command}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed: {command}\nError: {e}")
+def run_command(argv, **kwargs):
+    """Run one external tool (argv list, no shell) through the executor; raises on failure or timeout."""
+    return config.command_executor().run(argv, **kwargs)
+
+
+def load_func_gii(func_gii):
+    """Load a .func.gii as an array of shape (num_vertices, num_timepoints); arrays pass through."""
+    if isinstance(func_gii, np.ndarray):
+        return func_gii
+    # Load the functional GIFTI image
+    func_img = nib.load(func_gii)
+    # Each darray is one time point, shape: (#vertices,) for each time slice
+    # We stack them along axis=1 so final shape becomes (num_vertices, num_timepoints).
+    return np.column_stack([darr.data for darr in func_img.darrays])
 
 
-def average_partition_timeseries(func_gii_path, label_gii_path):
+def average_partition_timeseries(func_gii, label_gii_paths):
     """
-    Given a functional GIFTI (.func.gii) and a label GIFTI (.label.gii),
-    compute the average time series for each unique label in the data.
+    Given a functional GIFTI (.func.gii) and one or more label GIFTI (.label.gii)
+    files, compute the average time series for each unique label in the data.
+
+    Label 0 is excluded. The averaging is one sparse product per call over
+    all parcellations (see ``utils.parcel_utils.average_parcels``), and the
+    operators are cached across runs and subjects sharing a label file.
 
     Parameters
     ----------
-    func_gii_path : str
+    func_gii : str or np.ndarray
         Path to the cortical fMRI time series GIFTI file
-        (e.g., 'rfMRI_REST1_LR_cortex_left.func.gii').
-    label_gii_path : str
+        (e.g., 'rfMRI_REST1_LR_cortex_left.func.gii'), or the already
+        separated surface data of shape (num_vertices, num_timepoints).
+    label_gii_paths : str or dict
         Path to the label GIFTI file
-        (e.g., '100307.L.aparc.a2009s.32k_fs_LR.label.gii').
+        (e.g., '100307.L.aparc.a2009s.32k_fs_LR.label.gii'), or a dict of
+        parcellation name -> path to average several parcellations at once.
 
     Returns
     -------
-    partition_ts : dict
-        A dictionary where:
-          - Keys: unique label IDs (could be float or integer).
-          - Values: 1D NumPy arrays of length num_timepoints,
-                    representing the average time course across vertices
-                    for that label.
+    partition_ts : ParcelTimeSeries or dict
+        For a single path, a ParcelTimeSeries with label_ids (num_labels,),
+        label_names and data of shape (num_labels, num_timepoints); for a
+        dict, parcellation name -> ParcelTimeSeries.
     """
-    # Load the functional GIFTI image
-    func_img = nib.load(func_gii_path)
-    # Each darray is one time point, shape: (#vertices,) for each time slice
-    # We stack them along axis=1 so final shape becomes (num_vertices, num_timepoints).
-    func_data = np.column_stack([darr.data for darr in func_img.darrays])
+    func_data = load_func_gii(func_gii)
+    if isinstance(label_gii_paths, dict):
+        return average_parcels(func_data, label_gii_paths)
+    return average_parcels(func_data, {'labels': label_gii_paths})['labels']
 
-    # Load the label GIFTI image (assumes one darray with label info)
-    label_img = nib.load(label_gii_path)
-    labels = label_img.darrays[0].data  # shape: (num_vertices,)
 
-    # Collect unique labels
-    unique_labels = np.unique(labels)
-
-    # Prepare a dictionary to store average time series for each label
-    partition_ts = {}
-    for lb in unique_labels:
-        # If you want to exclude label 0
-        if lb == 0:
-            continue
-        # Find all vertices belonging to the current label
-        idx = np.where(labels == lb)[0]
-        # Compute the average time series for these vertices
-        avg_ts = func_data[idx, :].mean(axis=0)
-        partition_ts[lb] = avg_ts
+def stream_partition_timeseries(dtseries_path, label_gii_paths_by_structure, chunk_size):
+    """
+    Parcel averages of both hemispheres, reading the dense time series in time chunks.
 
-    return partition_ts
+    The averages of consecutive chunks are concatenated along time, which
+    gives the same result as averaging the separated surfaces of the whole
+    run.
 
+    Parameters
+    ----------
+    dtseries_path : str
+        Dense time series ('*_Atlas_hp2000_clean.dtseries.nii').
+    label_gii_paths_by_structure : dict
+        CIFTI structure (``CORTEX_LEFT``/``CORTEX_RIGHT``) -> parcellation
+        name -> label GIFTI path.
+    chunk_size : int
+        Time points per chunk.
 
-def save_time_series_dict(timeseries_dict, output_file):
+    Returns
+    -------
+    dict
+        Structure -> parcellation name -> ParcelTimeSeries.
     """
-    Saves a dictionary of label -> time series to a CSV file.
+    dataobj, brain_models, _ = open_dense_time_series(dtseries_path)
+    blocks = {structure: [] for structure in label_gii_paths_by_structure}
+    for _, _, chunk in iter_time_chunks(dataobj, chunk_size, time_axis=0):
+        for structure, label_gii_paths in label_gii_paths_by_structure.items():
+            surface = surface_time_series(chunk, brain_models, structure)
+            blocks[structure].append(average_parcels(surface, label_gii_paths))
+    return {
+        structure: {
+            name: ParcelTimeSeries(
+                parts[0][name].label_ids, parts[0][name].label_names,
+                np.concatenate([part[name].data for part in parts], axis=1),
+            )
+            for name in label_gii_paths_by_structure[structure]
+        }
+        for structure, parts in blocks.items()
+    }
+
+
+def save_partition_timeseries(partition_ts, output_file):
+    """
+    Saves parcel-averaged time series to a CSV file, with the label IDs and
+    names in a companion '<output_file>.labels.txt'.
 
     Parameters
     ----------
-    timeseries_dict : dict
-        Dictionary where the key is a label ID and the value is a 1D NumPy array
-        representing the average time course for that label.
+    partition_ts : ParcelTimeSeries
+        Label IDs, names and time series of shape (num_labels, num_timepoints).
     output_file : str
         Full path to the output CSV file.
+
+    Returns
+    -------
+    list of str
+        Paths of the written files (empty when there is nothing to save).
     """
-    if not timeseries_dict:
+    if len(partition_ts.label_ids) == 0:
         logging.warning(f"No time series data found; skipping save to {output_file}")
-        return
-
-    # Sort label IDs to have a consistent row ordering
-    label_ids = sorted(timeseries_dict.keys())
-
-    # Each row in this matrix will correspond to one label's time series
-    # shape: (num_labels, num_timepoints)
-    time_series_matrix = np.array([timeseries_dict[lb] for lb in label_ids])
-
-    # Save to CSV
-    np.savetxt(output_file, time_series_matrix, delimiter=",")
-    logging.info(f"Saved time series to {output_file} with shape {time_series_matrix.shape}")
+        return []
 
-    # Optional: save the label IDs to a separate file or a header
-    # For example:
-    # with open(output_file + '.labels.txt', 'w') as f:
-    #     for lb in label_ids:
-    #         f.write(f"{lb}\n")
+    # Each row corresponds to one label's time series, in sorted label order
+    with atomic_output(output_file) as tmp_file:
+        np.savetxt(tmp_file, partition_ts.data, delimiter=",")
+    with atomic_output(output_file + '.labels.txt') as tmp_file, open(tmp_file, 'w') as f:
+        for lb, name in zip(partition_ts.label_ids, partition_ts.label_names):
+            f.write(f"{lb}\t{name}\n")
+    logging.info(f"Saved time series to {output_file} with shape {partition_ts.data.shape}")
+    return [output_file, output_file + '.labels.txt']
 
 
 def process_cortex(subject_name, direction, phase, subject_dir):
-    """Process cortex data for a given subject, direction, and phase."""
+    """
+    Process cortex data for a given subject, direction, and phase.
+
+    Returns
+    -------
+    list of str or None
+        Paths of the written files, or None when an input is missing.
+    """
     logging.info(f"Processing cortex for subject: {subject_name}, phase: {phase}, direction: {direction}")
 
-    cortex_data_dir = os.path.join(
-        subject_dir,
-        f'{subject_name}_3T_rfMRI_REST_fix',
-        subject_name,
-        'MNINonLinear',
-        'Results',
-        f'rfMRI_REST{phase}_{direction}'
-    )
-    cortex_data = os.path.join(
-        cortex_data_dir,
-        f'rfMRI_REST{phase}_{direction}_Atlas_hp2000_clean.dtseries.nii'
-    )
+    cortex_data_dir = hcp_paths.results_dir(subject_dir, subject_name, phase, direction)
+    cortex_data = hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
 
     # Check if required files exist
     if not os.path.exists(cortex_data):
         logging.warning(f"Missing cortex data: {cortex_data}")
-        return
-
-    # Extract cortical data to GIFTI files
-    cortex_left_metric = os.path.join(cortex_data_dir, f'rfMRI_REST{phase}_{direction}_cortex_left.func.gii')
-    cortex_right_metric = os.path.join(cortex_data_dir, f'rfMRI_REST{phase}_{direction}_cortex_right.func.gii')
-
-    separate_cmd = (
-        f'wb_command -cifti-separate {cortex_data} COLUMN '
-        f'-metric CORTEX_LEFT {cortex_left_metric} '
-        f'-metric CORTEX_RIGHT {cortex_right_metric}'
-    )
-    run_command(separate_cmd)
-
-    # Paths to label GIFTI files
-    left_label_gii = os.path.join(
-        subject_dir,
-        f'{subject_name}_3T_Structural_preproc',
-        subject_name,
-        'MNINonLinear',
-        'fsaverage_LR32k',
-        f'{subject_name}.L.aparc.a2009s.32k_fs_LR.label.gii'
-    )
-    right_label_gii = os.path.join(
-        subject_dir,
-        f'{subject_name}_3T_Structural_preproc',
-        subject_name,
-        'MNINonLinear',
-        'fsaverage_LR32k',
-        f'{subject_name}.R.aparc.a2009s.32k_fs_LR.label.gii'
-    )
-
-    # Compute average time series for the left hemisphere
-    left_partition_timeseries = average_partition_timeseries(cortex_left_metric, left_label_gii)
-    logging.info(f"Number of left hemisphere labels: {len(left_partition_timeseries)}")
-
-    # Compute average time series for the right hemisphere
-    right_partition_timeseries = average_partition_timeseries(cortex_right_metric, right_label_gii)
-    logging.info(f"Number of right hemisphere labels: {len(right_partition_timeseries)}")
-
-    # Save the time series to CSV files (separate for left and right)
-    output_dir_sub = os.path.join(subject_dir, 'fMRI', f'phase{phase}_{direction}')
+        return None
+
+    # Paths to label GIFTI files, per hemisphere and parcellation
+    label_files = {}
+    for hemisphere in hcp_paths.HEMISPHERES:
+        label_gii_paths = {
+            parcellation: hcp_paths.label_gii_path(subject_dir, subject_name, hemisphere, parcellation)
+            for parcellation in parcellations
+        }
+        label_gii_paths.update({name: path.format(subject=subject_name, hemisphere=hemisphere)
+                                for name, path in extra_label_files.items()})
+        missing = [path for path in label_gii_paths.values() if not os.path.exists(path)]
+        if missing:
+            logging.warning(f"Missing label files: {missing}")
+            label_gii_paths = {name: path for name, path in label_gii_paths.items() if path not in missing}
+        if label_gii_paths:
+            label_files[hemisphere] = label_gii_paths
+    if not label_files:
+        return None
+
+    streamed = None
+    if separate_with_wb_command:
+        # Extract cortical data to GIFTI files
+        cortex_left_metric = os.path.join(cortex_data_dir, f'rfMRI_REST{phase}_{direction}_cortex_left.func.gii')
+        cortex_right_metric = os.path.join(cortex_data_dir, f'rfMRI_REST{phase}_{direction}_cortex_right.func.gii')
+
+        run_command(['wb_command', '-cifti-separate', cortex_data, 'COLUMN',
+                     '-metric', 'CORTEX_LEFT', cortex_left_metric, '-metric', 'CORTEX_RIGHT', cortex_right_metric])
+    elif stream_chunk_size:
+        # Average chunk by chunk without separating the whole run
+        structures = {'L': CORTEX_LEFT, 'R': CORTEX_RIGHT}
+        with telemetry.stage('stream'):
+            streamed = stream_partition_timeseries(
+                cortex_data, {structures[h]: paths for h, paths in label_files.items()}, stream_chunk_size
+            )
+        streamed = {h: streamed[structures[h]] for h in label_files}
+        cortex_left_metric = cortex_right_metric = None
+    else:
+        # Separate the dense time series in memory; no .func.gii round-trip
+        with telemetry.stage('separate_cifti'):
+            separated = separate_cifti(cortex_data, volume=False)
+        cortex_left_metric = separated['cortex_left']
+        cortex_right_metric = separated['cortex_right']
+
+    output_dir_sub = hcp_paths.output_dir(subject_dir, phase, direction)
     os.makedirs(output_dir_sub, exist_ok=True)
 
-    left_output_file = os.path.join(output_dir_sub, "voxel_time_series_L_cortex.csv")
-    right_output_file = os.path.join(output_dir_sub, "voxel_time_series_R_cortex.csv")
-
-    save_time_series_dict(left_partition_timeseries, left_output_file)
-    save_time_series_dict(right_partition_timeseries, right_output_file)
-
+    outputs = []
+    qc = {}
+    for hemisphere, metric in [('L', cortex_left_metric), ('R', cortex_right_metric)]:
+        if hemisphere not in label_files:
+            continue
+        label_gii_paths = label_files[hemisphere]
+
+        if streamed is not None:
+            partition_timeseries = streamed[hemisphere]
+        else:
+            # Compute average time series for every parcellation of this hemisphere in one pass
+            with telemetry.stage('average_parcels', hemisphere=hemisphere):
+                partition_timeseries = average_partition_timeseries(metric, label_gii_paths)
+
+        for name, partition_ts in partition_timeseries.items():
+            logging.info(f"Number of {hemisphere} hemisphere labels in {name}: {len(partition_ts.label_ids)}")
+            qc[f"cortex_{hemisphere}_{name}"] = time_series_qc(partition_ts.data)
+            if output_format != 'csv':
+                outputs.append(write_time_series(
+                    output_dir_sub, f"cortex_{hemisphere}_{name}", partition_ts.data,
+                    label_ids=partition_ts.label_ids, label_names=partition_ts.label_names,
+                    meta={'provenance': provenance(source=cortex_data, labels=label_gii_paths[name])},
+                    backend=output_format,
+                ))
+                continue
+            # The default parcellation keeps the historical file name
+            suffix = '' if name == 'aparc.a2009s' else f'_{name}'
+            output_file = os.path.join(output_dir_sub, f"voxel_time_series_{hemisphere}_cortex{suffix}.csv")
+            outputs += save_partition_timeseries(partition_ts, output_file)
+
+    # QC of the parcel averages (tSNR, DVARS, global signal, zero-variance fraction)
+    write_qc(output_dir_sub, qc)
+    return outputs
+
+
+def stage_inputs(subject_name, phase, direction):
+    """Files the extraction of a run reads; their fingerprints decide whether a recorded run is stale."""
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
+    inputs = [hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)]
+    for hemisphere in hcp_paths.HEMISPHERES:
+        inputs += [hcp_paths.label_gii_path(subject_dir, subject_name, hemisphere, parcellation)
+                   for parcellation in parcellations]
+        inputs += [path.format(subject=subject_name, hemisphere=hemisphere) for path in extra_label_files.values()]
+    return inputs
+
+
+def stage_params():
+    """Parameters that change the extracted files."""
+    return {'parcellations': parcellations, 'extra_label_files': extra_label_files, 'output_format': output_format}
+
+
+def process_subject(subject_name, runs=None):
+    """
+    Process the given (phase, direction) runs (default: all four) of a single subject.
 
-def process_subject(subject_name):
-    """Process a single subject."""
+    Returns
+    -------
+    subject_name : str
+    results : list of (phase, direction, outputs, error)
+        One entry per run, as recorded by ``manifest_utils.record_runs``.
+    """
     logging.info(f"Processing subject: {subject_name}")
-    subject_dir = os.path.join(hcp_dir, subject_name)
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
     if not os.path.isdir(subject_dir):
         logging.warning(f"{subject_dir} is not a valid directory. Skipping...")
-        return
+        return subject_name, []
+
+    results = []
+    for phase, direction in runs or RUNS:
+        try:
+            with telemetry.stage('cortex', subject=subject_name, phase=phase, direction=direction):
+                outputs = process_cortex(subject_name, direction, phase, subject_dir)
+            results.append((phase, direction, outputs, None))
+        except Exception as e:
+            logging.exception(f"Failed subject: {subject_name}, phase: {phase}, direction: {direction}")
+            results.append((phase, direction, None, repr(e)))
+    return subject_name, results
+
 
-    for direction in ['LR', 'RL']:
-        for phase in [1, 2]:
-            process_cortex(subject_name, direction, phase, subject_dir)
+def process_task(task):
+    """``process_subject`` of one (subject_name, runs) task."""
+    return process_subject(*task)
 
 
 def main():
     """Main function to process all subjects in parallel."""
-    subjects = [name for name in os.listdir(hcp_dir) if os.path.isdir(os.path.join(hcp_dir, name))]
-    # subjects = ['100307']  # Uncomment for testing a single subject
-    num_workers = 5
-    logging.info(f"Starting multiprocessing with {num_workers} workers...")
-    with Pool(num_workers) as pool:
-        pool.map(process_subject, subjects)
+    if config.catalog_file:
+        # Plan from the catalog: only runs whose dense time series is on disk
+        catalog = DatasetCatalog(config.catalog_file)
+        catalog.refresh(config.hcp_dir)
+        tasks = group_runs(catalog.runs(kind='dtseries'))
+    else:
+        tasks = [(name, RUNS) for name in os.listdir(config.hcp_dir)
+                 if os.path.isdir(os.path.join(config.hcp_dir, name))]
+    # tasks = [('100307', RUNS)]  # Uncomment for testing a single subject
+    manifest = RunManifest(config.manifest_file) if config.manifest_file else None
+    if manifest is not None:
+        # Never extract from what a failed upstream run left on disk, even when forced
+        tasks = drop_failed_upstream(manifest, tasks, 'cortex')
+        if not config.force:
+            tasks = stale_runs(manifest, tasks, 'cortex', stage_inputs, stage_params())
+    logging.info(f"Starting multiprocessing with {config.num_workers} workers on {len(tasks)} subjects...")
+    parcel_utils.operator_cache_dir = operator_cache_dir
+    telemetry.configure(config.telemetry_file)
+    start = time.time()
+    with Pool(config.num_workers) as pool:
+        # Record each subject's runs as soon as it finishes, from this process only
+        for subject_name, results in pool.imap_unordered(process_task, tasks):
+            if manifest is not None:
+                record_runs(manifest, subject_name, results, 'cortex', stage_inputs, stage_params())
+    if config.telemetry_file:
+        logging.info("Telemetry summary:\n" + telemetry.report(config.telemetry_file, config.prometheus_file, since=start))
 
 
 if __name__ == "__main__":
@@ -1,122 +1,352 @@
 import os
-import subprocess
 import logging
-from multiprocessing import Pool, cpu_count
+import time
+import nibabel as nib
+import numpy as np
+from nibabel.affines import voxel_sizes
+from multiprocessing import Pool
+from utils import script_config as config
+from utils import telemetry_utils as telemetry
+from utils.catalog_utils import DatasetCatalog, group_runs
+from utils import hcp_paths
+from utils.hcp_paths import RUNS
+from utils.cifti_utils import open_dense_time_series, separate_cifti, save_volume, volume_columns
+from utils.manifest_utils import RunManifest, record_runs, stale_runs
+from utils.resample_utils import resample_image_isotropic
+from utils.stream_utils import NiftiStreamWriter, iter_time_chunks
+from utils.warp_utils import apply_dense_sampling_operator, apply_warp, cached_sampling_operator, compare_with_applywarp
+from utils.workspace_utils import Workspace
 
-# Set the root directory for HCP data
-hcp_dir = '/home/test/lmq/data/HCP'
+# The HCP directory, worker count, manifest, catalog, telemetry and external tool
+# settings are shared by the three scripts in utils/script_config.py
+
+# Register with applywarp + downsampling on disk instead of the cached
+# composite (warp + 3mm downsample) sampling operator
+register_with_fsl = False
+
+# Per-subject sampling operators, keyed by the hashes of the warp and reference files
+sampling_cache_dir = os.path.join(config.hcp_dir, '.sampling_cache')
+sampling_cache_max_bytes = 20 * 1024 ** 3
+
+# Node-local scratch directory: cached operators are copied there once and
+# memory-mapped by every worker (None maps them from sampling_cache_dir)
+local_cache_dir = None
+
+# Time points per chunk and threads used when applying the warp in process
+registration_chunk_size = 100
+registration_threads = 4
+
+# Read, warp and write each run in chunks of this many time points so that peak
+# memory does not grow with run length (None reads the whole run at once)
+stream_chunk_size = None
+
+# Use `wb_command -cifti-separate` instead of the in-process reader
+# (kept for byte-for-byte comparison of the separated volume)
+separate_with_wb_command = False
+
+# Use fslsplit -> per-volume flirt -> fslmerge instead of the vectorized resampler
+downsample_with_flirt = False
+
+# Per-job workspace of the FSL path's intermediates, removed when the run ends: a
+# fast node-local disk or tmpfs such as /dev/shm (None: the system temporary directory)
+scratch_dir = None
+# Write the intermediates gzipped (FSLOUTPUTTYPE=NIFTI_GZ) instead of as plain NIfTI
+compress_intermediates = False
+# gzip level of the published fMRI_downsampled_3mm.nii.gz
+output_compresslevel = 1
+# Quota guard: refuse or stop a run whose workspace would exceed scratch_max_bytes
+# (None: no limit) or leave less than scratch_min_free_bytes free on the scratch disk
+scratch_max_bytes = None
+scratch_min_free_bytes = 2 * 1024 ** 3
+# Keep the workspace of a failed run for inspection
+keep_failed_workspace = False
+
+# Print the planned command DAG with costs estimated from the telemetry file instead of running it
+dry_run = False
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def run_command(command):
-    """Run a shell command with error handling."""
-    try:
-        subprocess.run(command, shell=True, check=True)
-        logging.info(f"Command succeeded: {command}")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Command failed: {command}\nError: {e}")
+def run_command(argv, **kwargs):
+    """Run one external tool (argv list, no shell) through the executor; raises on failure or timeout."""
+    return config.command_executor(dry_run).run(argv, **kwargs)
 
 
 def process_fMRI(subject_name, direction, phase, subject_dir):
-    """Process fMRI data for a given subject, direction, and phase."""
-    fMRI_data_dir = os.path.join(
-        subject_dir,
-        f'{subject_name}_3T_rfMRI_REST_fix',
-        subject_name,
-        'MNINonLinear',
-        'Results',
-        f'rfMRI_REST{phase}_{direction}'
-    )
-    fMRI_data = os.path.join(
-        fMRI_data_dir,
-        f'rfMRI_REST{phase}_{direction}_Atlas_hp2000_clean.dtseries.nii'
-    )
+    """
+    Process fMRI data for a given subject, direction, and phase.
+
+    Returns
+    -------
+    list of str or None
+        The registered volume, or None when the dense time series is missing
+        or the run was only planned (``dry_run``).
+    """
+    fMRI_data = hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
 
     # Check if fMRI data exists
     if not os.path.exists(fMRI_data):
         logging.warning(f"Missing fMRI data: {fMRI_data}")
-        return
+        return None
+
+    t1_ref = hcp_paths.t1_ref_path(subject_dir)
+    warp_file = hcp_paths.warp_path(subject_dir, subject_name)
+    merged_output = hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)
+
+    executor = config.command_executor(dry_run)
+    if not register_with_fsl and executor.dry_run:
+        executor.add_step('registration', f'native registration of {fMRI_data}', [fMRI_data, t1_ref, warp_file],
+                          [merged_output])
+        return None
+
+    if not register_with_fsl and stream_chunk_size:
+        stream_register(fMRI_data, t1_ref, warp_file, merged_output)
+        return [merged_output]
+
+    if not register_with_fsl:
+        # Warp and downsample every time point with one sparse product, reading the
+        # volumetric grayordinates registration_chunk_size time points at a time
+        dataobj, brain_models, series = open_dense_time_series(fMRI_data)
+        with telemetry.stage('warp_downsample'):
+            operator, out_shape, out_affine, columns = registration_operator(brain_models, t1_ref, warp_file)
+            registered = apply_dense_sampling_operator(
+                operator, dataobj, columns, out_shape, chunk_size=registration_chunk_size,
+                num_threads=registration_threads
+            )
+        with telemetry.stage('write_volume'):
+            save_volume({'volume': registered, 'affine': out_affine, 'tr': series.step}, merged_output)
+        return [merged_output]
+
+    with Workspace(scratch_dir, f'{subject_name}_REST{phase}_{direction}', compress=compress_intermediates,
+                   max_bytes=scratch_max_bytes, min_free_bytes=scratch_min_free_bytes,
+                   keep_on_failure=keep_failed_workspace) as workspace:
+        register_in_workspace(workspace, fMRI_data, t1_ref, warp_file, merged_output)
+    return None if executor.dry_run else [merged_output]
+
+
+def stage_inputs(subject_name, phase, direction):
+    """Files the registration of a run reads; their fingerprints decide whether a recorded run is stale."""
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
+    return [
+        hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction),
+        hcp_paths.t1_ref_path(subject_dir),
+        hcp_paths.warp_path(subject_dir, subject_name),
+    ]
+
+
+def stage_params():
+    """Parameters that change the registered volume."""
+    params = {'voxel_size': 3, 'register_with_fsl': register_with_fsl}
+    if register_with_fsl:
+        params.update(downsample_with_flirt=downsample_with_flirt, separate_with_wb_command=separate_with_wb_command)
+    return params
+
+
+def register_in_workspace(workspace, fMRI_data, t1_ref, warp_file, merged_output):
+    """FSL registration of one run with every intermediate in ``workspace``; only the result is published."""
+    executor = config.command_executor(dry_run)
+    # Peak scratch: the separated volume, the warped run and, with flirt, its split and downsampled
+    # volumes plus the merged result (float32; an upper bound when intermediates are compressed)
+    dataobj, brain_models, _ = open_dense_time_series(fMRI_data)
+    num_volumes = dataobj.shape[0]
+    separated_bytes = 4 * num_volumes * int(np.prod(brain_models.volume_shape))
+    warped_bytes = 4 * num_volumes * int(np.prod(nib.load(t1_ref).shape[:3]))
+    if not executor.dry_run:
+        workspace.reserve(separated_bytes + warped_bytes * (4 if downsample_with_flirt else 2))
 
     # Separate the CIFTI file into volume
-    volume_file = os.path.join(fMRI_data_dir, f'rfMRI_REST{phase}_{direction}.nii.gz')
-    run_command(f'wb_command -cifti-separate {fMRI_data} COLUMN -volume-all {volume_file}')
+    volume_file = workspace.image('separated')
+    if separate_with_wb_command:
+        run_command(['wb_command', '-cifti-separate', fMRI_data, 'COLUMN', '-volume-all', volume_file],
+                    inputs=[fMRI_data], outputs=[volume_file])
+    else:
+        executor.call('separate_cifti', lambda: save_volume(separate_cifti(fMRI_data, surfaces=False), volume_file),
+                      inputs=[fMRI_data], outputs=[volume_file])
+    workspace.check()
 
     # Apply warp
-    warped_output = os.path.join(fMRI_data_dir, 'Atlas_in_T1w_all.nii.gz')
-    warp_cmd = (
-        f'applywarp --ref={os.path.join(subject_dir, "T1", "T1_3mm.nii.gz")} '
-        f'--in={volume_file} '
-        f'--warp={os.path.join(subject_dir, f"{subject_name}_3T_Structural_preproc", subject_name, "MNINonLinear", "xfms", "standard2acpc_dc.nii.gz")} '
-        f'--out={warped_output}'
+    warped_output = workspace.image('Atlas_in_T1w_all')
+    run_command(
+        ['applywarp', f'--ref={t1_ref}', f'--in={volume_file}', f'--warp={warp_file}', f'--out={warped_output}'],
+        inputs=[t1_ref, volume_file, warp_file], outputs=[warped_output], env=workspace.fsl_env,
     )
-    run_command(warp_cmd)
+    workspace.check()
+
+    # Downsample the warped time series to 3mm
+    downsampled_output = workspace.image('fMRI_downsampled_3mm')
+    if downsample_with_flirt:
+        downsample_with_flirt_per_volume(warped_output, downsampled_output, workspace, num_volumes)
+    else:
+        executor.call(
+            'downsample', lambda: nib.save(resample_image_isotropic(nib.load(warped_output), voxel_size=3),
+                                           downsampled_output),
+            inputs=[warped_output], outputs=[downsampled_output],
+        )
+
+    # Only the finished result reaches the results directory, gzipped at output_compresslevel
+    executor.call('publish', workspace.publish, downsampled_output, merged_output, output_compresslevel,
+                  inputs=[downsampled_output], outputs=[merged_output])
+
+
+def registration_operator(brain_models, t1_ref, warp_file):
+    """
+    The subject's cached warp + 3mm downsample operator over the volumetric grayordinates of a run.
+
+    Returns
+    -------
+    operator, out_shape, out_affine
+        As in ``cached_sampling_operator``.
+    columns : np.ndarray
+        Grayordinate columns the operator applies to (``volume_columns``).
+    """
+    columns, flat_voxels = volume_columns(brain_models)
+    operator, out_shape, out_affine = cached_sampling_operator(
+        sampling_cache_dir, tuple(brain_models.volume_shape), brain_models.affine, voxel_sizes(brain_models.affine),
+        t1_ref, warp_file, voxel_size=3, max_bytes=sampling_cache_max_bytes, local_cache_dir=local_cache_dir,
+        in_voxels=flat_voxels,
+    )
+    return operator, out_shape, out_affine, columns
+
 
-    # Split the warped file into volumes
-    run_command(f'fslsplit {warped_output} {fMRI_data_dir}/volume_ -t')
+def stream_register(fMRI_data, t1_ref, warp_file, merged_output):
+    """Native registration of one run, ``stream_chunk_size`` time points at a time."""
+    dataobj, brain_models, series = open_dense_time_series(fMRI_data)
+    operator, out_shape, out_affine, columns = registration_operator(brain_models, t1_ref, warp_file)
+    out_shape_4d = tuple(out_shape) + (dataobj.shape[0],)
+    with telemetry.stage('stream'), NiftiStreamWriter(merged_output, out_shape_4d, out_affine, tr=series.step) as writer:
+        for _, _, chunk in iter_time_chunks(dataobj, stream_chunk_size, time_axis=0):
+            writer.write(apply_dense_sampling_operator(
+                operator, chunk, columns, out_shape,
+                chunk_size=registration_chunk_size, num_threads=registration_threads
+            ))
+
+
+def downsample_with_flirt_per_volume(warped_output, downsampled_output, workspace, num_volumes):
+    """Downsample with fslsplit -> per-volume flirt -> fslmerge (slow reference path) inside ``workspace``."""
+    # Split the warped file into volumes (fslsplit numbers them volume_0000, volume_0001, ...)
+    volumes = [workspace.image(f'volume_{t:04d}') for t in range(num_volumes)]
+    run_command(['fslsplit', warped_output, workspace.file('volume_'), '-t'],
+                inputs=[warped_output], outputs=volumes, env=workspace.fsl_env)
+    workspace.check()
 
     # Downsample each volume
-    volumes = [f for f in os.listdir(fMRI_data_dir) if f.startswith('volume_') and f.endswith('.nii.gz')]
-    for vol in volumes:
-        vol_path = os.path.join(fMRI_data_dir, vol)
-        downsampled_vol = os.path.join(fMRI_data_dir, f'downsampled_{vol}')
-        downsample_cmd = (
-            f'flirt -ref {vol_path} -in {vol_path} -o {downsampled_vol} '
-            f'-applyisoxfm 3 -interp nearestneighbour'
+    downsampled = [workspace.image(f'downsampled_volume_{t:04d}') for t in range(num_volumes)]
+    for vol_path, downsampled_vol in zip(volumes, downsampled):
+        run_command(
+            ['flirt', '-ref', vol_path, '-in', vol_path, '-o', downsampled_vol,
+             '-applyisoxfm', '3', '-interp', 'nearestneighbour'],
+            inputs=[vol_path], outputs=[downsampled_vol], env=workspace.fsl_env,
         )
-        run_command(downsample_cmd)
+    workspace.check()
+
+    # Merge in time order; the volumes are passed as arguments, so no shell or list file is needed
+    run_command(['fslmerge', '-t', downsampled_output] + downsampled,
+                inputs=downsampled, outputs=[downsampled_output], env=workspace.fsl_env)
 
-    # # Merge the downsampled volumes back into a single file
-    # downsampled_volumes = ' '.join([
-    #     os.path.join(fMRI_data_dir, f'downsampled_{vol}')
-    #     for vol in volumes
-    # ])
-    # merged_output = os.path.join(fMRI_data_dir, 'fMRI_downsampled_3mm.nii.gz')
-    # run_command(f'fslmerge -t {merged_output} {downsampled_volumes}')
-    # Generate the list of downsampled volumes
-    downsampled_file_list = os.path.join(fMRI_data_dir, 'downsampled_file_list.txt')
 
-    # Write all file paths to a text file
-    with open(downsampled_file_list, 'w') as f:
-        for vol in volumes:
-            f.write(f"{os.path.join(fMRI_data_dir, f'downsampled_{vol}')}\n")
+def validate_native_warp(subject_name, direction='LR', phase=1, interp='trilinear'):
+    """
+    Compare the in-process warp with real applywarp output on one run.
 
-    # Output file
-    merged_output = os.path.join(fMRI_data_dir, 'fMRI_downsampled_3mm.nii.gz')
+    Separates the run's volume, warps it with both applywarp and
+    ``utils.warp_utils.apply_warp``, and logs the voxelwise difference report.
+    The separated volume and the applywarp output live in a ``Workspace``
+    under ``scratch_dir``; nothing is written to the results directory.
+    """
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
+    fMRI_data = hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
+    t1_ref = hcp_paths.t1_ref_path(subject_dir)
+    warp_file = hcp_paths.warp_path(subject_dir, subject_name)
 
-    run_command(f'fslmerge -t {merged_output} $(cat {downsampled_file_list})')
+    with Workspace(scratch_dir, f'validate_{subject_name}_REST{phase}_{direction}', compress=compress_intermediates,
+                   max_bytes=scratch_max_bytes, min_free_bytes=scratch_min_free_bytes,
+                   keep_on_failure=keep_failed_workspace) as workspace:
+        volume_file = workspace.image('separated')
+        save_volume(separate_cifti(fMRI_data, surfaces=False), volume_file)
+        fsl_output = workspace.image('Atlas_in_T1w_all_applywarp')
+        fsl_interp = 'nn' if interp == 'nearest' else interp
+        run_command(['applywarp', f'--ref={t1_ref}', f'--in={volume_file}', f'--warp={warp_file}',
+                     f'--out={fsl_output}', f'--interp={fsl_interp}'],
+                    inputs=[t1_ref, volume_file, warp_file], outputs=[fsl_output], env=workspace.fsl_env)
+
+        native_img = apply_warp(
+            volume_file, t1_ref, warp_file, interp=interp,
+            chunk_size=registration_chunk_size, num_threads=registration_threads
+        )
+        report = compare_with_applywarp(native_img, fsl_output)
+    logging.info(f"Native warp vs applywarp for {subject_name} REST{phase}_{direction}: {report}")
+    return report
 
-    # Clean up intermediate files
-    for vol in volumes:
-        os.remove(os.path.join(fMRI_data_dir, vol))
-        os.remove(os.path.join(fMRI_data_dir, f'downsampled_{vol}'))
-        logging.info(f"Cleaned up intermediate file: {vol}")
 
+def process_subject(subject_name, runs=None):
+    """
+    Process the given (phase, direction) runs (default: all four) of a single subject.
 
-def process_subject(subject_name):
-    """Process a single subject."""
+    Returns
+    -------
+    subject_name : str
+    results : list of (phase, direction, outputs, error)
+        One entry per run, as recorded by ``manifest_utils.record_runs``.
+    """
     logging.info(f"Processing subject: {subject_name}")
-    subject_dir = os.path.join(hcp_dir, subject_name)
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
     if not os.path.isdir(subject_dir):
         logging.warning(f"{subject_dir} is not a valid directory. Skipping...")
-        return
+        return subject_name, []
+
+    results = []
+    for phase, direction in runs or RUNS:
+        try:
+            with telemetry.stage('registration', subject=subject_name, phase=phase, direction=direction):
+                outputs = process_fMRI(subject_name, direction, phase, subject_dir)
+            results.append((phase, direction, outputs, None))
+        except Exception as e:
+            logging.exception(f"Failed subject: {subject_name}, phase: {phase}, direction: {direction}")
+            results.append((phase, direction, None, repr(e)))
+    return subject_name, results
+
 
-    for direction in ['LR', 'RL']:
-        for phase in [1, 2]:
-            process_fMRI(subject_name, direction, phase, subject_dir)
+def process_task(task):
+    """``process_subject`` of one (subject_name, runs) task."""
+    return process_subject(*task)
 
 
 def main():
     """Main function to process all subjects in parallel."""
-    subjects = [name for name in os.listdir(hcp_dir) if os.path.isdir(os.path.join(hcp_dir, name))]
+    if config.catalog_file:
+        # Plan from the catalog: only runs whose inputs are on disk
+        catalog = DatasetCatalog(config.catalog_file)
+        catalog.refresh(config.hcp_dir)
+        # Registration needs the warp and the 3mm T1 reference besides the dense time series
+        subjects = catalog.subjects(require=['warp', 't1_ref'])
+        tasks = group_runs(catalog.runs(subjects, 'dtseries'))
+    else:
+        tasks = [(name, RUNS) for name in os.listdir(config.hcp_dir)
+                 if os.path.isdir(os.path.join(config.hcp_dir, name))]
+    manifest = RunManifest(config.manifest_file) if config.manifest_file else None
+    if manifest is not None and not config.force:
+        tasks = stale_runs(manifest, tasks, 'registration', stage_inputs, stage_params())
 
     # Use multiprocessing pool to process subjects in parallel
-    num_workers = 5
-    logging.info(f"Starting multiprocessing with {num_workers} workers...")
+    logging.info(f"Starting multiprocessing with {config.num_workers} workers on {len(tasks)} subjects...")
+
+    if dry_run:
+        # Plan every stale run in this process and print the DAG; nothing is executed or recorded
+        for task in tasks:
+            process_subject(*task)
+        print(config.command_executor(dry_run).format_plan(workers=config.num_workers))
+        return
 
-    with Pool(num_workers) as pool:
-        pool.map(process_subject, subjects)
+    telemetry.configure(config.telemetry_file)
+    start = time.time()
+    with Pool(config.num_workers) as pool:
+        # Record each subject's runs as soon as it finishes, from this process only
+        for subject_name, results in pool.imap_unordered(process_task, tasks):
+            if manifest is not None:
+                record_runs(manifest, subject_name, results, 'registration', stage_inputs, stage_params())
+    if config.telemetry_file:
+        logging.info("Telemetry summary:\n" + telemetry.report(config.telemetry_file, config.prometheus_file, since=start))
 
 
 if __name__ == "__main__":
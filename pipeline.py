@@ -0,0 +1,878 @@
+import argparse
+import json
+import logging
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import nibabel as nib
+from nibabel.affines import voxel_sizes
+from utils import hcp_paths
+from utils import parcel_utils
+from utils import telemetry_utils as telemetry
+from utils.catalog_utils import CATALOG_NAME, DatasetCatalog
+from utils.connectivity_utils import MEAN_RUN, load_run_time_series, run_connectivity, subject_connectivity, write_connectivity
+from utils.cifti_utils import (
+    load_dense_time_series, open_dense_time_series, save_volume, separate_dense_data, volume_columns,
+)
+from utils.extract_utils import (
+    gather_voxel_major, gather_voxel_time_series, in_bounds_mask, load_coordinates, voxel_major_cache,
+)
+from utils.manifest_utils import MANIFEST_NAME, UPSTREAM_STAGES, RunManifest, stage_row
+from utils.parcel_utils import average_parcels, parcel_operator
+from utils.qc_utils import QCAccumulator, load_qc, qc_failures, time_series_qc, write_qc
+from utils.queue_utils import DEFAULT_LEASE_SECONDS, TaskFailed, format_progress, open_queue, progress, run_worker
+from utils.store_utils import TimeSeriesWriter, provenance, write_time_series
+from utils.stream_utils import DEFAULT_STREAM_CHUNK_SIZE, NiftiStreamWriter, iter_time_chunks
+from utils.warp_utils import apply_dense_sampling_operator, cached_sampling_operator
+
+STAGES = ['registration', 'striatum', 'cortex', 'connectivity']
+DEFAULT_STAGES = ['registration', 'striatum', 'cortex']
+
+# 'run' processes the planned runs on this machine; 'init', 'work' and 'status'
+# fill, drain and report a task queue shared by any number of nodes
+COMMANDS = ['run', 'init', 'work', 'status']
+
+DEFAULT_CONFIG = {
+    'command': 'run',
+    'hcp_dir': None,
+    'subjects': None,
+    'workers': 5,
+    'backend': 'process',
+    'stages': DEFAULT_STAGES,
+    'output_format': 'auto',
+    'parcellations': ['aparc.a2009s', 'aparc'],
+    'fisher_z': True,
+    'qc_thresholds': {},
+    'voxel_size': 3.0,
+    'sampling_cache_dir': None,
+    'sampling_cache_max_bytes': 20 * 1024 ** 3,
+    'local_cache_dir': None,
+    'voxel_cache_dir': None,
+    'voxel_cache_max_bytes': 200 * 1024 ** 3,
+    'chunk_size': 100,
+    'threads': 1,
+    'stream_chunk_size': None,
+    'manifest': None,
+    'catalog': None,
+    'force': False,
+    'verify_outputs': False,
+    'queue': None,
+    'lease_seconds': DEFAULT_LEASE_SECONDS,
+    'telemetry': None,
+    'prometheus': None,
+}
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Pipeline configuration of the current (worker) process
+config = dict(DEFAULT_CONFIG)
+
+
+def init_worker(run_config):
+    """Pool initializer: install the pipeline configuration in the worker."""
+    config.update(run_config)
+    # Queue workers of several nodes share the file system: every node appends to its own file
+    telemetry.configure(telemetry_path(run_config), per_host=run_config['command'] == 'work')
+    if run_config['local_cache_dir']:
+        parcel_utils.operator_cache_dir = os.path.join(run_config['local_cache_dir'], 'parcel_operators')
+
+
+def telemetry_path(run_config):
+    """Telemetry JSON-lines file of a run configuration (default: <hcp-dir>/.telemetry/telemetry.jsonl)."""
+    return run_config['telemetry'] or os.path.join(run_config['hcp_dir'], '.telemetry', 'telemetry.jsonl')
+
+
+def registration_operator(subject_name, subject_dir, brain_models):
+    """
+    The subject's cached warp + downsample operator over the volumetric grayordinates of a run.
+
+    Returns
+    -------
+    operator, out_shape, out_affine
+        As in ``cached_sampling_operator``.
+    columns : np.ndarray
+        Grayordinate columns the operator applies to (``volume_columns``).
+    """
+    cache_dir = config['sampling_cache_dir'] or os.path.join(config['hcp_dir'], '.sampling_cache')
+    local_cache_dir = config['local_cache_dir'] and os.path.join(config['local_cache_dir'], 'sampling_operators')
+    columns, flat_voxels = volume_columns(brain_models)
+    operator, out_shape, out_affine = cached_sampling_operator(
+        cache_dir, tuple(brain_models.volume_shape), brain_models.affine, voxel_sizes(brain_models.affine),
+        hcp_paths.t1_ref_path(subject_dir), hcp_paths.warp_path(subject_dir, subject_name),
+        voxel_size=config['voxel_size'], max_bytes=config['sampling_cache_max_bytes'],
+        local_cache_dir=local_cache_dir, in_voxels=flat_voxels,
+    )
+    return operator, out_shape, out_affine, columns
+
+
+def register_run(subject_name, subject_dir, data, brain_models, tr):
+    """
+    Warp and downsample the run's subcortical grayordinates with the subject's cached operator.
+
+    ``data`` is the dense time series, in memory or as the lazy proxy of
+    ``open_dense_time_series``; it is read in ``config['chunk_size']`` time
+    points, and the 4D subcortical volume is never built.
+    """
+    operator, out_shape, out_affine, columns = registration_operator(subject_name, subject_dir, brain_models)
+    registered = apply_dense_sampling_operator(
+        operator, data, columns, out_shape, chunk_size=config['chunk_size'], num_threads=config['threads']
+    )
+    return {'volume': registered, 'affine': out_affine, 'tr': tr}
+
+
+def striatum_coordinates(subject_dir):
+    """Coordinates files and seed voxels of the hemispheres that have them."""
+    coor_paths = {h: hcp_paths.coords_path(subject_dir, h) for h in hcp_paths.HEMISPHERES}
+    coor_paths = {h: path for h, path in coor_paths.items() if os.path.exists(path)}
+    if not coor_paths:
+        raise FileNotFoundError(f"No coordinates files in {subject_dir}")
+    return coor_paths, {h: load_coordinates(path) for h, path in coor_paths.items()}
+
+
+def gather_registered(downsampled, coords_by_hemisphere):
+    """
+    Gather seed voxels from a stored registered volume, through the voxel-major cache if configured.
+
+    With ``config['voxel_cache_dir']`` the run's subcortical bounding box is
+    cached once, uncompressed and voxel-major, so re-extracting with new
+    coordinates reads contiguous rows instead of decompressing the run.
+    """
+    if config['voxel_cache_dir']:
+        with telemetry.stage('voxel_cache'):
+            cached = voxel_major_cache(
+                config['voxel_cache_dir'], downsampled, max_bytes=config['voxel_cache_max_bytes']
+            )
+        if cached is not None:
+            return gather_voxel_major(cached, coords_by_hemisphere)
+    return gather_voxel_time_series(nib.load(downsampled).dataobj, coords_by_hemisphere)
+
+
+def extract_striatum(subject_dir, registered, run_dir, source, arrays=None):
+    """
+    Gather both hemispheres' seed voxels from the registered volume and store them; returns the output paths.
+
+    ``registered`` is the in-memory volume, or None to read the stored
+    registered volume ``source`` (see ``gather_registered``). If given,
+    ``arrays`` receives hemisphere -> (time_series, coords, in_bounds) for
+    the connectivity stage. QC metrics of the gathered voxels go to the run's
+    QC table.
+    """
+    coor_paths, coords_by_hemisphere = striatum_coordinates(subject_dir)
+    if registered is None:
+        gathered = gather_registered(source, coords_by_hemisphere)
+    else:
+        gathered = gather_voxel_time_series(registered, coords_by_hemisphere)
+    write_qc(run_dir, {f'striatum_{h}': time_series_qc(ts, in_bounds) for h, (ts, in_bounds) in gathered.items()})
+    outputs = []
+    for hemisphere, (time_series, in_bounds) in gathered.items():
+        if arrays is not None:
+            arrays[hemisphere] = (time_series, coords_by_hemisphere[hemisphere], in_bounds)
+        outputs.append(write_time_series(
+            run_dir, f'striatum_{hemisphere}', time_series, coords=coords_by_hemisphere[hemisphere],
+            meta={'in_bounds': in_bounds.tolist(), 'provenance': provenance(source=source, coords=coor_paths[hemisphere])},
+            backend=config['output_format'],
+        ))
+    return outputs
+
+
+def cortex_label_files(subject_name, subject_dir, hemisphere):
+    """Existing label files of the configured parcellations for one hemisphere."""
+    label_gii_paths = {
+        parcellation: hcp_paths.label_gii_path(subject_dir, subject_name, hemisphere, parcellation)
+        for parcellation in config['parcellations']
+    }
+    label_gii_paths = {name: path for name, path in label_gii_paths.items() if os.path.exists(path)}
+    if not label_gii_paths:
+        raise FileNotFoundError(f"No {hemisphere} label files for {subject_name}")
+    return label_gii_paths
+
+
+def extract_cortex(subject_name, subject_dir, separated, run_dir, source, arrays=None):
+    """
+    Average every configured parcellation of both hemispheres and store them; returns the output paths.
+
+    If given, ``arrays`` receives parcellation -> hemisphere -> ParcelTimeSeries for the connectivity stage.
+    QC metrics of the parcel averages go to the run's QC table.
+    """
+    outputs = []
+    qc = {}
+    for hemisphere, surface in [('L', separated['cortex_left']), ('R', separated['cortex_right'])]:
+        label_gii_paths = cortex_label_files(subject_name, subject_dir, hemisphere)
+        for name, partition_ts in average_parcels(surface, label_gii_paths).items():
+            if arrays is not None:
+                arrays.setdefault(name, {})[hemisphere] = partition_ts
+            qc[f'cortex_{hemisphere}_{name}'] = time_series_qc(partition_ts.data)
+            outputs.append(write_time_series(
+                run_dir, f'cortex_{hemisphere}_{name}', partition_ts.data,
+                label_ids=partition_ts.label_ids, label_names=partition_ts.label_names,
+                meta={'provenance': provenance(source=source, labels=label_gii_paths[name])},
+                backend=config['output_format'],
+            ))
+    write_qc(run_dir, qc)
+    return outputs
+
+
+def extract_connectivity(run_dir, striatum=None, cortex=None):
+    """
+    Striatum x cortex correlation matrices of one run; returns the output paths.
+
+    ``striatum`` and ``cortex`` are the in-memory arrays collected by
+    ``extract_striatum`` and ``extract_cortex``; whichever is missing (the
+    stage was up to date or streamed) is read back from the output store.
+    """
+    if striatum is None or cortex is None:
+        stored_striatum, stored_cortex = load_run_time_series(run_dir, hcp_paths.HEMISPHERES, config['parcellations'])
+        if striatum is None:
+            striatum = {h: (data, meta.get('coords'), meta.get('in_bounds')) for h, (data, meta) in stored_striatum.items()}
+        if cortex is None:
+            cortex = stored_cortex
+    matrices = run_connectivity({h: data for h, (data, _, _) in striatum.items()}, cortex, config['fisher_z'])
+    return write_connectivity(
+        run_dir, matrices,
+        coords_by_hemisphere={h: coords for h, (_, coords, _) in striatum.items()},
+        in_bounds_by_hemisphere={h: in_bounds for h, (_, _, in_bounds) in striatum.items() if in_bounds is not None},
+        meta={'fisher_z': config['fisher_z'], 'provenance': provenance(source=run_dir)},
+        backend=config['output_format'],
+    )
+
+
+def stage_inputs(subject_name, phase, direction, stage, run_config):
+    """Files a stage reads; their fingerprints decide whether recorded work is stale."""
+    subject_dir = os.path.join(run_config['hcp_dir'], subject_name)
+    registration_inputs = [
+        hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction),
+        hcp_paths.t1_ref_path(subject_dir),
+        hcp_paths.warp_path(subject_dir, subject_name),
+    ]
+    if stage == 'registration':
+        return registration_inputs
+    if stage == 'striatum':
+        return registration_inputs + [hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)] + [
+            hcp_paths.coords_path(subject_dir, h) for h in hcp_paths.HEMISPHERES
+        ]
+    if stage == 'connectivity':
+        return sorted(set(stage_inputs(subject_name, phase, direction, 'striatum', run_config)
+                          + stage_inputs(subject_name, phase, direction, 'cortex', run_config)))
+    return [hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)] + [
+        hcp_paths.label_gii_path(subject_dir, subject_name, h, parcellation)
+        for h in hcp_paths.HEMISPHERES for parcellation in run_config['parcellations']
+    ]
+
+
+def stage_params(stage, run_config):
+    """Parameters that change a stage's outputs."""
+    if stage == 'registration':
+        return {'voxel_size': run_config['voxel_size']}
+    if stage == 'striatum':
+        return {'voxel_size': run_config['voxel_size'], 'output_format': run_config['output_format']}
+    if stage == 'connectivity':
+        return {'voxel_size': run_config['voxel_size'], 'parcellations': run_config['parcellations'],
+                'fisher_z': run_config['fisher_z'], 'qc_thresholds': run_config['qc_thresholds'],
+                'output_format': run_config['output_format']}
+    return {'parcellations': run_config['parcellations'], 'output_format': run_config['output_format']}
+
+
+def run_stage(outcomes, stage, func, *args):
+    """Run one stage, recording its outputs or its error in ``outcomes`` and its resource usage in telemetry."""
+    try:
+        with telemetry.stage(stage):
+            outcomes[stage] = {'status': 'done', 'outputs': func(*args)}
+    except Exception as e:
+        logging.exception(f"Stage {stage} failed")
+        outcomes[stage] = {'status': 'failed', 'error': repr(e)}
+
+
+def process_run(task):
+    """
+    Run the given stages on one (subject, phase, direction).
+
+    The dense time series is read once and fanned out in memory to the
+    registration, the striatum gather and the cortical parcel averaging.
+
+    Returns
+    -------
+    (task, outcomes)
+        outcomes maps each stage to {'status': 'done', 'outputs': [...]} or
+        {'status': 'failed', 'error': ...}.
+    """
+    subject_name, phase, direction, stages = task
+    with telemetry.tagged(subject=subject_name, phase=phase, direction=direction):
+        # Connectivity alone reads the stored time series, and striatum re-extraction through
+        # the voxel-major cache reads contiguous rows of a memmap; neither needs streaming
+        cached_striatum = config['voxel_cache_dir'] and not set(stages) & {'registration', 'cortex'}
+        if config['stream_chunk_size'] and set(stages) - {'connectivity'} and not cached_striatum:
+            return task, stream_stages(subject_name, phase, direction, stages)
+        return task, run_stages(subject_name, phase, direction, stages)
+
+
+def run_stages(subject_name, phase, direction, stages):
+    """Body of ``process_run``; returns the outcomes of the stages."""
+    subject_dir = os.path.join(config['hcp_dir'], subject_name)
+    dtseries = hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
+    downsampled = hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)
+    run_dir = hcp_paths.output_dir(subject_dir, phase, direction)
+    logging.info(f"Processing subject: {subject_name}, phase: {phase}, direction: {direction}, stages: {stages}")
+    outcomes = {}
+
+    # Striatum alone re-uses an existing registered volume instead of registering again
+    reuse_registered = 'registration' not in stages and os.path.exists(downsampled)
+    need_volume = 'registration' in stages or ('striatum' in stages and not reuse_registered)
+    need_surfaces = 'cortex' in stages
+
+    separated = data = None
+    if need_volume or need_surfaces:
+        if not os.path.exists(dtseries):
+            logging.warning(f"Missing fMRI data: {dtseries}")
+            return {stage: {'status': 'failed', 'error': f'missing {dtseries}'} for stage in stages}
+        with telemetry.stage('load_cifti'):
+            if need_surfaces:
+                data, brain_models, series = load_dense_time_series(dtseries)
+                separated = separate_dense_data(data, brain_models, tr=series.step, volume=False)
+            else:
+                # The registration alone reads the volumetric columns chunk by chunk
+                data, brain_models, series = open_dense_time_series(dtseries)
+
+    registered = {}
+    if need_volume:
+        def register():
+            registered.update(register_run(subject_name, subject_dir, data, brain_models, series.step))
+            if 'registration' in stages:
+                with telemetry.stage('write_volume'):
+                    save_volume(registered, downsampled)
+                return [downsampled]
+            return []
+        run_stage(outcomes, 'registration', register)
+        if 'registration' not in stages:
+            outcomes.pop('registration', None)
+    data = None
+
+    # Time series kept in memory for the connectivity stage
+    striatum = {} if 'connectivity' in stages and 'striatum' in stages else None
+    cortex = {} if 'connectivity' in stages and need_surfaces else None
+
+    if 'striatum' in stages:
+        if registered:
+            run_stage(outcomes, 'striatum', extract_striatum, subject_dir, registered['volume'], run_dir, dtseries,
+                      striatum)
+        elif reuse_registered:
+            run_stage(outcomes, 'striatum', extract_striatum, subject_dir, None, run_dir, downsampled, striatum)
+        else:
+            outcomes['striatum'] = {'status': 'failed', 'error': 'registration failed'}
+
+    if need_surfaces:
+        run_stage(outcomes, 'cortex', extract_cortex, subject_name, subject_dir, separated, run_dir, dtseries, cortex)
+
+    if 'connectivity' in stages:
+        run_connectivity_stage(outcomes, run_dir, striatum, cortex)
+    return outcomes
+
+
+def run_connectivity_stage(outcomes, run_dir, striatum=None, cortex=None):
+    """
+    Run the connectivity stage unless the striatum or cortex stage of the same
+    run failed or the run fails the configured QC thresholds.
+    """
+    failed = [stage for stage in ('striatum', 'cortex') if outcomes.get(stage, {}).get('status') == 'failed']
+    if failed:
+        outcomes['connectivity'] = {'status': 'failed', 'error': f"{' and '.join(failed)} failed"}
+        return
+    qc_failed = qc_failures(load_qc(run_dir), config['qc_thresholds'])
+    if qc_failed:
+        logging.warning(f"Skipping connectivity of {run_dir}, which fails QC: {qc_failed}")
+        outcomes['connectivity'] = {'status': 'failed', 'error': f"QC failed: {qc_failed}"}
+        return
+    run_stage(outcomes, 'connectivity', extract_connectivity, run_dir, striatum, cortex)
+
+
+def stream_stages(subject_name, phase, direction, stages):
+    """
+    Streaming variant of ``run_stages``.
+
+    The run is read, separated, registered, gathered and parcel-averaged in
+    chunks of ``config['stream_chunk_size']`` time points, and each chunk is
+    written straight into preallocated outputs, so peak memory per worker
+    depends on the chunk size instead of the run length. The outputs are
+    identical to those of the in-memory path. A failing stage discards its
+    partial outputs while the other stages carry on.
+    """
+    subject_dir = os.path.join(config['hcp_dir'], subject_name)
+    dtseries = hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)
+    downsampled = hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)
+    run_dir = hcp_paths.output_dir(subject_dir, phase, direction)
+    logging.info(f"Streaming subject: {subject_name}, phase: {phase}, direction: {direction}, stages: {stages}, "
+                 f"chunk size: {config['stream_chunk_size']}")
+    outcomes = {}
+
+    reuse_registered = 'registration' not in stages and os.path.exists(downsampled)
+    need_volume = 'registration' in stages or ('striatum' in stages and not reuse_registered)
+    need_surfaces = 'cortex' in stages
+
+    if need_volume or need_surfaces:
+        if not os.path.exists(dtseries):
+            logging.warning(f"Missing fMRI data: {dtseries}")
+            return {stage: {'status': 'failed', 'error': f'missing {dtseries}'} for stage in stages}
+        dataobj, brain_models, series = open_dense_time_series(dtseries)
+        chunks = iter_time_chunks(dataobj, config['stream_chunk_size'], time_axis=0)
+        num_timepoints = dataobj.shape[0]
+    if not need_volume and 'striatum' in stages:
+        registered_img = nib.load(downsampled, keep_file_open=True)
+        if not need_surfaces:
+            chunks = iter_time_chunks(registered_img.dataobj, config['stream_chunk_size'])
+            num_timepoints = registered_img.shape[3]
+
+    # Open writers of the stages still running; a stage leaves this dict when it fails
+    writers = {}
+    # QC accumulators per stage and region, fed with the same chunks as the writers
+    qc = {'striatum': {}, 'cortex': {}}
+
+    def drop(stage, error):
+        for writer in writers.pop(stage, {}).values():
+            writer.abort()
+        outcomes[stage] = {'status': 'failed', 'error': error}
+        # The striatum gathers from the volume registered on the fly
+        if stage == 'registration' and need_volume and 'striatum' in writers:
+            drop('striatum', 'registration failed')
+        if stage == 'striatum' and 'registration' not in stages:
+            writers.pop('registration', None)
+
+    def guarded(stage, func, *args):
+        if stage not in writers:
+            return None
+        try:
+            return func(*args)
+        except Exception as e:
+            logging.exception(f"Stage {stage} failed")
+            drop(stage, repr(e))
+            return None
+
+    def setup_registration():
+        operator, out_shape, out_affine, columns = registration_operator(subject_name, subject_dir, brain_models)
+        if 'registration' in stages:
+            writers['registration']['volume'] = NiftiStreamWriter(
+                downsampled, tuple(out_shape) + (num_timepoints,), out_affine, tr=series.step
+            )
+        return operator, out_shape, columns
+
+    def setup_striatum():
+        coor_paths, coords_by_hemisphere = striatum_coordinates(subject_dir)
+        grid_shape = registration[1] if need_volume else registered_img.shape[:3]
+        source = dtseries if need_volume else downsampled
+        for hemisphere, coords in coords_by_hemisphere.items():
+            in_bounds = in_bounds_mask(coords, grid_shape)
+            writers['striatum'][hemisphere] = TimeSeriesWriter(
+                run_dir, f'striatum_{hemisphere}', (len(coords), num_timepoints), coords=coords,
+                meta={'in_bounds': in_bounds.tolist(),
+                      'provenance': provenance(source=source, coords=coor_paths[hemisphere])},
+                backend=config['output_format'],
+            )
+            qc['striatum'][f'striatum_{hemisphere}'] = QCAccumulator(len(coords), in_bounds)
+        return coords_by_hemisphere
+
+    def setup_cortex():
+        label_files = {h: cortex_label_files(subject_name, subject_dir, h) for h in hcp_paths.HEMISPHERES}
+        for hemisphere, label_gii_paths in label_files.items():
+            for name, path in label_gii_paths.items():
+                label_ids, label_names, _ = parcel_operator(path)
+                writers['cortex'][(hemisphere, name)] = TimeSeriesWriter(
+                    run_dir, f'cortex_{hemisphere}_{name}', (len(label_ids), num_timepoints),
+                    label_ids=label_ids, label_names=label_names,
+                    meta={'provenance': provenance(source=dtseries, labels=path)},
+                    backend=config['output_format'],
+                )
+                qc['cortex'][f'cortex_{hemisphere}_{name}'] = QCAccumulator(len(label_ids))
+        return label_files
+
+    def register_chunk(chunk):
+        operator, out_shape, columns = registration
+        registered = apply_dense_sampling_operator(
+            operator, chunk, columns, out_shape, chunk_size=config['chunk_size'], num_threads=config['threads']
+        )
+        for writer in writers['registration'].values():
+            writer.write(registered)
+        return registered
+
+    def gather_chunk(start, registered):
+        for hemisphere, (time_series, _) in gather_voxel_time_series(registered, striatum).items():
+            writers['striatum'][hemisphere].write(start, time_series)
+            qc['striatum'][f'striatum_{hemisphere}'].update(time_series)
+
+    def average_chunk(start, separated):
+        for hemisphere, key in [('L', 'cortex_left'), ('R', 'cortex_right')]:
+            for name, partition_ts in average_parcels(separated[key], cortex[hemisphere]).items():
+                writers['cortex'][(hemisphere, name)].write(start, partition_ts.data)
+                qc['cortex'][f'cortex_{hemisphere}_{name}'].update(partition_ts.data)
+
+    registration = striatum = cortex = None
+    if need_volume:
+        writers['registration'] = {}
+        registration = guarded('registration', setup_registration)
+    if 'striatum' in stages:
+        if need_volume and 'registration' not in writers:
+            outcomes['striatum'] = {'status': 'failed', 'error': 'registration failed'}
+        else:
+            writers['striatum'] = {}
+            striatum = guarded('striatum', setup_striatum)
+    if need_surfaces:
+        writers['cortex'] = {}
+        cortex = guarded('cortex', setup_cortex)
+
+    try:
+        with telemetry.stage('stream'):
+            for start, stop, chunk in chunks:
+                if not writers:
+                    break
+                separated = registered = None
+                if need_volume or need_surfaces:
+                    separated = separate_dense_data(
+                        chunk, brain_models, tr=series.step, surfaces='cortex' in writers, volume=False
+                    )
+                if need_volume:
+                    registered = guarded('registration', register_chunk, chunk)
+                elif 'striatum' in writers:
+                    registered = chunk if separated is None else registered_img.dataobj[..., start:stop]
+                if registered is not None:
+                    guarded('striatum', gather_chunk, start, registered)
+                guarded('cortex', average_chunk, start, separated)
+    except Exception as e:
+        # Reading the input failed: nothing of this run can be completed
+        logging.exception(f"Streaming failed for {subject_name} REST{phase}_{direction}")
+        for stage in list(writers):
+            drop(stage, repr(e))
+
+    def finish(stage):
+        outputs = [writer.close() for writer in writers[stage].values()]
+        if qc.get(stage):
+            write_qc(run_dir, {region: accumulator.result() for region, accumulator in qc[stage].items()})
+        return outputs
+
+    for stage in list(writers):
+        outputs = guarded(stage, finish, stage)
+        if stage in writers:
+            outcomes[stage] = {'status': 'done', 'outputs': outputs}
+    if 'registration' not in stages:
+        outcomes.pop('registration', None)
+    if 'connectivity' in stages:
+        # Computed from the complete time series just written
+        run_connectivity_stage(outcomes, run_dir)
+    return outcomes
+
+
+def list_tasks(hcp_dir, subjects=None, catalog=None, stages=STAGES):
+    """
+    All (subject, phase, direction) runs for the given or discovered subjects.
+
+    With a ``DatasetCatalog`` only runs whose input is on disk are listed: the
+    dense time series, or for the striatum and connectivity stages alone a
+    registered volume.
+    """
+    if catalog is None:
+        if subjects is None:
+            subjects = sorted(name for name in os.listdir(hcp_dir) if os.path.isdir(os.path.join(hcp_dir, name)))
+        return [(subject, phase, direction) for subject in subjects for phase, direction in hcp_paths.RUNS]
+    runs = set(catalog.runs(subjects, 'dtseries'))
+    if set(stages) <= {'striatum', 'connectivity'}:
+        runs.update(catalog.runs(subjects, 'downsampled'))
+    return sorted(runs, key=lambda run: (run[0], hcp_paths.RUNS.index(run[1:])))
+
+
+def plan_tasks(run_config, runs, manifest=None):
+    """
+    Attach the stages that still need to run to every (subject, phase, direction).
+
+    Stages recorded as done with unchanged inputs, parameters and outputs are
+    skipped; a stale upstream stage (see ``manifest_utils.UPSTREAM_STAGES``)
+    makes its downstream stages stale, e.g. a stale registration the striatum
+    stage.
+    """
+    tasks = []
+    for subject_name, phase, direction in runs:
+        run = f'phase{phase}_{direction}'
+        stale = []
+        for stage in STAGES:
+            if stage not in run_config['stages']:
+                continue
+            up_to_date = manifest is not None and manifest.is_up_to_date(
+                subject_name, run, stage,
+                stage_inputs(subject_name, phase, direction, stage, run_config), stage_params(stage, run_config)
+            )
+            if not up_to_date or any(upstream in stale for upstream in UPSTREAM_STAGES.get(stage, [])):
+                stale.append(stage)
+        if stale:
+            tasks.append((subject_name, phase, direction, stale))
+    logging.info(f"{len(tasks)} of {len(runs)} runs have stale stages")
+    return tasks
+
+
+def run_tasks(run_config, tasks, manifest=None):
+    """
+    Process tasks at run granularity on a pool of ``run_config['workers']`` workers.
+
+    With ``backend='thread'`` the workers are threads of this process: the
+    sparse products, gzip and most NumPy work release the GIL, and per-subject
+    operators and parcel operators are held once instead of once per process.
+
+    Returns
+    -------
+    list of (task, outcomes)
+    """
+    num_workers = run_config['workers']
+    logging.info(f"Starting {run_config['backend']} pool with {num_workers} workers on {len(tasks)} runs...")
+
+    results = []
+
+    def record(task, outcomes):
+        results.append((task, outcomes))
+        record_outcomes(run_config, manifest, task, outcomes)
+
+    if num_workers <= 1:
+        init_worker(run_config)
+        for task in tasks:
+            record(*process_run(task))
+        return results
+    pool_class = ThreadPool if run_config['backend'] == 'thread' else Pool
+    with pool_class(num_workers, initializer=init_worker, initargs=(run_config,)) as pool:
+        for task, outcomes in pool.imap_unordered(process_run, tasks):
+            record(task, outcomes)
+    return results
+
+
+def outcome_rows(run_config, task, outcomes):
+    """Manifest rows (``stage_row``) of the stage outcomes of a processed task."""
+    subject_name, phase, direction, _ = task
+    return [
+        stage_row(subject_name, f'phase{phase}_{direction}', stage, outcome['status'],
+                  stage_inputs(subject_name, phase, direction, stage, run_config), stage_params(stage, run_config),
+                  outputs=outcome.get('outputs', ()), error=outcome.get('error'))
+        for stage, outcome in outcomes.items()
+    ]
+
+
+def record_outcomes(run_config, manifest, task, outcomes):
+    """Record the outcome of every stage of a processed task in the manifest (if any)."""
+    if manifest is not None:
+        manifest.write(outcome_rows(run_config, task, outcomes))
+
+
+def manifest_path(run_config):
+    """Run manifest of a run configuration (default: <hcp-dir>/.pipeline_manifest.sqlite)."""
+    return run_config['manifest'] or os.path.join(run_config['hcp_dir'], MANIFEST_NAME)
+
+
+def queue_tasks(run_config, tasks):
+    """
+    Enqueue planned tasks, one per (subject, phase, direction) with its stale stages.
+
+    Returns
+    -------
+    int
+        Number of tasks queued (tasks still pending or leased are kept as they are).
+    """
+    queue = open_queue(run_config['queue'], lease_seconds=run_config['lease_seconds'])
+    queued = queue.put([
+        {'id': f'{subject_name}_phase{phase}_{direction}', 'subject': subject_name, 'phase': phase,
+         'direction': direction, 'stages': stages}
+        for subject_name, phase, direction, stages in tasks
+    ])
+    logging.info(f"Queued {queued} of {len(tasks)} planned runs in {run_config['queue']}")
+    return queued
+
+
+def queue_worker(_):
+    """
+    Pool worker of the 'work' command: process queued runs until the queue is finished.
+
+    Workers never write the manifest, which is a SQLite file on the shared
+    file system: each run's stage outcomes are fingerprinted when it finishes
+    and stored with the task in the queue ('manifest' rows of its result),
+    and ``fold_queue`` records them on 'init' and 'status'. A run with a
+    failed stage is marked failed in the queue.
+
+    Returns
+    -------
+    list of (task, outcomes)
+    """
+    queue = open_queue(config['queue'], lease_seconds=config['lease_seconds'])
+    results = []
+
+    def handle(payload):
+        task = (payload['subject'], payload['phase'], payload['direction'], payload['stages'])
+        task, outcomes = process_run(task)
+        results.append((task, outcomes))
+        result = {'manifest': outcome_rows(config, task, outcomes)}
+        failed = {stage: outcome['error'] for stage, outcome in outcomes.items() if outcome['status'] == 'failed'}
+        if failed:
+            raise TaskFailed(f"Failed stages: {failed}", result)
+        return result
+
+    run_worker(queue, handle)
+    return results
+
+
+def fold_queue(run_config, manifest):
+    """
+    Record the stage outcomes carried by the queue's finished tasks in the manifest.
+
+    Rows older than the stored ones are ignored (``RunManifest.write``), so
+    folding a queue again is harmless.
+
+    Returns
+    -------
+    int
+        Number of manifest rows updated.
+    """
+    queue = open_queue(run_config['queue'], lease_seconds=run_config['lease_seconds'])
+    rows = [row for record in queue.records() if record['status'] in ('done', 'failed') and record['result']
+            for row in record['result'].get('manifest', [])]
+    updated = manifest.write(rows)
+    logging.info(f"Recorded {updated} stage outcomes from {run_config['queue']} in {manifest.path}")
+    return updated
+
+
+def work_queue(run_config):
+    """
+    Drain the shared queue with ``run_config['workers']`` processes on this node.
+
+    Start this on every node (and as often as wanted on one machine); each
+    worker pulls the next run as soon as it is free. Returns once the whole
+    queue is finished, so the per-subject connectivity averages are computed
+    after every run of the cohort.
+
+    Returns
+    -------
+    list of (task, outcomes)
+    """
+    num_workers = max(run_config['workers'], 1)
+    logging.info(f"Starting {num_workers} {run_config['backend']} queue workers on {run_config['queue']}")
+    if num_workers == 1:
+        init_worker(run_config)
+        return queue_worker(0)
+    pool_class = ThreadPool if run_config['backend'] == 'thread' else Pool
+    with pool_class(num_workers, initializer=init_worker, initargs=(run_config,)) as pool:
+        return [result for results in pool.map(queue_worker, range(num_workers)) for result in results]
+
+
+def average_connectivity(run_config, results):
+    """
+    Average the connectivity matrices over the runs of every subject with a new run matrix.
+
+    The averages go to '<subject>/fMRI/all_runs' and include the matrices of
+    runs that were already up to date.
+    """
+    subjects = sorted({task[0] for task, outcomes in results
+                       if outcomes.get('connectivity', {}).get('status') == 'done'})
+    for subject_name in subjects:
+        try:
+            outputs = subject_connectivity(
+                os.path.join(run_config['hcp_dir'], subject_name), run_config['parcellations'],
+                fisher=run_config['fisher_z'], backend=run_config['output_format'], recompute=False,
+                qc_thresholds=run_config['qc_thresholds'],
+            )
+            logging.info(f"Averaged connectivity of {subject_name} over runs: {len(outputs)} matrices in {MEAN_RUN}")
+        except Exception:
+            logging.exception(f"Averaging connectivity failed for subject: {subject_name}")
+
+
+def parse_config(argv=None):
+    """Build the pipeline configuration from defaults, an optional JSON config file and the CLI."""
+    parser = argparse.ArgumentParser(description="HCP rfMRI registration, striatum and cortex extraction")
+    parser.add_argument('command', nargs='?', choices=COMMANDS,
+                        help="run (default): process the planned runs here; init: queue them in --queue; "
+                             "work: process queued runs until the queue is finished; status: queue progress and ETA")
+    parser.add_argument('--config', help="JSON file with any of the options below (CLI flags take precedence)")
+    parser.add_argument('--hcp-dir', help="HCP root directory with one sub-directory per subject")
+    parser.add_argument('--subjects', nargs='+', help="Subject IDs (default: every directory in --hcp-dir)")
+    parser.add_argument('--subjects-file', help="File with one subject ID per line")
+    parser.add_argument('--workers', type=int, help="Workers (processes or threads, see --backend)")
+    parser.add_argument('--backend', choices=['process', 'thread'], help="Worker pool type (default: process)")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, help="Stages to run")
+    parser.add_argument('--output-format', choices=['auto', 'hdf5', 'npy', 'csv'], help="Output backend")
+    parser.add_argument('--parcellations', nargs='+', help="FreeSurfer parcellations to average")
+    parser.add_argument('--no-fisher-z', dest='fisher_z', action='store_false', default=None,
+                        help="Store raw correlations instead of Fisher z in the connectivity stage")
+    parser.add_argument('--qc-thresholds', nargs='+', metavar='KEY=VALUE',
+                        help="Skip the connectivity stage of runs failing these QC limits, e.g. "
+                             "min_tsnr_median=20 max_out_of_bounds_fraction=0.1")
+    parser.add_argument('--sampling-cache-dir', help="Directory of cached sampling operators")
+    parser.add_argument('--local-cache-dir', help="Node-local scratch where sampling and parcel operators are "
+                                                  "published once and memory-mapped by all workers")
+    parser.add_argument('--voxel-cache-dir', help="Voxel-major cache of the registered volumes' subcortical bounding "
+                                                  "boxes, used when the striatum stage re-reads a stored volume")
+    parser.add_argument('--voxel-cache-max-bytes', type=int, help="Size limit of --voxel-cache-dir (LRU eviction)")
+    parser.add_argument('--chunk-size', type=int, help="Time points per registration chunk")
+    parser.add_argument('--threads', type=int, help="Threads per worker for registration")
+    parser.add_argument('--stream-chunk-size', type=int, nargs='?', const=DEFAULT_STREAM_CHUNK_SIZE,
+                        help="Process each run in chunks of this many time points to bound memory "
+                             f"(default when given without a value: {DEFAULT_STREAM_CHUNK_SIZE})")
+    parser.add_argument('--manifest', help="Run manifest (default: <hcp-dir>/.pipeline_manifest.sqlite)")
+    parser.add_argument('--catalog', help="Dataset catalog (default: <hcp-dir>/.dataset_catalog.sqlite)")
+    parser.add_argument('--force', action='store_true', default=None, help="Ignore the manifest and redo every stage")
+    parser.add_argument('--verify-outputs', action='store_true', default=None,
+                        help="Compare the recorded output checksums, not only size and mtime, before skipping a stage")
+    parser.add_argument('--queue', help="Shared task queue: a directory (any number of nodes) or a .sqlite file "
+                                        "(one machine)")
+    parser.add_argument('--lease-seconds', type=float, help="Seconds without heartbeat before a claimed run is "
+                                                            f"re-queued (default: {DEFAULT_LEASE_SECONDS})")
+    parser.add_argument('--telemetry', help="Telemetry JSON lines (default: <hcp-dir>/.telemetry/telemetry.jsonl)")
+    parser.add_argument('--prometheus', help="Write the batch summary as a Prometheus textfile")
+    args = parser.parse_args(argv)
+
+    run_config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config) as f:
+            run_config.update(json.load(f))
+    for key, value in vars(args).items():
+        if key not in ('config', 'subjects_file', 'qc_thresholds') and value is not None:
+            run_config[key] = value
+    if args.qc_thresholds:
+        run_config['qc_thresholds'] = {
+            key: float(value) for key, value in (item.split('=', 1) for item in args.qc_thresholds)
+        }
+    if args.subjects_file:
+        with open(args.subjects_file) as f:
+            run_config['subjects'] = [line.strip() for line in f if line.strip()]
+    if not run_config['hcp_dir']:
+        parser.error("--hcp-dir is required (on the command line or in --config)")
+    if run_config['command'] != 'run' and not run_config['queue']:
+        parser.error(f"The {run_config['command']} command needs --queue")
+    return run_config
+
+
+def main(argv=None):
+    """Main function to process all runs of all subjects in parallel, here or through a shared queue."""
+    run_config = parse_config(argv)
+    if run_config['command'] == 'status':
+        fold_queue(run_config, RunManifest(manifest_path(run_config), verify_outputs=run_config['verify_outputs']))
+        queue = open_queue(run_config['queue'], lease_seconds=run_config['lease_seconds'])
+        print(format_progress(progress(queue.records())))
+        return
+    # Queue workers leave the shared manifest to 'init' and 'status'
+    manifest = None if run_config['command'] == 'work' else RunManifest(
+        manifest_path(run_config), verify_outputs=run_config['verify_outputs']
+    )
+    start = time.time()
+    if run_config['command'] == 'work':
+        results = work_queue(run_config)
+    else:
+        if run_config['command'] == 'init' and os.path.exists(run_config['queue']):
+            # Outcomes of an earlier round of the queue decide what is still stale
+            fold_queue(run_config, manifest)
+        catalog = DatasetCatalog(run_config['catalog'] or os.path.join(run_config['hcp_dir'], CATALOG_NAME))
+        catalog.refresh(run_config['hcp_dir'], run_config['subjects'])
+        runs = list_tasks(run_config['hcp_dir'], run_config['subjects'], catalog, run_config['stages'])
+        tasks = plan_tasks(run_config, runs, None if run_config['force'] else manifest)
+        if run_config['command'] == 'init':
+            queue_tasks(run_config, tasks)
+            return
+        results = run_tasks(run_config, tasks, manifest)
+    # In 'work' mode the stages come from the queued tasks, so look at what actually ran
+    average_connectivity(run_config, results)
+    if manifest is not None:
+        logging.info(f"Manifest summary: {manifest.summary()}")
+    summary = telemetry.report(telemetry_path(run_config), run_config['prometheus'], since=start)
+    logging.info(f"Telemetry summary:\n{summary}")
+
+
+if __name__ == "__main__":
+    main()
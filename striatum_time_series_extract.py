@@ -1,82 +1,199 @@
 import os
+import logging
+import time
 import numpy as np
 import nibabel as nib
+from multiprocessing import Pool
+from utils import script_config as config
+from utils import telemetry_utils as telemetry
+from utils.catalog_utils import DatasetCatalog, group_runs
+from utils import hcp_paths
+from utils.hcp_paths import RUNS
+from utils.extract_utils import gather_voxel_major, gather_voxel_time_series, load_coordinates, voxel_major_cache
+from utils.io_utils import atomic_output
+from utils.manifest_utils import RunManifest, drop_failed_upstream, record_runs, stale_runs
+from utils.qc_utils import time_series_qc, write_qc
+from utils.store_utils import provenance, write_time_series
 
-# Define the base directory
-data_directory = "/home/test/lmq/data/HCP"
-
-# Loop through each subject directory in the HCP directory
-for subject_name in os.listdir(data_directory):
-    subject_dir = os.path.join(data_directory, subject_name)
-
-    # Check if it's a directory
-    if os.path.isdir(subject_dir):
-        print(f"Processing subject: {subject_name}")
-
-        # Loop through phases [1, 2] and directions ['RL', 'LR']
-        for phase in [1, 2]:
-            for direction in ['RL', 'LR']:
-                # Path to the fMRI data
-                fMRI_file = os.path.join(
-                    subject_dir,
-                    f'{subject_name}_3T_rfMRI_REST_fix',
-                    f'{subject_name}',
-                    'MNINonLinear',
-                    'Results',
-                    f'rfMRI_REST{phase}_{direction}',
-                    'fMRI_downsampled_3mm.nii.gz'
-                )
-
-                # Check if the fMRI file exists
-                if not os.path.exists(fMRI_file):
-                    print(f"fMRI file not found: {fMRI_file}. Skipping...")
-                    continue
-
-                # Load the fMRI data
-                fMRI_img = nib.load(fMRI_file)
-                fMRI_data = fMRI_img.get_fdata()  # Shape: (x, y, z, time)
-
-                # Process both L and R coordinates
-                for hemisphere in ['L', 'R']:
-                    print(f"Processing {hemisphere} hemisphere for phase {phase}, direction {direction}")
-
-                    # Path to the coordinates file
-                    coor_path = os.path.join(
-                        subject_dir,
-                        f"probtrackx_{hemisphere}_omatrix2",
-                        "coords_for_fdt_matrix2"
-                    )
-
-                    # Check if the coordinates file exists
-                    if not os.path.exists(coor_path):
-                        print(f"Coordinates file not found: {coor_path}. Skipping...")
-                        continue
-
-                    # Load the voxel coordinates
-                    coordinates = np.loadtxt(coor_path)
-                    x_coordinates = coordinates[:, 0].astype(int)
-                    y_coordinates = coordinates[:, 1].astype(int)
-                    z_coordinates = coordinates[:, 2].astype(int)
-
-                    # Extract time series for each coordinate
-                    subject_coords = list(zip(x_coordinates, y_coordinates, z_coordinates))
-                    time_series = []
-
-                    for coord in subject_coords:
-                        x, y, z = coord
-                        try:
-                            voxel_time_series = fMRI_data[x, y, z, :]  # Extract the time series for the voxel
-                            time_series.append(voxel_time_series)
-                        except IndexError:
-                            print(f"Coordinate {coord} is out of bounds for subject {subject_name}. Skipping...")
-                            continue
-
-                    # Convert to a NumPy array (optional)
-                    time_series_array = np.array(time_series)  # Shape: (num_voxels, time_points)
-
-                    # Save the time series to a CSV file
-                    output_dir = os.path.join(subject_dir, 'fMRI', f'phase{phase}_{direction}')
-                    os.makedirs(output_dir, exist_ok=True)
-                    output_file = os.path.join(output_dir, f"voxel_time_series_{hemisphere}.csv")
-                    np.savetxt(output_file, time_series_array, delimiter=",")
-                    print(f"Saved time series for {hemisphere} hemisphere, phase {phase}, direction {direction} to {output_file}")
+# The HCP directory, worker count, manifest, catalog and telemetry settings are
+# shared by the three scripts in utils/script_config.py
+
+# Output backend: 'auto' (HDF5 if h5py is installed, else NPY), 'hdf5', 'npy' or 'csv'
+output_format = 'auto'
+
+# Read the voxels in chunks of this many time points so that only one chunk of the
+# bounding box is in memory (None reads all time points at once)
+stream_chunk_size = None
+
+# Voxel-major cache of each run's subcortical bounding box (uncompressed, one
+# contiguous row per voxel), built on the first extraction so that re-extracting
+# with new coords_for_fdt_matrix2 files skips decompressing the whole run; rebuilt
+# when the registered volume changes, least recently used entries evicted beyond
+# voxel_cache_max_bytes (None reads the registered volume every time)
+voxel_cache_dir = None
+voxel_cache_max_bytes = 200 * 1024 ** 3
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def process_striatum(subject_name, direction, phase, subject_dir):
+    """
+    Extract striatal voxel time series for a given subject, direction, and phase.
+
+    Returns
+    -------
+    list of str or None
+        Paths of the written files, or None when an input is missing.
+    """
+    # Path to the fMRI data
+    fMRI_file = hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)
+
+    # Check if the fMRI file exists
+    if not os.path.exists(fMRI_file):
+        logging.warning(f"fMRI file not found: {fMRI_file}. Skipping...")
+        return None
+
+    # Load the voxel coordinates of both hemispheres
+    coords_by_hemisphere = {}
+    coor_paths = {}
+    for hemisphere in hcp_paths.HEMISPHERES:
+        # Path to the coordinates file
+        coor_path = hcp_paths.coords_path(subject_dir, hemisphere)
+
+        # Check if the coordinates file exists
+        if not os.path.exists(coor_path):
+            logging.warning(f"Coordinates file not found: {coor_path}. Skipping...")
+            continue
+        coords_by_hemisphere[hemisphere] = load_coordinates(coor_path)
+        coor_paths[hemisphere] = coor_path
+
+    if not coords_by_hemisphere:
+        return None
+
+    cached = None
+    if voxel_cache_dir:
+        with telemetry.stage('voxel_cache'):
+            cached = voxel_major_cache(voxel_cache_dir, fMRI_file, max_bytes=voxel_cache_max_bytes)
+    with telemetry.stage('gather_voxels'):
+        if cached is not None:
+            gathered = gather_voxel_major(cached, coords_by_hemisphere)
+        else:
+            # Read only the voxels needed by both hemispheres from one open handle
+            fMRI_img = nib.load(fMRI_file, keep_file_open=True)
+            gathered = gather_voxel_time_series(fMRI_img.dataobj, coords_by_hemisphere, chunk_size=stream_chunk_size)
+
+    output_dir = hcp_paths.output_dir(subject_dir, phase, direction)
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = []
+    # QC of the gathered voxels (tSNR, DVARS, global signal, out-of-bounds and zero-variance fractions)
+    write_qc(output_dir, {
+        f"striatum_{hemisphere}": time_series_qc(time_series_array, in_bounds)
+        for hemisphere, (time_series_array, in_bounds) in gathered.items()
+    })
+    for hemisphere, (time_series_array, in_bounds) in gathered.items():
+        num_out_of_bounds = int((~in_bounds).sum())
+        if num_out_of_bounds:
+            logging.warning(
+                f"{num_out_of_bounds} {hemisphere} coordinates are out of bounds for subject {subject_name}; "
+                f"their rows are NaN"
+            )
+
+        if output_format != 'csv':
+            # One float32 array per region with its coordinates, mask and provenance
+            outputs.append(write_time_series(
+                output_dir, f"striatum_{hemisphere}", time_series_array,
+                coords=coords_by_hemisphere[hemisphere],
+                meta={'in_bounds': in_bounds.tolist(), 'provenance': provenance(source=fMRI_file, coords=coor_paths[hemisphere])},
+                backend=output_format,
+            ))
+            continue
+
+        # Save the time series (num_voxels, time_points) and the in-bounds mask
+        output_file = os.path.join(output_dir, f"voxel_time_series_{hemisphere}.csv")
+        with atomic_output(output_file) as tmp_file:
+            np.savetxt(tmp_file, time_series_array, delimiter=",")
+        in_bounds_file = os.path.join(output_dir, f"voxel_time_series_{hemisphere}_in_bounds.txt")
+        with atomic_output(in_bounds_file) as tmp_file:
+            np.savetxt(tmp_file, in_bounds, fmt='%d')
+        outputs += [output_file, in_bounds_file]
+        logging.info(
+            f"Saved time series for {hemisphere} hemisphere, phase {phase}, direction {direction} to {output_file}"
+        )
+    return outputs
+
+
+def stage_inputs(subject_name, phase, direction):
+    """Files the extraction of a run reads; their fingerprints decide whether a recorded run is stale."""
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
+    return [hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)] + [
+        hcp_paths.coords_path(subject_dir, hemisphere) for hemisphere in hcp_paths.HEMISPHERES
+    ]
+
+
+def stage_params():
+    """Parameters that change the extracted files."""
+    return {'output_format': output_format}
+
+
+def process_subject(subject_name, runs=None):
+    """
+    Process the given (phase, direction) runs (default: all four) of a single subject.
+
+    Returns
+    -------
+    subject_name : str
+    results : list of (phase, direction, outputs, error)
+        One entry per run, as recorded by ``manifest_utils.record_runs``.
+    """
+    subject_dir = os.path.join(config.hcp_dir, subject_name)
+    if not os.path.isdir(subject_dir):
+        return subject_name, []
+    logging.info(f"Processing subject: {subject_name}")
+
+    results = []
+    for phase, direction in runs or RUNS:
+        try:
+            with telemetry.stage('striatum', subject=subject_name, phase=phase, direction=direction):
+                outputs = process_striatum(subject_name, direction, phase, subject_dir)
+            results.append((phase, direction, outputs, None))
+        except Exception as e:
+            logging.exception(f"Failed subject: {subject_name}, phase: {phase}, direction: {direction}")
+            results.append((phase, direction, None, repr(e)))
+    return subject_name, results
+
+
+def process_task(task):
+    """``process_subject`` of one (subject_name, runs) task."""
+    return process_subject(*task)
+
+
+def main():
+    """Main function to process all subjects in parallel."""
+    if config.catalog_file:
+        # Plan from the catalog: only runs with a registered volume
+        catalog = DatasetCatalog(config.catalog_file)
+        catalog.refresh(config.hcp_dir)
+        tasks = group_runs(catalog.runs(kind='downsampled'))
+    else:
+        tasks = [(name, RUNS) for name in sorted(os.listdir(config.hcp_dir))]
+    manifest = RunManifest(config.manifest_file) if config.manifest_file else None
+    if manifest is not None:
+        # Never extract from what a failed upstream run left on disk, even when forced
+        tasks = drop_failed_upstream(manifest, tasks, 'striatum')
+        if not config.force:
+            tasks = stale_runs(manifest, tasks, 'striatum', stage_inputs, stage_params())
+    logging.info(f"Starting multiprocessing with {config.num_workers} workers on {len(tasks)} subjects...")
+    telemetry.configure(config.telemetry_file)
+    start = time.time()
+    with Pool(config.num_workers) as pool:
+        # Record each subject's runs as soon as it finishes, from this process only
+        for subject_name, results in pool.imap_unordered(process_task, tasks):
+            if manifest is not None:
+                record_runs(manifest, subject_name, results, 'striatum', stage_inputs, stage_params())
+    if config.telemetry_file:
+        logging.info("Telemetry summary:\n" + telemetry.report(config.telemetry_file, config.prometheus_file, since=start))
+
+
+if __name__ == "__main__":
+    main()
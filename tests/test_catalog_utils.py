@@ -0,0 +1,59 @@
+"""Catalog refreshes must not lose image headers that could not be read."""
+import os
+import sqlite3
+from utils import catalog_utils, hcp_paths
+from utils.catalog_utils import DatasetCatalog
+
+
+def make_run(hcp_dir, subject_name, phase=1, direction='LR'):
+    path = hcp_paths.dtseries_path(os.path.join(hcp_dir, subject_name), subject_name, phase, direction)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(b'\0' * 16)
+    return path
+
+
+def test_unreadable_header_is_retried(tmp_path, monkeypatch):
+    hcp_dir = str(tmp_path)
+    path = make_run(hcp_dir, '100307')
+    catalog = DatasetCatalog(str(tmp_path / catalog_utils.CATALOG_NAME))
+    header = {'shape': [1200, 91282], 'dtype': 'float32', 'tr': 0.72, 'n_vols': 1200, 'affine': None}
+
+    def unreadable(path):
+        raise OSError('truncated file')
+
+    monkeypatch.setattr(catalog_utils, 'read_header', unreadable)
+    catalog.refresh(hcp_dir)
+    assert catalog.files(kind='dtseries')[0]['shape'] is None
+
+    # Nothing changed on disk, but the missing header is read again
+    reads = []
+    monkeypatch.setattr(catalog_utils, 'read_header', lambda p: reads.append(p) or header)
+    stats = catalog.refresh(hcp_dir)
+    assert stats['listed'] == 0 and reads == [path]
+    record = catalog.files(kind='dtseries')[0]
+    assert record['shape'] == [1200, 91282] and record['n_vols'] == 1200
+
+    # Once recorded, an unchanged file is not read again
+    catalog.refresh(hcp_dir)
+    assert reads == [path]
+
+
+def test_each_subject_is_committed_on_its_own(tmp_path, monkeypatch):
+    hcp_dir = str(tmp_path / 'HCP')
+    for subject_name in ['100206', '100307']:
+        make_run(hcp_dir, subject_name)
+    catalog_path = str(tmp_path / catalog_utils.CATALOG_NAME)
+    catalog = DatasetCatalog(catalog_path)
+    committed = []
+    scan_subject = DatasetCatalog._scan_subject
+
+    def scan_and_look(self, conn, hcp_dir, subject_name, *args):
+        # What another process sees while this subject is being scanned
+        with sqlite3.connect(catalog_path) as other:
+            committed.append(sorted(row[0] for row in other.execute('SELECT DISTINCT subject FROM files')))
+        return scan_subject(self, conn, hcp_dir, subject_name, *args)
+
+    monkeypatch.setattr(DatasetCatalog, '_scan_subject', scan_and_look)
+    catalog.refresh(hcp_dir, read_headers=False)
+    assert committed == [[], ['100206']]
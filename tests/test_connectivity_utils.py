@@ -0,0 +1,75 @@
+"""Striatum x cortex correlations against numpy, and their average over runs."""
+import numpy as np
+import pytest
+from utils.connectivity_utils import FISHER_Z_LIMIT, average_runs, correlation_matrix, fisher_z, run_connectivity, \
+    write_connectivity
+from utils.store_utils import load_time_series
+
+NUM_TIMEPOINTS = 50
+
+
+def expected_correlations(x, y):
+    """Cross block of ``np.corrcoef`` over the rows of x and y, in float64."""
+    return np.corrcoef(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))[:len(x), len(x):]
+
+
+def test_correlation_matrix_matches_corrcoef():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(7, NUM_TIMEPOINTS)).astype(np.float32) * 40 + 1000
+    y = rng.normal(size=(5, NUM_TIMEPOINTS)).astype(np.float32)
+    y[1] = x[3] * -2 + 5
+    r = correlation_matrix(x, y)
+    assert r.shape == (7, 5) and r.dtype == np.float32
+    np.testing.assert_allclose(r, expected_correlations(x, y), atol=1e-5)
+    np.testing.assert_allclose(r[3, 1], -1, atol=1e-5)
+
+
+def test_constant_and_out_of_bounds_rows_are_nan():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=(4, NUM_TIMEPOINTS)).astype(np.float32)
+    y = rng.normal(size=(3, NUM_TIMEPOINTS)).astype(np.float32)
+    x[1] = 7.0  # no variance
+    x[2, 10] = np.nan  # e.g. a voxel outside the registered field of view
+    y[0] = 0.0
+    r = correlation_matrix(x, y)
+    assert np.isnan(r[1]).all() and np.isnan(r[2]).all() and np.isnan(r[:, 0]).all()
+    valid_x, valid_y = [0, 3], [1, 2]
+    np.testing.assert_allclose(r[np.ix_(valid_x, valid_y)], expected_correlations(x[valid_x], y[valid_y]), atol=1e-5)
+
+
+def test_different_lengths_are_rejected():
+    with pytest.raises(ValueError):
+        correlation_matrix(np.zeros((2, 10)), np.zeros((2, 11)))
+
+
+def test_fisher_z_is_arctanh_and_finite_at_one():
+    r = np.array([-1.0, -0.5, 0.0, 0.3, 1.0, np.nan], dtype=np.float32)
+    z = fisher_z(r.copy())
+    np.testing.assert_allclose(z[1:4], np.arctanh(r[1:4]), rtol=1e-6)
+    np.testing.assert_allclose(z[[0, 4]], [-np.arctanh(FISHER_Z_LIMIT), np.arctanh(FISHER_Z_LIMIT)], rtol=1e-6)
+    assert np.isnan(z[5])
+
+
+def test_average_runs_averages_fisher_z(tmp_path):
+    rng = np.random.default_rng(2)
+    cortex_ids, cortex_names = [11, 12, 13], ['a', 'b', 'c']
+    run_dirs, z_by_run = {}, []
+    for run in ['phase1_LR', 'phase1_RL']:
+        striatum = rng.normal(size=(6, NUM_TIMEPOINTS)).astype(np.float32)
+        cortex = rng.normal(size=(3, NUM_TIMEPOINTS)).astype(np.float32)
+        # Strongly correlated pairs, where averaging r and averaging z differ most
+        cortex[0] = striatum[0] + 0.05 * rng.normal(size=NUM_TIMEPOINTS)
+        matrices = run_connectivity({'L': striatum}, {'aparc': {'L': (cortex_ids, cortex_names, cortex)}})
+        run_dirs[run] = str(tmp_path / run)
+        write_connectivity(run_dirs[run], matrices, backend='npy')
+        z_by_run.append(fisher_z(correlation_matrix(striatum, cortex)))
+
+    outputs = average_runs(run_dirs, str(tmp_path / 'all_runs'), backend='npy')
+    assert len(outputs) == 1
+    mean, meta = load_time_series(str(tmp_path / 'all_runs'), 'connectivity_striatum_L_aparc')
+    expected = (z_by_run[0] + z_by_run[1]) / 2
+    np.testing.assert_allclose(np.asarray(mean), expected, rtol=1e-5)
+    # Not the transform of the averaged correlations
+    assert not np.allclose(np.asarray(mean), np.arctanh((np.tanh(z_by_run[0]) + np.tanh(z_by_run[1])) / 2))
+    assert meta['runs'] == sorted(run_dirs)
+    assert meta['column_label_ids'] == cortex_ids
@@ -0,0 +1,52 @@
+"""Selective extraction must keep every member inside its extraction directory."""
+import os
+import zipfile
+import pytest
+from utils.dir_utils import INGEST_PATTERNS, extract_member, member_path, selected_members
+
+
+def make_zip(path, names):
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        for name in names:
+            zip_file.writestr(name, name)
+
+
+def test_member_path_inside_extract_dir(tmp_path):
+    assert member_path(str(tmp_path), 'a/./b/../c.txt') == os.path.join(os.path.realpath(tmp_path), 'a', 'c.txt')
+
+
+@pytest.mark.parametrize('name', ['/etc/passwd', '../outside', 'a/../../outside', '..'])
+def test_member_path_rejects_escaping_names(tmp_path, name):
+    with pytest.raises(ValueError):
+        member_path(str(tmp_path), name)
+
+
+def test_member_path_rejects_symlink_out_of_extract_dir(tmp_path):
+    extract_dir = tmp_path / 'extract'
+    extract_dir.mkdir()
+    os.symlink(tmp_path, extract_dir / 'link')
+    with pytest.raises(ValueError):
+        member_path(str(extract_dir), 'link/outside')
+
+
+def test_pattern_matched_traversal_is_not_extracted(tmp_path):
+    # fnmatch's '*' also matches '/' and '..', so a crafted name passes the ingest patterns
+    name = '../../MNINonLinear/xfms/evil'
+    zip_path = str(tmp_path / 'subject.zip')
+    make_zip(zip_path, [name, 'subject/MNINonLinear/xfms/warp.nii.gz'])
+    extract_dir = tmp_path / 'a' / 'b'
+    extract_dir.mkdir(parents=True)
+
+    with zipfile.ZipFile(zip_path) as zip_file:
+        members = selected_members(zip_file, INGEST_PATTERNS['Structural_preproc'])
+        assert sorted(info.filename for info in members) == sorted([name, 'subject/MNINonLinear/xfms/warp.nii.gz'])
+        for info in members:
+            if info.filename == name:
+                with pytest.raises(ValueError):
+                    extract_member(zip_file, info, str(extract_dir))
+            else:
+                assert extract_member(zip_file, info, str(extract_dir))
+
+    assert not (tmp_path / 'MNINonLinear').exists()
+    assert (extract_dir / 'subject' / 'MNINonLinear' / 'xfms' / 'warp.nii.gz').read_text() == \
+        'subject/MNINonLinear/xfms/warp.nii.gz'
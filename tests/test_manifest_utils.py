@@ -0,0 +1,102 @@
+"""The manifest must skip exactly the stages whose inputs, parameters and outputs are unchanged."""
+import os
+import pytest
+from utils.manifest_utils import RunManifest, drop_failed_upstream, stale_runs
+
+SUBJECT = '100307'
+RUN = 'phase1_LR'
+PARAMS = {'voxel_size': 3.0}
+
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+def touch_later(path):
+    """Advance the mtime without changing size or content."""
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+@pytest.fixture
+def done(tmp_path):
+    """A manifest with one 'done' registration of one input and one output."""
+    manifest = RunManifest(str(tmp_path / 'manifest.sqlite'))
+    inputs = [write(tmp_path / 'input.nii', b'input')]
+    outputs = [write(tmp_path / 'output.nii', b'output')]
+    manifest.mark_done(SUBJECT, RUN, 'registration', inputs, PARAMS, outputs)
+    return manifest, inputs, outputs
+
+
+def test_unchanged_stage_is_skipped(done):
+    manifest, inputs, _ = done
+    assert manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs, PARAMS)
+    assert not manifest.is_up_to_date(SUBJECT, RUN, 'striatum', inputs, PARAMS)
+    assert not manifest.is_up_to_date(SUBJECT, 'phase2_LR', 'registration', inputs, PARAMS)
+
+
+def test_changed_input_reruns(done):
+    manifest, inputs, _ = done
+    write(inputs[0], b'changed')
+    assert not manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs, PARAMS)
+
+
+def test_new_input_reruns(done, tmp_path):
+    manifest, inputs, _ = done
+    assert not manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs + [str(tmp_path / 'more.nii')], PARAMS)
+
+
+def test_changed_parameters_rerun(done):
+    manifest, inputs, _ = done
+    assert not manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs, {'voxel_size': 2.0})
+
+
+@pytest.mark.parametrize('change', ['remove', 'resize', 'touch'])
+def test_changed_output_reruns(done, change):
+    manifest, inputs, outputs = done
+    if change == 'remove':
+        os.remove(outputs[0])
+    elif change == 'resize':
+        write(outputs[0], b'truncated')
+    else:
+        touch_later(outputs[0])
+    assert not manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs, PARAMS)
+
+
+def test_output_checksums_are_verified_on_request(done):
+    manifest, inputs, outputs = done
+    # Same size and mtime, different content
+    st = os.stat(outputs[0])
+    write(outputs[0], b'OUTPUT')
+    os.utime(outputs[0], ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs, PARAMS)
+    verifying = RunManifest(manifest.path, verify_outputs=True)
+    assert not verifying.is_up_to_date(SUBJECT, RUN, 'registration', inputs, PARAMS)
+
+
+def test_failed_stage_reruns(done):
+    manifest, inputs, _ = done
+    manifest.mark_failed(SUBJECT, RUN, 'registration', inputs, PARAMS, RuntimeError('applywarp failed'))
+    assert manifest.record(SUBJECT, RUN, 'registration')['error'] == 'applywarp failed'
+    assert not manifest.is_up_to_date(SUBJECT, RUN, 'registration', inputs, PARAMS)
+
+
+def test_failed_registration_blocks_striatum(done):
+    manifest, inputs, outputs = done
+    tasks = [(SUBJECT, [(1, 'LR'), (2, 'LR')]), ('100408', [(1, 'LR')])]
+    # Done or not yet recorded registrations leave every run to the striatum stage
+    assert drop_failed_upstream(manifest, tasks, 'striatum') == tasks
+
+    manifest.mark_failed(SUBJECT, RUN, 'registration', inputs, PARAMS, 'applywarp failed')
+    assert drop_failed_upstream(manifest, tasks, 'striatum') == [(SUBJECT, [(2, 'LR')]), ('100408', [(1, 'LR')])]
+    # The cortex stage reads the dense time series, not the registered volume
+    assert drop_failed_upstream(manifest, tasks, 'cortex') == tasks
+
+
+def test_stale_runs_keeps_only_stale_runs(done):
+    manifest, inputs, _ = done
+    tasks = [(SUBJECT, [(1, 'LR'), (2, 'LR')]), ('100408', [(1, 'LR')])]
+    planned = stale_runs(manifest, tasks, 'registration', lambda subject, phase, direction: inputs, PARAMS)
+    assert planned == [(SUBJECT, [(2, 'LR')]), ('100408', [(1, 'LR')])]
@@ -0,0 +1,59 @@
+"""Chunked QC metrics against their closed forms over the whole array."""
+import numpy as np
+import pytest
+from utils.qc_utils import QCAccumulator, qc_failures, time_series_qc
+
+
+def closed_form(data):
+    """tSNR, DVARS and global signal computed directly from a complete (num_rows, num_timepoints) array."""
+    data = np.asarray(data, dtype=np.float64)
+    std = data.std(axis=1)
+    tsnr = data.mean(axis=1)[std > 0] / std[std > 0]
+    dvars = np.sqrt(np.mean(np.square(np.diff(data, axis=1)), axis=0))
+    global_signal = data.mean(axis=0)
+    return {
+        'tsnr_median': np.median(tsnr), 'tsnr_mean': tsnr.mean(),
+        'dvars_mean': dvars.mean(), 'dvars_max': dvars.max(),
+        'global_signal_mean': global_signal.mean(), 'global_signal_std': global_signal.std(),
+    }
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return (1000 + 50 * rng.normal(size=(6, 23)) + np.linspace(0, 30, 23)).astype(np.float32)
+
+
+@pytest.mark.parametrize('block_size', [1, 4, 7, 23])
+def test_chunked_metrics_match_closed_form(data, block_size):
+    accumulator = QCAccumulator(data.shape[0])
+    for start in range(0, data.shape[1], block_size):
+        accumulator.update(data[:, start:start + block_size])
+    metrics = accumulator.result()
+    assert metrics['num_rows'] == 6 and metrics['num_timepoints'] == 23
+    for metric, value in closed_form(data).items():
+        np.testing.assert_allclose(metrics[metric], value, rtol=1e-7, err_msg=metric)
+    assert metrics['out_of_bounds_fraction'] == metrics['zero_variance_fraction'] == 0
+
+
+def test_out_of_bounds_and_constant_rows(data):
+    data = data.copy()
+    data[1] = 0.0  # out of bounds, filled with zeros
+    data[4] = 1234.5  # constant
+    in_bounds = np.array([True, False, True, True, True, True])
+    metrics = time_series_qc(data, in_bounds)
+    assert metrics['out_of_bounds_fraction'] == pytest.approx(1 / 6)
+    assert metrics['zero_variance_fraction'] == pytest.approx(1 / 5)
+    # tSNR leaves out the constant row, DVARS and global signal only the out-of-bounds one
+    for metric, value in closed_form(data[in_bounds]).items():
+        np.testing.assert_allclose(metrics[metric], value, rtol=1e-7, err_msg=metric)
+
+
+def test_qc_failures():
+    metrics = {'striatum_L': {'tsnr_median': 15.0, 'out_of_bounds_fraction': 0.0},
+               'cortex_L_aparc': {'tsnr_median': 80.0, 'out_of_bounds_fraction': float('nan')}}
+    assert qc_failures(metrics, {'min_tsnr_median': 10, 'max_out_of_bounds_fraction': 0.1}) == []
+    failures = qc_failures(metrics, {'min_tsnr_median': 20})
+    assert len(failures) == 1 and failures[0].startswith('striatum_L tsnr_median')
+    with pytest.raises(ValueError):
+        qc_failures(metrics, {'tsnr_median': 20})
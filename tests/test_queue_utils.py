@@ -0,0 +1,117 @@
+"""Several worker processes draining one queue on this machine, as several nodes would."""
+import json
+import multiprocessing
+import os
+import time
+import pytest
+from utils.queue_utils import DirectoryQueue, open_queue, run_worker
+
+LEASE_SECONDS = 1.0
+POLL_SECONDS = 0.1
+
+
+def handle_task(payload):
+    """Record which process ran the task; 'poison' tasks kill their worker mid-task."""
+    if payload.get('poison'):
+        os._exit(1)
+    with open(os.path.join(payload['log_dir'], payload['id']), 'a') as f:
+        f.write(f'{os.getpid()}\n')
+    time.sleep(0.05)
+    return {'pid': os.getpid()}
+
+
+def work(queue_path, max_attempts):
+    queue = open_queue(queue_path, lease_seconds=LEASE_SECONDS, max_attempts=max_attempts)
+    run_worker(queue, handle_task, poll_seconds=POLL_SECONDS)
+
+
+def run_workers(queue_path, num_workers, max_attempts=3, timeout=60):
+    """Start ``num_workers`` worker processes and wait until all of them have returned or died."""
+    workers = [multiprocessing.Process(target=work, args=(queue_path, max_attempts)) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout)
+        assert not worker.is_alive(), "worker did not return although the queue should be finished"
+    return [worker.exitcode for worker in workers]
+
+
+def make_tasks(log_dir, num_tasks, **fields):
+    return [{'id': f'task{i:03d}', 'log_dir': str(log_dir), **fields} for i in range(num_tasks)]
+
+
+def runs_per_task(log_dir):
+    return {name: len(open(os.path.join(log_dir, name)).read().split()) for name in os.listdir(log_dir)}
+
+
+@pytest.fixture(params=['queue', 'queue.sqlite'])
+def queue_path(request, tmp_path):
+    """A directory queue and a SQLite queue in a temporary directory."""
+    return str(tmp_path / request.param)
+
+
+def test_every_task_completed_exactly_once(queue_path, tmp_path):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    queue = open_queue(queue_path, lease_seconds=LEASE_SECONDS)
+    assert queue.put(make_tasks(log_dir, 40)) == 40
+
+    assert run_workers(queue_path, 4) == [0] * 4
+
+    assert runs_per_task(log_dir) == {f'task{i:03d}': 1 for i in range(40)}
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'done': 40, 'failed': 0}
+    # Queuing the same tasks while they are done queues them again
+    assert queue.put(make_tasks(log_dir, 40)) == 40
+
+
+def test_abandoned_lease_is_requeued(queue_path, tmp_path):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    queue = open_queue(queue_path, lease_seconds=LEASE_SECONDS)
+    queue.put(make_tasks(log_dir, 10))
+    # A worker that claims a task and dies without ever sending a heartbeat
+    abandoned = queue.claim('dead-worker')
+
+    assert run_workers(queue_path, 3) == [0] * 3
+
+    assert runs_per_task(log_dir) == {f'task{i:03d}': 1 for i in range(10)}
+    records = {record['id']: record for record in queue.records()}
+    assert all(record['status'] == 'done' for record in records.values())
+    assert records[abandoned['id']]['attempts'] == 2
+    assert not queue.complete(abandoned), "the dead worker's lease must be void"
+
+
+def test_task_failed_after_max_attempts(queue_path, tmp_path):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    queue = open_queue(queue_path, lease_seconds=LEASE_SECONDS, max_attempts=2)
+    queue.put(make_tasks(log_dir, 10) + [{'id': 'poison', 'log_dir': str(log_dir), 'poison': True}])
+
+    # The poison task kills the worker holding it on each of its two attempts
+    exit_codes = run_workers(queue_path, 4, max_attempts=2)
+
+    assert sorted(exit_codes) == [0, 0, 1, 1]
+    assert runs_per_task(log_dir) == {f'task{i:03d}': 1 for i in range(10)}
+    records = {record['id']: record for record in queue.records()}
+    assert records['poison']['status'] == 'failed'
+    assert records['poison']['attempts'] == 2
+    assert 'lease expired' in records['poison']['error']
+
+
+def test_lease_staged_by_a_dead_worker_is_recovered(tmp_path):
+    log_dir = tmp_path / 'log'
+    log_dir.mkdir()
+    queue_path = str(tmp_path / 'queue')
+    queue = DirectoryQueue(queue_path, lease_seconds=LEASE_SECONDS)
+    queue.put(make_tasks(log_dir, 5))
+    # A worker that moved an expired lease aside and died before re-queuing it
+    lease = queue.claim('dead-worker')
+    os.rename(lease['token'], os.path.join(queue_path, 'pending', f'.expired-{os.path.basename(lease["token"])}'))
+
+    assert run_workers(queue_path, 2) == [0] * 2
+
+    assert runs_per_task(log_dir) == {f'task{i:03d}': 1 for i in range(5)}
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'done': 5, 'failed': 0}
+    assert not [name for name in os.listdir(os.path.join(queue_path, 'pending')) if name.startswith('.expired-')]
+    with open(os.path.join(queue_path, 'done', f"{lease['id']}.json")) as f:
+        assert json.load(f)['attempts'] == 2
@@ -0,0 +1,72 @@
+"""The isotropic grid and nearest-neighbour gather of ``flirt -applyisoxfm``."""
+import nibabel as nib
+import numpy as np
+import pytest
+from utils.resample_utils import isotropic_grid, resample_image_isotropic, resample_isotropic_nearest
+
+SHAPE = (11, 13, 9)
+ZOOMS = (2.0, 2.5, 1.2)
+
+# Non-divisible fields of view: floor(n * zoom / 3 + 0.5) = floor(7.83), floor(11.33), floor(4.1)
+FLIRT_DIMS = (7, 11, 4)
+
+RADIOLOGICAL_AFFINE = np.array([[-2.0, 0, 0, 40], [0, 2.5, 0, -50], [0, 0, 1.2, -30], [0, 0, 0, 1]])
+NEUROLOGICAL_AFFINE = np.array([[2.0, 0, 0, -40], [0, 2.5, 0, -50], [0, 0, 1.2, -30], [0, 0, 0, 1]])
+
+# flirt's scaled-mm frame starts at voxel 0, except along x of a neurological image where FSL
+# counts from the last voxel: there output voxel j is input voxel 10 - 1.5 * (6 - j) = 1 + 1.5 j
+FLIRT_AFFINES = {
+    'radiological': np.array([[-3.0, 0, 0, 40], [0, 3, 0, -50], [0, 0, 3, -30], [0, 0, 0, 1]]),
+    'neurological': np.array([[3.0, 0, 0, -38], [0, 3, 0, -50], [0, 0, 3, -30], [0, 0, 0, 1]]),
+}
+# Nearest input voxel along each axis for every output voxel
+FLIRT_INDICES = {
+    'radiological': ([0, 2, 3, 5, 6, 8, 9], [0, 1, 2, 4, 5, 6, 7, 8, 10, 11, 12], [0, 3, 5, 8]),
+    'neurological': ([1, 3, 4, 6, 7, 9, 10], [0, 1, 2, 4, 5, 6, 7, 8, 10, 11, 12], [0, 3, 5, 8]),
+}
+AFFINES = {'radiological': RADIOLOGICAL_AFFINE, 'neurological': NEUROLOGICAL_AFFINE}
+
+
+def test_hcp_mni_grid():
+    mni_affine = np.array([[-2.0, 0, 0, 90], [0, 2, 0, -126], [0, 0, 2, -72], [0, 0, 0, 1]])
+    out_shape, out_affine, _ = isotropic_grid((91, 109, 91), (2.0, 2.0, 2.0), mni_affine, 3.0)
+    assert out_shape == (61, 73, 61)
+    np.testing.assert_allclose(out_affine, [[-3, 0, 0, 90], [0, 3, 0, -126], [0, 0, 3, -72], [0, 0, 0, 1]])
+
+
+@pytest.mark.parametrize('orientation', ['radiological', 'neurological'])
+def test_isotropic_grid_matches_flirt(orientation):
+    assert (np.linalg.det(AFFINES[orientation][:3, :3]) > 0) == (orientation == 'neurological')
+    out_shape, out_affine, out_to_in = isotropic_grid(SHAPE, ZOOMS, AFFINES[orientation], 3.0)
+    assert out_shape == FLIRT_DIMS
+    np.testing.assert_allclose(out_affine, FLIRT_AFFINES[orientation], atol=1e-12)
+    np.testing.assert_allclose(out_affine, AFFINES[orientation] @ out_to_in)
+
+
+@pytest.mark.parametrize('orientation', ['radiological', 'neurological'])
+def test_resample_gathers_the_nearest_voxels(orientation):
+    data = np.arange(np.prod(SHAPE) * 2, dtype=np.float32).reshape(SHAPE + (2,))
+    resampled, out_affine = resample_isotropic_nearest(data, AFFINES[orientation], ZOOMS, 3.0)
+    ix, iy, iz = FLIRT_INDICES[orientation]
+    assert resampled.shape == FLIRT_DIMS + (2,) and resampled.dtype == data.dtype
+    np.testing.assert_array_equal(resampled, data[np.ix_(ix, iy, iz)])
+    np.testing.assert_allclose(out_affine, FLIRT_AFFINES[orientation], atol=1e-12)
+
+
+def test_voxels_outside_the_field_of_view_are_zero():
+    # Two 1 mm voxels at 0.4 mm: output centres 0, 0.4, 0.8, 1.2 and 1.6 mm round to input voxels 0, 0, 1, 1, 2
+    data = np.ones((2, 2, 2), dtype=np.float32)
+    resampled, _ = resample_isotropic_nearest(data, RADIOLOGICAL_AFFINE, (1.0, 1.0, 1.0), 0.4)
+    assert resampled.shape == (5, 5, 5)
+    np.testing.assert_array_equal(resampled[:4, :4, :4], 1)
+    assert not resampled[4].any() and not resampled[:, 4].any() and not resampled[:, :, 4].any()
+
+
+def test_resampled_image_header():
+    img = nib.Nifti1Image(np.zeros(SHAPE + (4,), dtype=np.int16), NEUROLOGICAL_AFFINE)
+    img.header.set_zooms(ZOOMS + (0.72,))
+    out_img = resample_image_isotropic(img, voxel_size=3.0)
+    assert out_img.shape == FLIRT_DIMS + (4,)
+    assert out_img.header.get_zooms() == pytest.approx((3.0, 3.0, 3.0, 0.72))
+    np.testing.assert_allclose(out_img.affine, FLIRT_AFFINES['neurological'], atol=1e-12)
+    assert out_img.get_data_dtype() == np.int16
@@ -0,0 +1,44 @@
+"""Per-run stores and their consolidation into a cohort store."""
+import os
+import numpy as np
+import pytest
+from utils.store_utils import consolidate_cohort, list_regions, load_cohort_region, write_time_series
+
+
+def write_run(hcp_dir, subject, run, seed):
+    run_dir = os.path.join(hcp_dir, subject, 'fMRI', run)
+    rng = np.random.default_rng(seed)
+    data = {'striatum_L': rng.random((5, 8), dtype=np.float32),
+            'cortex_L_aparc': rng.random((3, 8), dtype=np.float32)}
+    write_time_series(run_dir, 'striatum_L', data['striatum_L'], coords=np.arange(15).reshape(5, 3), backend='npy')
+    write_time_series(run_dir, 'cortex_L_aparc', data['cortex_L_aparc'], label_ids=[1, 2, 3],
+                      label_names=['a', 'b', 'c'], backend='npy')
+    return run_dir, data
+
+
+def test_list_regions_skips_interrupted_writes(tmp_path):
+    run_dir, _ = write_run(str(tmp_path), '100307', 'phase1_LR', 0)
+    # What atomic_output leaves behind when its worker is killed mid-write
+    np.save(os.path.join(run_dir, '.tmp-4242-0123abcd-striatum_R.npy'), np.zeros((2, 8), dtype=np.float32))
+    open(os.path.join(run_dir, '.tmp-4242-89abcdef-striatum_R.json'), 'w').close()
+
+    assert list_regions(run_dir) == ['cortex_L_aparc', 'striatum_L']
+
+
+@pytest.mark.parametrize('backend, name', [('npy', 'cohort'), ('hdf5', 'cohort.h5')])
+def test_consolidate_cohort_ignores_interrupted_writes(tmp_path, backend, name):
+    if backend == 'hdf5':
+        pytest.importorskip('h5py')
+    hcp_dir = str(tmp_path / 'HCP')
+    runs = {}
+    for seed, (subject, run) in enumerate([('100206', 'phase1_LR'), ('100307', 'phase1_LR'), ('100307', 'phase2_RL')]):
+        run_dir, runs[(subject, run)] = write_run(hcp_dir, subject, run, seed)
+    np.save(os.path.join(run_dir, '.tmp-4242-0123abcd-striatum_R.npy'), np.zeros((2, 8), dtype=np.float32))
+
+    cohort_path = consolidate_cohort(hcp_dir, str(tmp_path / name), backend=backend)
+
+    for region in ['striatum_L', 'cortex_L_aparc']:
+        cohort = load_cohort_region(cohort_path, region)
+        assert sorted(cohort) == sorted(runs)
+        for key, data in runs.items():
+            np.testing.assert_array_equal(cohort[key][()], data[region])
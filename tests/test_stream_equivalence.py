@@ -0,0 +1,79 @@
+"""The streaming path must write the same outputs as the in-memory path."""
+import os
+import shutil
+import nibabel as nib
+import numpy as np
+import pytest
+import pipeline
+from benchmarks.synthetic import generate_subject
+from utils import hcp_paths
+from utils.qc_utils import load_qc
+from utils.store_utils import load_time_series
+
+SUBJECT = '900000'
+RUN = (1, 'LR')
+STAGES = ['registration', 'striatum', 'cortex']
+
+
+@pytest.fixture(scope='module')
+def template(tmp_path_factory):
+    """One short synthetic run with a 3mm warp, generated once for the module."""
+    hcp_dir = str(tmp_path_factory.mktemp('template'))
+    generate_subject(hcp_dir, SUBJECT, num_timepoints=23, runs=[RUN], small_warp=True, num_coords=200)
+    return hcp_dir
+
+
+def process(template, hcp_dir, monkeypatch, stream_chunk_size):
+    """Run the stages on a private copy of the template; returns the run's paths and outcomes."""
+    shutil.copytree(template, hcp_dir)
+    monkeypatch.setattr(pipeline, 'config', dict(
+        pipeline.DEFAULT_CONFIG, hcp_dir=hcp_dir, output_format='npy', chunk_size=4,
+        stream_chunk_size=stream_chunk_size,
+    ))
+    if stream_chunk_size:
+        outcomes = pipeline.stream_stages(SUBJECT, *RUN, STAGES)
+    else:
+        outcomes = pipeline.run_stages(SUBJECT, *RUN, STAGES)
+    assert {stage: outcome['status'] for stage, outcome in outcomes.items()} == dict.fromkeys(STAGES, 'done')
+    subject_dir = os.path.join(hcp_dir, SUBJECT)
+    return {
+        'downsampled': hcp_paths.downsampled_path(subject_dir, SUBJECT, *RUN),
+        'run_dir': hcp_paths.output_dir(subject_dir, *RUN),
+        'outputs': {stage: sorted(os.path.relpath(path, hcp_dir) for path in outcome['outputs'])
+                    for stage, outcome in outcomes.items()},
+    }
+
+
+def test_streamed_outputs_equal_in_memory_outputs(template, tmp_path, monkeypatch):
+    # A chunk size that divides neither the run length nor the registration chunk size
+    in_memory = process(template, str(tmp_path / 'in_memory'), monkeypatch, None)
+    streamed = process(template, str(tmp_path / 'streamed'), monkeypatch, 5)
+    assert streamed['outputs'] == in_memory['outputs']
+
+    # Registered volume
+    expected, actual = nib.load(in_memory['downsampled']), nib.load(streamed['downsampled'])
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual.affine, expected.affine)
+    np.testing.assert_allclose(np.asanyarray(actual.dataobj), np.asanyarray(expected.dataobj), rtol=1e-6)
+
+    # Striatum voxels and cortex parcel averages, with their metadata
+    regions = [f'striatum_{h}' for h in hcp_paths.HEMISPHERES] + [
+        f'cortex_{h}_{name}' for h in hcp_paths.HEMISPHERES for name in pipeline.DEFAULT_CONFIG['parcellations']
+    ]
+    for region in regions:
+        expected_data, expected_meta = load_time_series(in_memory['run_dir'], region)
+        actual_data, actual_meta = load_time_series(streamed['run_dir'], region)
+        np.testing.assert_allclose(np.asarray(actual_data), np.asarray(expected_data), rtol=1e-6, err_msg=region)
+        for key in ['label_ids', 'label_names', 'in_bounds']:
+            assert actual_meta.get(key) == expected_meta.get(key), (region, key)
+        if 'coords' in expected_meta:
+            np.testing.assert_array_equal(actual_meta['coords'], expected_meta['coords'])
+
+    # QC rows, accumulated chunk by chunk when streaming
+    expected_qc, actual_qc = load_qc(in_memory['run_dir']), load_qc(streamed['run_dir'])
+    assert sorted(actual_qc) == sorted(expected_qc) == sorted(regions)
+    for region, metrics in expected_qc.items():
+        for metric, value in metrics.items():
+            if metric != 'updated':
+                np.testing.assert_allclose(actual_qc[region][metric], value, rtol=1e-5, equal_nan=True,
+                                           err_msg=f'{region} {metric}')
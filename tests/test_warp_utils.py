@@ -0,0 +1,185 @@
+"""The composed warp + downsample operator against the steps it replaces."""
+import nibabel as nib
+import numpy as np
+import pytest
+from utils.cache_utils import ArrayCache
+from utils.resample_utils import resample_isotropic_nearest
+from utils.warp_utils import build_sampling_operator, cached_sampling_operator, nearest_weights, trilinear_weights
+
+FSL_FNIRT_DISPLACEMENT_FIELD = 2006
+
+
+def radiological_affine(voxel_size, sign=-1):
+    """Voxel-to-world matrix, by default with a negative determinant as HCP's MNI and ACPC grids."""
+    affine = np.diag([sign * voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = [40.0, -50.0, -30.0]
+    return affine
+
+
+def write_image(path, data, voxel_size, sign=-1):
+    img = nib.Nifti1Image(np.asarray(data, dtype=np.float32), radiological_affine(voxel_size, sign))
+    nib.save(img, str(path))
+    return img
+
+
+def write_warp(path, shape, voxel_size, displacement_mm=(0.0, 0.0, 0.0), sign=-1):
+    """Constant relative displacement field (FSL mm) on the given grid."""
+    field = np.broadcast_to(np.asarray(displacement_mm, dtype=np.float32), tuple(shape) + (3,))
+    img = nib.Nifti1Image(np.ascontiguousarray(field), radiological_affine(voxel_size, sign))
+    img.header['intent_code'] = FSL_FNIRT_DISPLACEMENT_FIELD
+    nib.save(img, str(path))
+    return str(path)
+
+
+@pytest.fixture
+def grid(tmp_path):
+    """A 1mm input volume with the reference and a zero warp on the same grid."""
+    shape = (13, 11, 10)
+    ref = write_image(tmp_path / 'ref.nii.gz', np.zeros(shape), 1.0)
+    warp = write_warp(tmp_path / 'warp.nii.gz', shape, 1.0)
+    return {'shape': shape, 'affine': ref.affine, 'zooms': (1.0, 1.0, 1.0),
+            'ref_path': str(tmp_path / 'ref.nii.gz'), 'ref': ref, 'warp': warp}
+
+
+def test_operator_larger_than_the_cache_is_returned_uncached(grid, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    operator, out_shape, out_affine = cached_sampling_operator(
+        cache_dir, grid['shape'], grid['affine'], grid['zooms'], grid['ref_path'], grid['warp'], max_bytes=100,
+    )
+    expected, expected_shape, expected_affine = build_sampling_operator(
+        grid['shape'], grid['affine'], grid['zooms'], grid['ref'], grid['warp'],
+    )
+    assert out_shape == expected_shape
+    np.testing.assert_allclose(out_affine, expected_affine)
+    assert (operator != expected).nnz == 0
+    # The oversized entry was evicted on publication, as ArrayCache does
+    assert ArrayCache(cache_dir, max_bytes=100).entries() == []
+
+
+def test_cached_operator_is_reused(grid, tmp_path):
+    cache_dir, local_dir = str(tmp_path / 'cache'), str(tmp_path / 'local')
+    args = (grid['shape'], grid['affine'], grid['zooms'], grid['ref_path'], grid['warp'])
+    first = cached_sampling_operator(cache_dir, *args, local_cache_dir=local_dir)
+    second = cached_sampling_operator(cache_dir, *args, local_cache_dir=local_dir)
+    assert first[1] == second[1]
+    assert (first[0] != second[0]).nnz == 0
+
+
+def apply(operator, out_shape, data):
+    """Operator applied to a 3D volume, reshaped onto the output grid."""
+    return (operator @ data.ravel()).reshape(out_shape)
+
+
+@pytest.mark.parametrize('interp', ['trilinear', 'nearest'])
+def test_zero_warp_is_the_nearest_downsample(grid, interp):
+    data = np.random.default_rng(0).random(grid['shape']).astype(np.float32)
+    operator, out_shape, out_affine = build_sampling_operator(
+        grid['shape'], grid['affine'], grid['zooms'], grid['ref'], grid['warp'], voxel_size=3.0, interp=interp,
+    )
+    expected, expected_affine = resample_isotropic_nearest(data, grid['affine'], grid['zooms'], 3.0)
+    assert out_shape == expected.shape
+    np.testing.assert_allclose(out_affine, expected_affine)
+    np.testing.assert_allclose(apply(operator, out_shape, data), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('sign', [-1, 1])
+@pytest.mark.parametrize('axis', [0, 1, 2])
+def test_one_voxel_shift_moves_the_data_by_one_voxel(tmp_path, axis, sign):
+    shape = (9, 8, 7)
+    data = np.random.default_rng(1).random(shape).astype(np.float32)
+    ref = write_image(tmp_path / 'ref.nii.gz', np.zeros(shape), 2.0, sign)
+    displacement = [0.0, 0.0, 0.0]
+    displacement[axis] = 2.0
+    warp = write_warp(tmp_path / 'warp.nii.gz', shape, 2.0, displacement, sign)
+
+    operator, out_shape, _ = build_sampling_operator(shape, ref.affine, (2.0,) * 3, ref, warp, voxel_size=None)
+
+    # +2 mm along FSL's x axis is one voxel towards lower indices when FSL flips x (positive determinant)
+    step = -1 if axis == 0 and sign > 0 else 1
+    expected = np.zeros(shape, dtype=np.float32)
+    target = [slice(None)] * 3
+    source = [slice(None)] * 3
+    target[axis], source[axis] = (slice(0, -1), slice(1, None)) if step == 1 else (slice(1, None), slice(0, -1))
+    expected[tuple(target)] = data[tuple(source)]
+    # The voxels sampled from outside the field of view are zero
+    np.testing.assert_allclose(apply(operator, out_shape, data), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('interp', ['trilinear', 'nearest'])
+def test_composed_operator_equals_warp_then_downsample(tmp_path, interp):
+    # A 2mm input warped onto a 1mm reference by a smooth field, then downsampled to 3mm
+    in_shape, ref_shape = (8, 9, 7), (16, 17, 14)
+    data = np.random.default_rng(2).random(in_shape).astype(np.float32)
+    in_affine = radiological_affine(2.0)
+    ref = write_image(tmp_path / 'ref.nii.gz', np.zeros(ref_shape), 1.0)
+    grid = np.indices(ref_shape, dtype=np.float32)
+    field = np.stack([0.7 * np.sin(grid[1] / 3), 1.3 * np.cos(grid[2] / 4), 0.4 * grid[0] / ref_shape[0]], axis=-1)
+    warp_img = nib.Nifti1Image(field.astype(np.float32), radiological_affine(1.0))
+    warp_img.header['intent_code'] = FSL_FNIRT_DISPLACEMENT_FIELD
+    warp = str(tmp_path / 'warp.nii.gz')
+    nib.save(warp_img, warp)
+
+    warp_only, ref_grid, _ = build_sampling_operator(
+        in_shape, in_affine, (2.0,) * 3, ref, warp, voxel_size=None, interp=interp
+    )
+    warped = apply(warp_only, ref_grid, data)
+    expected, expected_affine = resample_isotropic_nearest(warped, ref.affine, (1.0,) * 3, 3.0)
+
+    composed, out_shape, out_affine = build_sampling_operator(
+        in_shape, in_affine, (2.0,) * 3, ref, warp, voxel_size=3.0, interp=interp
+    )
+    assert out_shape == expected.shape
+    np.testing.assert_allclose(out_affine, expected_affine)
+    np.testing.assert_allclose(apply(composed, out_shape, data), expected, rtol=1e-6)
+    assert np.count_nonzero(expected) > 0.5 * expected.size
+
+
+def sample(idx, weights, volume):
+    """Values interpolated with the given flat indices and weights."""
+    return np.sum(weights * volume.ravel()[idx], axis=1)
+
+
+def test_trilinear_weights_match_map_coordinates():
+    ndimage = pytest.importorskip('scipy.ndimage')
+    shape = (6, 7, 5)
+    rng = np.random.default_rng(3)
+    volume = rng.random(shape)
+    # Interior points, points on every face including the last voxel n - 1, and the corners
+    coords = np.vstack([
+        rng.random((500, 3)) * (np.array(shape) - 1),
+        np.column_stack([np.full(20, shape[0] - 1), rng.random(20) * (shape[1] - 1), rng.random(20) * (shape[2] - 1)]),
+        np.column_stack([rng.random(20) * (shape[0] - 1), np.zeros(20), np.full(20, shape[2] - 1)]),
+        np.array([[0, 0, 0], np.array(shape) - 1]),
+    ])
+    idx, weights = trilinear_weights(coords, shape)
+    np.testing.assert_allclose(weights.sum(axis=1), 1, rtol=1e-6)
+    expected = ndimage.map_coordinates(volume, coords.T, order=1)
+    np.testing.assert_allclose(sample(idx, weights, volume), expected, rtol=1e-6)
+
+
+def test_trilinear_weights_at_the_last_voxel():
+    shape = (4, 3, 5)
+    corner = np.array([[3.0, 2.0, 4.0]])
+    idx, weights = trilinear_weights(corner, shape)
+    np.testing.assert_allclose(weights[0][idx[0] == np.ravel_multi_index((3, 2, 4), shape)].sum(), 1)
+
+
+def test_trilinear_weights_are_zero_outside_the_field_of_view():
+    shape = (4, 3, 5)
+    outside = np.array([[-0.01, 1, 1], [3.01, 1, 1], [1, -1, 1], [1, 2.5, 1], [1, 1, 4.2], [-5, -5, -5]])
+    _, weights = trilinear_weights(outside, shape)
+    assert not weights.any()
+
+
+def test_nearest_weights():
+    shape = (4, 3, 5)
+    volume = np.arange(np.prod(shape), dtype=np.float64).reshape(shape)
+    coords = np.array([[0.4, 0.6, 1.49], [3.4, 2.3, 4.49], [-0.4, 0, 0], [1.2, 1.7, 2.5]])
+    idx, weights = nearest_weights(coords, shape)
+    assert idx.shape == weights.shape == (4, 1)
+    expected = [volume[0, 1, 1], volume[3, 2, 4], volume[0, 0, 0], volume[1, 2, 3]]
+    np.testing.assert_array_equal(sample(idx, weights, volume), expected)
+    # Rounding past either end of an axis samples zero
+    outside = np.array([[3.5, 1, 1], [-0.6, 1, 1], [1, 2.5, 1], [1, 1, -0.51]])
+    _, weights = nearest_weights(outside, shape)
+    assert not weights.any()
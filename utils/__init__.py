@@ -1,3 +1,3 @@
 # utils/__init__.py
 from .dir_utils import make_dirs, move_files
-from .inspect_utils import load_and_inspect_file
+from .inspect_utils import inspect_files, load_and_inspect_file
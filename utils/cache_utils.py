@@ -0,0 +1,194 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy as np
+
+# In-process memo of file digests, keyed by (path, size, mtime_ns)
+_digest_memo = {}
+
+
+def file_digest(path, block_size=1 << 20, memoize=True):
+    """
+    SHA-256 of a file's content, memoized per process while the file is unchanged.
+
+    Parameters
+    ----------
+    path : str
+        File to hash (e.g., 'standard2acpc_dc.nii.gz').
+    block_size : int
+        Read size in bytes.
+    memoize : bool
+        Reuse the digest of a file with the same size and mtime; False always
+        reads the file, e.g. to verify content that changed in place.
+
+    Returns
+    -------
+    str
+        Hex digest.
+    """
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if not memoize or memo_key not in _digest_memo:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        _digest_memo[memo_key] = sha.hexdigest()
+    return _digest_memo[memo_key]
+
+
+def cache_key(*parts):
+    """Stable hex key from strings, numbers and NumPy arrays."""
+    sha = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            sha.update(np.ascontiguousarray(part).tobytes())
+            sha.update(str(part.dtype).encode())
+        else:
+            sha.update(repr(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class ArrayCache:
+    """
+    Directory of named NumPy array bundles with size-bounded LRU eviction.
+
+    Each entry is a sub-directory ``<root>/<key>/`` holding one ``.npy`` per
+    array and a ``meta.json``. Entries are published with an atomic directory
+    rename, so concurrent jobs on shared scratch never see a partial entry,
+    and every hit refreshes the entry's mtime, which drives eviction.
+
+    Parameters
+    ----------
+    root : str
+        Cache directory; created if missing.
+    max_bytes : int, optional
+        Upper bound on the total size of all entries. ``None`` disables eviction.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key, mmap_mode=None):
+        """
+        Load an entry.
+
+        Returns
+        -------
+        (arrays, meta) or None
+            ``arrays`` maps names to arrays (memory-mapped if ``mmap_mode`` is
+            given); ``None`` on a cache miss.
+        """
+        entry_dir = self._entry_dir(key)
+        meta_file = os.path.join(entry_dir, 'meta.json')
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+                for name in meta['arrays']
+            }
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(meta_file)
+        return arrays, meta
+
+    def put(self, key, arrays, meta=None):
+        """
+        Store a bundle of arrays under ``key`` and evict old entries if needed.
+
+        If another job published the same key first, its entry is kept.
+        """
+        with self.staging(key, dict(meta or {})) as tmp_dir:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+
+    @contextmanager
+    def staging(self, key, meta=None):
+        """
+        Build an entry in place and publish it under ``key`` when the block succeeds.
+
+        Yields a private directory for the entry's '<name>.npy' files, e.g.
+        written with ``np.lib.format.open_memmap`` for arrays larger than
+        memory. ``meta`` may still be updated inside the block. The directory
+        is discarded if the block raises, and as in ``put`` an entry published
+        first by another job is kept.
+        """
+        meta = {} if meta is None else meta
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{key[:16]}.', dir=self.root)
+        try:
+            yield tmp_dir
+            meta['arrays'] = sorted(name[:-len('.npy')] for name in os.listdir(tmp_dir) if name.endswith('.npy'))
+            meta['created'] = time.time()
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # Entry already published by a concurrent job (or the write failed)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not os.path.isdir(self._entry_dir(key)):
+                raise
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self.evict()
+
+    @contextmanager
+    def lock(self, key):
+        """
+        Hold an exclusive lock for building ``key``.
+
+        Workers that miss the same entry at the same time wait here instead of
+        each loading the inputs and building their own copy; after acquiring
+        the lock, check ``get`` again before building.
+        """
+        with open(os.path.join(self.root, f'.{key[:16]}.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def invalidate(self, key):
+        """Remove one entry."""
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def entries(self):
+        """List (key, size_bytes, last_used) for every published entry."""
+        found = []
+        for name in os.listdir(self.root):
+            entry_dir = self._entry_dir(name)
+            meta_file = os.path.join(entry_dir, 'meta.json')
+            if name.startswith('.') or not os.path.isfile(meta_file):
+                continue
+            try:
+                size = sum(e.stat().st_size for e in os.scandir(entry_dir) if e.is_file())
+                found.append((name, size, os.stat(meta_file).st_mtime))
+            except OSError:
+                continue
+        return found
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits ``max_bytes``."""
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self.invalidate(key)
+            total -= size
+            logging.info(f"Evicted cache entry {key} ({size} bytes) from {self.root}")
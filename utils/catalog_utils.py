@@ -0,0 +1,376 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+from . import hcp_paths
+
+CATALOG_NAME = '.dataset_catalog.sqlite'
+
+# Kinds of catalogued files whose image header is recorded
+IMAGE_KINDS = ('dtseries', 'downsampled', 't1_ref', 'warp')
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY,
+        subject TEXT NOT NULL,
+        mtime_ns INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        dir TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        shape TEXT,
+        dtype TEXT,
+        tr REAL,
+        n_vols INTEGER,
+        affine TEXT,
+        updated REAL
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS files_subject_kind ON files (subject, kind)',
+]
+
+
+def run_name(phase, direction):
+    """Run key used by the catalog and the run manifest, e.g. 'phase1_LR'."""
+    return f'phase{phase}_{direction}'
+
+
+_RUNS_BY_NAME = {run_name(phase, direction): (phase, direction) for phase, direction in hcp_paths.RUNS}
+
+
+def subject_layout(subject_dir, subject_name):
+    """
+    Directories of one subject and how to recognise the catalogued files in them.
+
+    Returns
+    -------
+    list of (directory, classify)
+        ``classify(file_name)`` returns (kind, key) or None; kinds are
+        'dtseries' and 'downsampled' (key: run name), 't1_ref', 'warp'
+        (key: ''), 'label' (key: '<hemisphere>.<parcellation>') and 'coords'
+        (key: hemisphere). Paths follow ``utils.hcp_paths``.
+    """
+    layout = []
+    for phase, direction in hcp_paths.RUNS:
+        run = run_name(phase, direction)
+        names = {
+            os.path.basename(hcp_paths.dtseries_path(subject_dir, subject_name, phase, direction)): ('dtseries', run),
+            os.path.basename(hcp_paths.downsampled_path(subject_dir, subject_name, phase, direction)): ('downsampled', run),
+        }
+        layout.append((hcp_paths.results_dir(subject_dir, subject_name, phase, direction), names.get))
+    for kind, path in [('t1_ref', hcp_paths.t1_ref_path(subject_dir)),
+                       ('warp', hcp_paths.warp_path(subject_dir, subject_name))]:
+        layout.append((os.path.dirname(path), {os.path.basename(path): (kind, '')}.get))
+
+    label_pattern = re.compile(rf'{re.escape(subject_name)}\.([LR])\.(.+)\.32k_fs_LR\.label\.gii$')
+
+    def classify_label(name):
+        match = label_pattern.match(name)
+        return ('label', f'{match.group(1)}.{match.group(2)}') if match else None
+
+    layout.append((os.path.dirname(hcp_paths.label_gii_path(subject_dir, subject_name, 'L', '')), classify_label))
+    for hemisphere in hcp_paths.HEMISPHERES:
+        path = hcp_paths.coords_path(subject_dir, hemisphere)
+        layout.append((os.path.dirname(path), {os.path.basename(path): ('coords', hemisphere)}.get))
+    return layout
+
+
+def read_header(path):
+    """
+    Header-only properties of a NIfTI or CIFTI image (no voxel data is read).
+
+    Returns
+    -------
+    dict
+        'shape', 'dtype', 'tr' (seconds, None for 3D volumes), 'n_vols' and
+        'affine' (for CIFTI, the affine of the volume brain models, if any).
+    """
+    img = nib.load(path)
+    shape = [int(n) for n in img.shape]
+    info = {'shape': shape, 'dtype': str(img.get_data_dtype())}
+    if isinstance(img, nib.Cifti2Image):
+        brain_models = img.header.get_axis(1)
+        info['tr'] = float(img.header.get_axis(0).step)
+        info['n_vols'] = shape[0]
+        info['affine'] = brain_models.affine.tolist() if brain_models.affine is not None else None
+    else:
+        info['tr'] = float(img.header.get_zooms()[3]) if len(shape) > 3 else None
+        info['n_vols'] = shape[3] if len(shape) > 3 else 1
+        info['affine'] = img.affine.tolist()
+    return info
+
+
+class DatasetCatalog:
+    """
+    SQLite index of the HCP tree: which runs, label, warp and coordinates
+    files every subject has, with the header properties of the images.
+
+    ``refresh`` lists each subject's few known directories instead of
+    probing every expected path, and only re-lists a directory whose mtime
+    changed (files are added, removed or renamed into place) and only
+    re-reads the header of a file whose size or mtime changed, or whose
+    header could not be read before. Each subject is committed on its own,
+    so a long scan does not hold the write lock. Planning then queries the
+    catalog without touching the file system.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file, by default '<HCP>/.dataset_catalog.sqlite'.
+
+    Example
+    -------
+    >>> catalog = DatasetCatalog('/path/to/HCP/.dataset_catalog.sqlite')
+    >>> catalog.refresh('/path/to/HCP')
+    >>> catalog.subjects(min_runs=4, coords=['L', 'R'])
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def refresh(self, hcp_dir, subjects=None, read_headers=True, rescan=False, max_workers=8):
+        """
+        Bring the catalog up to date with the tree.
+
+        Parameters
+        ----------
+        hcp_dir : str
+            HCP root directory with one sub-directory per subject.
+        subjects : list of str, optional
+            Subjects to scan (default: every directory in ``hcp_dir``; the
+            entries of subjects no longer there are dropped).
+        read_headers : bool
+            Record shape, dtype, TR, number of volumes and affine of new or
+            changed images.
+        rescan : bool
+            Re-list every directory, also those with an unchanged mtime (to
+            pick up files rewritten in place).
+        max_workers : int
+            Threads reading image headers.
+
+        Returns
+        -------
+        dict
+            Counts of 'subjects', directories 'listed' and 'unchanged', and
+            files 'updated' and 'removed'.
+        """
+        full = subjects is None
+        if full:
+            subjects = sorted(name for name in os.listdir(hcp_dir) if os.path.isdir(os.path.join(hcp_dir, name)))
+        stats = {'subjects': len(subjects), 'listed': 0, 'unchanged': 0, 'updated': 0, 'removed': 0}
+        pending = []
+        conn = self._connect()
+        try:
+            if full:
+                with conn:
+                    # Drop subjects that are no longer in the tree
+                    gone = {row[0] for row in conn.execute('SELECT DISTINCT subject FROM dirs')} - set(subjects)
+                    for subject_name in gone:
+                        stats['removed'] += conn.execute('DELETE FROM files WHERE subject = ?',
+                                                         (subject_name,)).rowcount
+                        conn.execute('DELETE FROM dirs WHERE subject = ?', (subject_name,))
+            stored_dirs = dict(conn.execute('SELECT path, mtime_ns FROM dirs').fetchall())
+            for subject_name in subjects:
+                # One transaction per subject, so a whole-tree scan never holds the write lock for long
+                with conn:
+                    self._scan_subject(conn, hcp_dir, subject_name, stored_dirs, rescan, stats)
+            if read_headers:
+                # New or changed images, and those whose header could not be read (or was not
+                # requested) on an earlier refresh, whether or not their directory changed
+                selected = set(subjects)
+                pending = [
+                    path for path, subject_name in conn.execute(
+                        f"SELECT path, subject FROM files WHERE shape IS NULL "
+                        f"AND kind IN ({', '.join('?' * len(IMAGE_KINDS))}) ORDER BY path", IMAGE_KINDS
+                    ) if subject_name in selected
+                ]
+        finally:
+            conn.close()
+
+        if pending:
+            def header(path):
+                try:
+                    return path, read_header(path)
+                except Exception as e:
+                    logging.warning(f"Could not read the header of {path}: {e}")
+                    return path, None
+
+            with ThreadPoolExecutor(max_workers) as pool:
+                headers = list(pool.map(header, pending))
+            with self._connect() as conn:
+                for path, info in headers:
+                    if info is None:
+                        continue
+                    conn.execute(
+                        'UPDATE files SET shape = ?, dtype = ?, tr = ?, n_vols = ?, affine = ? WHERE path = ?',
+                        (json.dumps(info['shape']), info['dtype'], info['tr'], info['n_vols'],
+                         json.dumps(info['affine']), path),
+                    )
+        logging.info(f"Catalog refreshed: {stats}")
+        return stats
+
+    def _scan_subject(self, conn, hcp_dir, subject_name, stored_dirs, rescan, stats):
+        """
+        Update the directories of one subject whose mtime changed, and their files.
+
+        A new or changed file is stored without header properties, which
+        ``refresh`` then reads.
+        """
+        subject_dir = os.path.join(hcp_dir, subject_name)
+        for directory, classify in subject_layout(subject_dir, subject_name):
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                mtime_ns = None
+            if not rescan and directory in stored_dirs and stored_dirs[directory] == mtime_ns:
+                stats['unchanged'] += 1
+                continue
+            stats['listed'] += 1
+            known = {
+                path: (size, mtime) for path, size, mtime in
+                conn.execute('SELECT path, size, mtime_ns FROM files WHERE dir = ?', (directory,))
+            }
+            seen = set()
+            for name in (os.listdir(directory) if mtime_ns is not None else []):
+                match = classify(name)
+                if match is None:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                seen.add(path)
+                if known.get(path) == (st.st_size, st.st_mtime_ns):
+                    continue
+                kind, key = match
+                conn.execute(
+                    'INSERT OR REPLACE INTO files (path, dir, subject, kind, key, size, mtime_ns, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (path, directory, subject_name, kind, key, st.st_size, st.st_mtime_ns, time.time()),
+                )
+                stats['updated'] += 1
+            for path in set(known) - seen:
+                conn.execute('DELETE FROM files WHERE path = ?', (path,))
+                stats['removed'] += 1
+            conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (directory, subject_name, mtime_ns))
+
+    def files(self, subject=None, kind=None, key=None):
+        """Catalogued files as dicts, optionally filtered by subject, kind and key."""
+        conditions, values = [], []
+        for column, value in [('subject', subject), ('kind', kind), ('key', key)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                values.append(value)
+        query = 'SELECT * FROM files' + (' WHERE ' + ' AND '.join(conditions) if conditions else '')
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query + ' ORDER BY subject, kind, key', values).fetchall()
+        records = []
+        for row in rows:
+            record = dict(row)
+            record['shape'] = json.loads(record['shape']) if record['shape'] else None
+            record['affine'] = json.loads(record['affine']) if record['affine'] else None
+            records.append(record)
+        return records
+
+    def path(self, subject, kind, key=''):
+        """Path of one catalogued file, or None if the subject does not have it."""
+        records = self.files(subject, kind, key)
+        return records[0]['path'] if records else None
+
+    def runs(self, subjects=None, kind='dtseries', min_volumes=None):
+        """
+        (subject, phase, direction) of every run with a file of ``kind``.
+
+        Parameters
+        ----------
+        subjects : list of str, optional
+            Restrict to these subjects.
+        kind : {'dtseries', 'downsampled'}
+            Dense time series or registered volume.
+        min_volumes : int, optional
+            Only runs with at least this many time points.
+        """
+        selected = set(subjects) if subjects is not None else None
+        runs = [
+            (record['subject'], *_RUNS_BY_NAME[record['key']])
+            for record in self.files(kind=kind)
+            if (selected is None or record['subject'] in selected)
+            and (min_volumes is None or (record['n_vols'] or 0) >= min_volumes)
+        ]
+        return sorted(runs, key=lambda run: (run[0], hcp_paths.RUNS.index(run[1:])))
+
+    def subjects(self, min_runs=0, kind='dtseries', min_volumes=None, coords=(), parcellations=(), require=()):
+        """
+        Subjects meeting all the given conditions.
+
+        Parameters
+        ----------
+        min_runs : int
+            Minimum number of runs with a file of ``kind`` (see ``runs``).
+        kind : {'dtseries', 'downsampled'}
+            File that makes a run complete.
+        min_volumes : int, optional
+            Only count runs with at least this many time points.
+        coords : list of str
+            Hemispheres whose coordinates files must exist, e.g. ['L', 'R'].
+        parcellations : list of str
+            Parcellations whose label files must exist for both hemispheres.
+        require : list of str
+            Other kinds that must exist, e.g. ['warp', 't1_ref'].
+
+        Example
+        -------
+        >>> catalog.subjects(min_runs=4, coords=['L', 'R'])  # four complete runs and both coords files
+        """
+        by_subject = defaultdict(lambda: defaultdict(dict))
+        for record in self.files():
+            by_subject[record['subject']][record['kind']][record['key']] = record
+        selected = []
+        for subject_name, kinds in sorted(by_subject.items()):
+            runs = [r for r in kinds[kind].values() if min_volumes is None or (r['n_vols'] or 0) >= min_volumes]
+            if len(runs) < min_runs:
+                continue
+            if any(hemisphere not in kinds['coords'] for hemisphere in coords):
+                continue
+            if any(f'{hemisphere}.{parcellation}' not in kinds['label']
+                   for parcellation in parcellations for hemisphere in hcp_paths.HEMISPHERES):
+                continue
+            if any(not kinds[required] for required in require):
+                continue
+            selected.append(subject_name)
+        return selected
+
+    def summary(self):
+        """Count of catalogued files per kind."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT kind, COUNT(*) FROM files GROUP BY kind').fetchall()
+        return dict(rows)
+
+
+def group_runs(runs):
+    """(subject, phase, direction) runs -> [(subject, [(phase, direction), ...]), ...] in subject order."""
+    grouped = defaultdict(list)
+    for subject_name, phase, direction in runs:
+        grouped[subject_name].append((phase, direction))
+    return sorted(grouped.items())
@@ -0,0 +1,187 @@
+import logging
+import nibabel as nib
+import numpy as np
+from .io_utils import atomic_output
+
+CORTEX_LEFT = 'CIFTI_STRUCTURE_CORTEX_LEFT'
+CORTEX_RIGHT = 'CIFTI_STRUCTURE_CORTEX_RIGHT'
+
+# GIFTI AnatomicalStructurePrimary values written by wb_command
+_GIFTI_STRUCTURES = {
+    CORTEX_LEFT: 'CortexLeft',
+    CORTEX_RIGHT: 'CortexRight',
+}
+
+
+def load_dense_time_series(dtseries_path):
+    """
+    Load a CIFTI-2 dense time series (.dtseries.nii) once.
+
+    Parameters
+    ----------
+    dtseries_path : str
+        Path to the dense time series
+        (e.g., 'rfMRI_REST1_LR_Atlas_hp2000_clean.dtseries.nii').
+
+    Returns
+    -------
+    data : np.ndarray
+        float32 array of shape (num_timepoints, num_grayordinates).
+    brain_models : nib.cifti2.BrainModelAxis
+        Column axis describing which grayordinate belongs to which structure.
+    series : nib.cifti2.SeriesAxis
+        Row axis (time); ``series.step`` is the repetition time.
+    """
+    dataobj, brain_models, series = open_dense_time_series(dtseries_path)
+    data = np.asanyarray(dataobj).astype(np.float32, copy=False)
+    return data, brain_models, series
+
+
+def open_dense_time_series(dtseries_path):
+    """
+    Open a CIFTI-2 dense time series without reading its data.
+
+    Returns
+    -------
+    dataobj : nibabel ArrayProxy
+        Lazy array of shape (num_timepoints, num_grayordinates);
+        ``dataobj[start:stop]`` reads only those time points (one short
+        strided read per grayordinate, as time varies fastest on disk).
+    brain_models, series
+        As in ``load_dense_time_series``.
+    """
+    img = nib.load(dtseries_path, keep_file_open=True)
+    return img.dataobj, img.header.get_axis(1), img.header.get_axis(0)
+
+
+def surface_time_series(data, brain_models, structure):
+    """
+    Scatter the grayordinates of one surface structure onto its full mesh.
+
+    Vertices that are not part of the CIFTI file (the medial wall) are zero,
+    matching the metric written by ``wb_command -cifti-separate -metric``.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (num_vertices, num_timepoints).
+    """
+    for name, slc, bm in brain_models.iter_structures():
+        if name == structure:
+            surface = np.zeros((bm.nvertices[structure], data.shape[0]), dtype=data.dtype)
+            surface[bm.vertex] = data[:, slc].T
+            return surface
+    raise ValueError(f"Structure {structure} not found in CIFTI brain models")
+
+
+def volume_time_series(data, brain_models):
+    """
+    Scatter all volumetric grayordinates into a 4D array.
+
+    Voxels outside the CIFTI volume structures are zero, matching the volume
+    written by ``wb_command -cifti-separate -volume-all``.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (x, y, z, num_timepoints) on ``brain_models.volume_shape``.
+    """
+    mask = brain_models.volume_mask
+    ijk = brain_models.voxel[mask]
+    volume = np.zeros(tuple(brain_models.volume_shape) + (data.shape[0],), dtype=data.dtype)
+    volume[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = data[:, mask].T
+    return volume
+
+
+def volume_columns(brain_models):
+    """
+    Grayordinate columns of the volumetric structures and their voxels, in voxel order.
+
+    ``data[:, columns].T`` holds exactly the non-zero rows of
+    ``volume_time_series(data, brain_models)`` flattened in C order, so an
+    operator over the volume restricted to ``flat_voxels`` applies to the
+    dense time series directly, without building the 4D array.
+
+    Returns
+    -------
+    columns : np.ndarray
+        Grayordinate indices of shape (num_voxels,).
+    flat_voxels : np.ndarray
+        Ascending flat (C-order) voxel indices on ``brain_models.volume_shape``.
+    """
+    columns = np.flatnonzero(brain_models.volume_mask)
+    flat_voxels = np.ravel_multi_index(brain_models.voxel[columns].T, tuple(brain_models.volume_shape))
+    order = np.argsort(flat_voxels)
+    return columns[order], flat_voxels[order]
+
+
+def separate_dense_data(data, brain_models, tr=None, surfaces=True, volume=True):
+    """
+    Split an in-memory dense time series into cortex and subcortical arrays.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Array of shape (num_timepoints, num_grayordinates).
+    brain_models : nib.cifti2.BrainModelAxis
+        Column axis of the dense time series.
+    tr : float, optional
+        Repetition time in seconds, carried through to the result.
+    surfaces, volume : bool
+        Which parts to separate; skipping one avoids its scatter copy.
+
+    Returns
+    -------
+    separated : dict
+        Keys 'cortex_left' and 'cortex_right' (num_vertices, num_timepoints),
+        'volume' (x, y, z, num_timepoints), 'affine' (4x4 voxel-to-world of
+        the volume) and 'tr'. Parts that were not requested are omitted.
+    """
+    separated = {'affine': brain_models.affine, 'tr': tr}
+    if surfaces:
+        separated['cortex_left'] = surface_time_series(data, brain_models, CORTEX_LEFT)
+        separated['cortex_right'] = surface_time_series(data, brain_models, CORTEX_RIGHT)
+    if volume:
+        separated['volume'] = volume_time_series(data, brain_models)
+    return separated
+
+
+def separate_cifti(dtseries_path, surfaces=True, volume=True):
+    """
+    In-process replacement for ``wb_command -cifti-separate ... COLUMN``.
+
+    The dense time series is read once and split in memory into left cortex,
+    right cortex and subcortical volume arrays. See ``separate_dense_data``
+    for the layout of the returned dictionary.
+    """
+    data, brain_models, series = load_dense_time_series(dtseries_path)
+    logging.info(f"Loaded {dtseries_path} with shape {data.shape}")
+    return separate_dense_data(data, brain_models, tr=series.step, surfaces=surfaces, volume=volume)
+
+
+def save_volume(separated, output_file):
+    """Write the separated subcortical volume as a 4D NIfTI file."""
+    img = nib.Nifti1Image(separated['volume'], separated['affine'])
+    img.header.set_xyzt_units('mm', 'sec')
+    if separated.get('tr') is not None:
+        zooms = img.header.get_zooms()
+        img.header.set_zooms(zooms[:3] + (separated['tr'],))
+    with atomic_output(output_file) as tmp_file:
+        nib.save(img, tmp_file)
+    logging.info(f"Saved volume to {output_file}")
+
+
+def save_metric(surface_data, structure, output_file):
+    """Write one separated surface as a .func.gii with one darray per time point."""
+    meta = nib.gifti.GiftiMetaData({'AnatomicalStructurePrimary': _GIFTI_STRUCTURES[structure]})
+    darrays = [
+        nib.gifti.GiftiDataArray(
+            np.ascontiguousarray(column, dtype=np.float32),
+            intent='NIFTI_INTENT_NONE',
+            datatype='NIFTI_TYPE_FLOAT32',
+        )
+        for column in surface_data.T
+    ]
+    with atomic_output(output_file) as tmp_file:
+        nib.save(nib.gifti.GiftiImage(meta=meta, darrays=darrays), tmp_file)
+    logging.info(f"Saved metric to {output_file}")
@@ -0,0 +1,297 @@
+import logging
+import os
+import numpy as np
+from .qc_utils import load_qc, qc_failures
+from .store_utils import iter_run_dirs, list_regions, load_time_series, provenance, write_time_series
+
+# Output directory, next to the run directories, of the connectivity averaged over runs
+MEAN_RUN = 'all_runs'
+
+# |r| is capped just below 1 before the Fisher transform so perfect correlations stay finite
+FISHER_Z_LIMIT = np.float32(1 - 1e-6)
+
+
+def connectivity_region(hemisphere, parcellation):
+    """Store region name of one striatum hemisphere x cortical parcellation matrix."""
+    return f'connectivity_striatum_{hemisphere}_{parcellation}'
+
+
+def zscore(data):
+    """
+    Standardize every row over time in float32 (mean 0, standard deviation 1, ddof=0).
+
+    Rows without variance (and rows containing NaN, e.g. out-of-bounds
+    voxels) become NaN, so their correlations are NaN.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    centered = data - data.mean(axis=1, keepdims=True, dtype=np.float64).astype(np.float32)
+    std = np.sqrt(np.mean(np.square(centered), axis=1, keepdims=True, dtype=np.float64)).astype(np.float32)
+    std[~(std > 0)] = np.nan
+    centered /= std
+    return centered
+
+
+def correlation_matrix(x, y):
+    """
+    Pearson correlations between every row of ``x`` and every row of ``y``.
+
+    Both inputs are z-scored in float32 and multiplied once (a single BLAS
+    matmul), so the cost is one (n, T) x (T, m) product.
+
+    Parameters
+    ----------
+    x : np.ndarray
+        Shape (n, num_timepoints), e.g. striatal voxel time series.
+    y : np.ndarray
+        Shape (m, num_timepoints), e.g. cortical parcel averages.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape (n, m).
+    """
+    if x.shape[1] != y.shape[1]:
+        raise ValueError(f"Time series of different lengths: {x.shape[1]} and {y.shape[1]}")
+    r = zscore(x) @ zscore(y).T
+    r /= np.float32(x.shape[1])
+    np.clip(r, -1, 1, out=r)
+    return r
+
+
+def fisher_z(r):
+    """Fisher z-transform ``arctanh(r)`` in place (float32)."""
+    np.clip(r, -FISHER_Z_LIMIT, FISHER_Z_LIMIT, out=r)
+    return np.arctanh(r, out=r)
+
+
+def cortex_columns(parcels_by_hemisphere):
+    """
+    Concatenate the parcels of both hemispheres of one parcellation.
+
+    Parameters
+    ----------
+    parcels_by_hemisphere : dict
+        Hemisphere -> ParcelTimeSeries (or (data, label_ids, label_names)).
+
+    Returns
+    -------
+    data : np.ndarray
+        Shape (num_parcels, num_timepoints), left hemisphere first.
+    columns : dict
+        'label_ids', 'label_names' and 'hemispheres' of the rows of ``data``.
+    """
+    blocks, columns = [], {'label_ids': [], 'label_names': [], 'hemispheres': []}
+    for hemisphere in sorted(parcels_by_hemisphere):
+        label_ids, label_names, data = parcels_by_hemisphere[hemisphere]
+        blocks.append(np.asarray(data, dtype=np.float32))
+        columns['label_ids'] += [int(label_id) for label_id in label_ids]
+        columns['label_names'] += list(label_names)
+        columns['hemispheres'] += [hemisphere] * len(label_ids)
+    return np.concatenate(blocks), columns
+
+
+def run_connectivity(striatum, cortex, fisher=True):
+    """
+    Striatum x cortex correlation matrices of one run.
+
+    Parameters
+    ----------
+    striatum : dict
+        Hemisphere -> voxel time series of shape (num_voxels, num_timepoints).
+    cortex : dict
+        Parcellation name -> hemisphere -> ParcelTimeSeries.
+    fisher : bool
+        Fisher z-transform the correlations.
+
+    Returns
+    -------
+    dict
+        Region name (``connectivity_region``) -> (matrix, columns), with
+        matrix of shape (num_voxels, num_parcels) and columns as in
+        ``cortex_columns``.
+    """
+    matrices = {}
+    for parcellation, parcels_by_hemisphere in cortex.items():
+        cortex_data, columns = cortex_columns(parcels_by_hemisphere)
+        for hemisphere, voxel_data in striatum.items():
+            r = correlation_matrix(voxel_data, cortex_data)
+            matrices[connectivity_region(hemisphere, parcellation)] = (fisher_z(r) if fisher else r, columns)
+    return matrices
+
+
+def load_run_time_series(run_dir, hemispheres, parcellations):
+    """
+    Read a run's stored striatum and cortex time series back from the output store.
+
+    Returns
+    -------
+    striatum : dict
+        Hemisphere -> (data, meta) of the stored 'striatum_<hemisphere>'.
+    cortex : dict
+        Parcellation -> hemisphere -> (label_ids, label_names, data).
+    """
+    striatum = {}
+    for hemisphere in hemispheres:
+        data, meta = load_time_series(run_dir, f'striatum_{hemisphere}')
+        striatum[hemisphere] = (np.asarray(data, dtype=np.float32), meta)
+    cortex = {}
+    for parcellation in parcellations:
+        cortex[parcellation] = {}
+        for hemisphere in hemispheres:
+            data, meta = load_time_series(run_dir, f'cortex_{hemisphere}_{parcellation}')
+            cortex[parcellation][hemisphere] = (meta['label_ids'], meta['label_names'], np.asarray(data))
+    return striatum, cortex
+
+
+def write_connectivity(run_dir, matrices, coords_by_hemisphere=None, in_bounds_by_hemisphere=None, meta=None,
+                       backend='auto'):
+    """
+    Store connectivity matrices with one row per striatal voxel.
+
+    The cortical parcel of every column is recorded in the metadata as
+    'column_label_ids', 'column_label_names' and 'column_hemispheres'.
+
+    Returns
+    -------
+    list of str
+        Paths of the written arrays.
+    """
+    outputs = []
+    for region, (matrix, columns) in matrices.items():
+        hemisphere = region.split('_')[2]
+        region_meta = {f'column_{key}': value for key, value in columns.items()}
+        if in_bounds_by_hemisphere and hemisphere in in_bounds_by_hemisphere:
+            region_meta['in_bounds'] = np.asarray(in_bounds_by_hemisphere[hemisphere]).tolist()
+        region_meta.update(meta or {})
+        outputs.append(write_time_series(
+            run_dir, region, matrix,
+            coords=(coords_by_hemisphere or {}).get(hemisphere), meta=region_meta, backend=backend,
+        ))
+    return outputs
+
+
+def average_runs(run_dirs, out_dir, backend='auto'):
+    """
+    Average every connectivity matrix over the runs that have it.
+
+    With Fisher-z matrices this is the average in z space. A voxel that is
+    NaN in any run stays NaN.
+
+    Parameters
+    ----------
+    run_dirs : dict
+        Run name (e.g. 'phase1_LR') -> run directory.
+    out_dir : str
+        Output directory, '<subject>/fMRI/all_runs' by default in
+        ``subject_connectivity``.
+
+    Returns
+    -------
+    list of str
+        Paths of the written averages.
+    """
+    by_region = {}
+    for run, run_dir in sorted(run_dirs.items()):
+        for region in list_regions(run_dir):
+            if region.startswith('connectivity_'):
+                by_region.setdefault(region, []).append((run, run_dir))
+    outputs = []
+    for region, runs in by_region.items():
+        total, meta = None, None
+        for run, run_dir in runs:
+            data, run_meta = load_time_series(run_dir, region)
+            if total is None:
+                total, meta = np.array(data, dtype=np.float32), run_meta
+            elif data.shape != total.shape:
+                raise ValueError(f"{region} of run {run} has shape {data.shape}, expected {total.shape}")
+            else:
+                total += data
+            if hasattr(data, 'file'):
+                data.file.close()
+        total /= np.float32(len(runs))
+        coords = meta.pop('coords', None)
+        meta['runs'] = [run for run, _ in runs]
+        outputs.append(write_time_series(out_dir, region, total, coords=coords, meta=meta, backend=backend))
+    return outputs
+
+
+def subject_connectivity(subject_dir, parcellations, hemispheres=('L', 'R'), fisher=True, backend='auto',
+                         recompute=True, qc_thresholds=None):
+    """
+    Connectivity of every run of one subject from its stored time series, and their average.
+
+    Parameters
+    ----------
+    subject_dir : str
+        '<HCP>/<subject>'.
+    parcellations : list of str
+        Cortical parcellations, e.g. ['aparc.a2009s', 'aparc'].
+    recompute : bool
+        Recompute the per-run matrices; otherwise only average the stored ones.
+    qc_thresholds : dict, optional
+        Leave out runs whose QC table fails these thresholds (see
+        ``utils.qc_utils.qc_failures``).
+
+    Returns
+    -------
+    list of str
+        Paths of the written per-run and averaged matrices.
+    """
+    hcp_dir, subject = os.path.split(subject_dir.rstrip(os.sep))
+    run_dirs = {run: run_dir for _, run, run_dir in iter_run_dirs(hcp_dir, [subject]) if run != MEAN_RUN}
+    if qc_thresholds:
+        for run, run_dir in list(run_dirs.items()):
+            failures = qc_failures(load_qc(run_dir), qc_thresholds)
+            if failures:
+                logging.warning(f"Leaving out {subject} {run}, which fails QC: {failures}")
+                del run_dirs[run]
+    outputs = []
+    if recompute:
+        for run, run_dir in run_dirs.items():
+            stored = list_regions(run_dir)
+            present = [h for h in hemispheres if f'striatum_{h}' in stored
+                       and all(f'cortex_{h}_{p}' in stored for p in parcellations)]
+            if not present:
+                continue
+            striatum, cortex = load_run_time_series(run_dir, present, parcellations)
+            matrices = run_connectivity({h: data for h, (data, _) in striatum.items()}, cortex, fisher)
+            outputs += write_connectivity(
+                run_dir, matrices,
+                coords_by_hemisphere={h: meta.get('coords') for h, (_, meta) in striatum.items()},
+                in_bounds_by_hemisphere={h: meta.get('in_bounds') for h, (_, meta) in striatum.items()
+                                         if meta.get('in_bounds') is not None},
+                meta={'fisher_z': fisher, 'provenance': provenance(source=run_dir)},
+                backend=backend,
+            )
+    outputs += average_runs(run_dirs, os.path.join(subject_dir, 'fMRI', MEAN_RUN), backend)
+    return outputs
+
+
+def cohort_connectivity(hcp_dir, subjects=None, parcellations=('aparc.a2009s', 'aparc'), fisher=True,
+                        backend='auto', qc_thresholds=None):
+    """
+    Compute striatum x cortex connectivity for many subjects from the output store.
+
+    Subjects are processed one at a time and their results written before
+    the next is read, so memory stays bounded by a single subject however
+    large the cohort; within a subject each run costs one float32 matmul per
+    (hemisphere, parcellation).
+
+    Returns
+    -------
+    dict
+        Subject -> written paths (an empty list if the subject has no stored
+        time series).
+    """
+    if subjects is None:
+        subjects = sorted(name for name in os.listdir(hcp_dir) if os.path.isdir(os.path.join(hcp_dir, name, 'fMRI')))
+    results = {}
+    for subject in subjects:
+        try:
+            results[subject] = subject_connectivity(os.path.join(hcp_dir, subject), parcellations, fisher=fisher,
+                                                    backend=backend, qc_thresholds=qc_thresholds)
+            logging.info(f"Connectivity of {subject}: {len(results[subject])} matrices")
+        except Exception:
+            logging.exception(f"Connectivity failed for subject: {subject}")
+            results[subject] = []
+    return results
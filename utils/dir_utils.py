@@ -1,55 +1,77 @@
+import argparse
+import fnmatch
+import gzip
+import logging
 import os
 import shutil
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 from zipfile import ZipFile
+import nibabel as nib
+from nibabel.fileholders import FileHolder
+from .io_utils import atomic_output
 
-def make_dirs():
-    # Define the paths
-    hcp_dir = '/home/test/lmq/data/HCP'
-    subject_names_file = '/home/test/lmq/HyperSeg/fMRI_Process/sub_ids'
+# Default locations
+HCP_DIR = '/home/test/lmq/data/HCP'
+SUBJECT_IDS_FILE = '/home/test/lmq/HyperSeg/fMRI_Process/sub_ids'
+DOWNLOADS_DIR = '/home/test/Downloads'
 
-    # Read subject names from the file
-    with open(subject_names_file, 'r') as file:
-        subject_names = [line.strip() for line in file.readlines()]
-
-    # Loop through each subject name
-    for subject_name in subject_names:
-        # Create the subject's directory in HCP
-        subject_hcp_dir = os.path.join(hcp_dir, subject_name)
-        # Have created before
-        # os.makedirs(subject_hcp_dir, exist_ok=True)
+# HCP packages ('<subject>_3T_<package>.zip'), each extracted to '<subject>/<subject>_3T_<package>/'
+PACKAGES = ['rfMRI_REST_fix', 'Structural_preproc']
 
-        # Create DTI and T1 folders in the subject's directory
-        fMRI_dir = os.path.join(subject_hcp_dir, 'fMRI')
-        os.makedirs(fMRI_dir, exist_ok=True)
+# Members the pipeline reads (see utils.hcp_paths); everything else stays in the archive
+INGEST_PATTERNS = {
+    'rfMRI_REST_fix': ['*/MNINonLinear/Results/rfMRI_REST*/*_Atlas_hp2000_clean.dtseries.nii'],
+    'Structural_preproc': ['*/MNINonLinear/xfms/*', '*/MNINonLinear/fsaverage_LR32k/*.label.gii'],
+}
 
+# Bytes per read when copying or checksumming members
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
 
-def move_files():
-    # Define the paths
-    downloads_dir = '/home/test/Downloads'
-    hcp_dir = '/home/test/lmq/data/HCP'
-    subject_names_file = '/home/test/lmq/HyperSeg/fMRI_Process/sub_ids'
 
-    # Read subject names from the file
+def read_subject_ids(subject_names_file=SUBJECT_IDS_FILE):
+    """Subject IDs listed one per line (blank lines are ignored)."""
     with open(subject_names_file, 'r') as file:
-        subject_names = [line.strip() for line in file.readlines()]
+        return [line.strip() for line in file if line.strip()]
+
+
+def make_dirs(hcp_dir=HCP_DIR, subject_names_file=SUBJECT_IDS_FILE, subjects=None):
+    """Create '<hcp_dir>/<subject>/fMRI' for the given subjects (default: those in ``subject_names_file``)."""
+    subject_names = subjects if subjects is not None else read_subject_ids(subject_names_file)
 
     # Loop through each subject name
     for subject_name in subject_names:
-        # Construct the source and destination paths for structural and diffusion zip files
-        fMRI_zip_src = os.path.join(downloads_dir, f'{subject_name}_3T_rfMRI_REST_fix.zip')
-        fMRI_zip_dest = os.path.join(hcp_dir, subject_name, f'{subject_name}_3T_rfMRI_REST_fix.zip')
+        # Create the fMRI output folder in the subject's directory
+        fMRI_dir = os.path.join(hcp_dir, subject_name, 'fMRI')
+        os.makedirs(fMRI_dir, exist_ok=True)
 
-        # Move the file if it exists in the source
-        if not os.path.exists(fMRI_zip_dest):
-            print(f'Move files for: {subject_name}')
 
-            # Move the files to their respective folders
-            shutil.move(fMRI_zip_src, fMRI_zip_dest)
+def move_files(downloads_dir=DOWNLOADS_DIR, hcp_dir=HCP_DIR, subject_names_file=SUBJECT_IDS_FILE, subjects=None,
+               packages=('rfMRI_REST_fix',), max_workers=4):
+    """
+    Move downloaded '<subject>_3T_<package>.zip' archives into their subject directories.
+
+    Archives already in place are left alone; moves run on ``max_workers``
+    threads (a cross-filesystem move is a copy).
+    """
+    subject_names = subjects if subjects is not None else read_subject_ids(subject_names_file)
+
+    def move(subject_name, package):
+        zip_src = os.path.join(downloads_dir, f'{subject_name}_3T_{package}.zip')
+        zip_dest = os.path.join(hcp_dir, subject_name, f'{subject_name}_3T_{package}.zip')
+        # Move the file if it exists in the source
+        if not os.path.exists(zip_dest) and os.path.exists(zip_src):
+            logging.info(f'Move files for: {subject_name}')
+            os.makedirs(os.path.dirname(zip_dest), exist_ok=True)
+            shutil.move(zip_src, zip_dest)
 
+    with ThreadPoolExecutor(max_workers) as pool:
+        list(pool.map(lambda args: move(*args), [(s, p) for s in subject_names for p in packages]))
 
-def unzip():
-    hcp_dir = '/home/test/lmq/data/HCP'
 
+def unzip(hcp_dir=HCP_DIR):
+    """Extract every subject's full rfMRI_REST_fix archive (see ``ingest`` for selective extraction)."""
     # Loop through each subject directory in the HCP directory
     for subject_name in os.listdir(hcp_dir):
         print(f'Unzip files for: {subject_name}')
@@ -69,3 +91,215 @@ def unzip():
             with ZipFile(fMRI_zip_path, 'r') as fMRI_zip:
                 fMRI_zip.extractall(fMRI_extract_dir)
 
+
+def package_zip_path(subject_dir, subject_name, package, zip_dir=None):
+    """'<subject>_3T_<package>.zip' in ``zip_dir`` or, by default, in the subject directory."""
+    return os.path.join(zip_dir or subject_dir, f'{subject_name}_3T_{package}.zip')
+
+
+def selected_members(zip_file, patterns):
+    """ZipInfo of the file members whose names match any of the glob ``patterns``."""
+    return [
+        info for info in zip_file.infolist()
+        if not info.is_dir() and any(fnmatch.fnmatch(info.filename, pattern) for pattern in patterns)
+    ]
+
+
+def file_crc32(path):
+    """CRC-32 of a file, as stored in zip headers."""
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def member_is_current(info, path):
+    """Whether ``path`` already holds the member (same size, then same CRC-32)."""
+    try:
+        if os.path.getsize(path) != info.file_size:
+            return False
+    except OSError:
+        return False
+    return file_crc32(path) == info.CRC
+
+
+def member_path(extract_dir, name):
+    """
+    Path a member extracts to, '<extract_dir>/<name>'.
+
+    Raises
+    ------
+    ValueError
+        If ``name`` is absolute or resolves outside ``extract_dir`` (e.g.
+        '../x', which a pattern's ``*`` matches since it also matches '/').
+    """
+    normalized = os.path.normpath(name.replace('\\', '/'))
+    if os.path.isabs(normalized) or os.path.splitdrive(normalized)[0] or normalized.split(os.sep)[0] == '..':
+        raise ValueError(f"Unsafe member name {name!r}")
+    root = os.path.realpath(extract_dir)
+    path = os.path.realpath(os.path.join(root, normalized))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Member {name!r} resolves outside {extract_dir}")
+    return path
+
+
+def extract_member(zip_file, info, extract_dir):
+    """
+    Stream one member to '<extract_dir>/<member name>' through a temporary file.
+
+    Member names are checked by ``member_path``; an absolute name or one
+    that resolves outside ``extract_dir`` raises ValueError.
+
+    Returns
+    -------
+    bool
+        False if an identical file was already present and nothing was written.
+    """
+    path = member_path(extract_dir, info.filename)
+    if member_is_current(info, path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zip_file.open(info) as src, atomic_output(path) as tmp_path, open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+    return True
+
+
+def ingest_subject(hcp_dir, subject_name, patterns=INGEST_PATTERNS, zip_dir=None):
+    """
+    Extract the members matching ``patterns`` from one subject's archives.
+
+    Returns
+    -------
+    dict
+        Counts of 'extracted' and 'skipped' members, 'bytes' written and
+        'missing' archives.
+    """
+    subject_dir = os.path.join(hcp_dir, subject_name)
+    stats = {'subject': subject_name, 'extracted': 0, 'skipped': 0, 'bytes': 0, 'missing': []}
+    for package, package_patterns in patterns.items():
+        zip_path = package_zip_path(subject_dir, subject_name, package, zip_dir)
+        if not os.path.exists(zip_path):
+            stats['missing'].append(zip_path)
+            continue
+        extract_dir = os.path.join(subject_dir, f'{subject_name}_3T_{package}')
+        with ZipFile(zip_path, 'r') as zip_file:
+            for info in selected_members(zip_file, package_patterns):
+                if extract_member(zip_file, info, extract_dir):
+                    stats['extracted'] += 1
+                    stats['bytes'] += info.file_size
+                else:
+                    stats['skipped'] += 1
+    logging.info(f"Ingested {subject_name}: {stats['extracted']} extracted ({stats['bytes'] / 1e9:.2f} GB), "
+                 f"{stats['skipped']} already present")
+    if stats['missing']:
+        logging.warning(f"Missing archives for {subject_name}: {stats['missing']}")
+    return stats
+
+
+def ingest(hcp_dir=HCP_DIR, subjects=None, patterns=INGEST_PATTERNS, zip_dir=None, max_workers=4):
+    """
+    Selectively extract the pipeline's inputs from every subject's HCP archives.
+
+    Only members matching ``patterns`` (dense time series, xfms and
+    fsaverage_LR32k label files by default) are extracted, members already
+    present with a matching CRC-32 are skipped, and subjects are processed on
+    ``max_workers`` threads (decompression and file I/O release the GIL, so
+    this sets the I/O parallelism).
+
+    Parameters
+    ----------
+    hcp_dir : str
+        HCP root directory; members go to '<subject>/<subject>_3T_<package>/'.
+    subjects : list of str, optional
+        Subjects to ingest (default: every directory in ``hcp_dir``).
+    patterns : dict
+        Package name -> glob patterns of member names.
+    zip_dir : str, optional
+        Directory holding the archives (e.g. the downloads directory); by
+        default each subject's own directory.
+    max_workers : int
+        Subjects ingested concurrently.
+
+    Returns
+    -------
+    list of dict
+        Per-subject statistics from ``ingest_subject``.
+    """
+    if subjects is None:
+        subjects = sorted(name for name in os.listdir(hcp_dir) if os.path.isdir(os.path.join(hcp_dir, name)))
+
+    def run(subject_name):
+        try:
+            return ingest_subject(hcp_dir, subject_name, patterns, zip_dir)
+        except Exception as e:
+            logging.exception(f"Failed to ingest subject: {subject_name}")
+            return {'subject': subject_name, 'error': repr(e)}
+
+    with ThreadPoolExecutor(max_workers) as pool:
+        return list(pool.map(run, subjects))
+
+
+def load_image_from_zip(zip_path, member):
+    """
+    Open an image stored in an archive without extracting it to disk.
+
+    NIfTI and CIFTI data are read lazily through the (seekable) member
+    stream, so slicing ``img.dataobj`` decompresses only up to the requested
+    bytes; GIFTI files are parsed in memory.
+
+    Parameters
+    ----------
+    zip_path : str
+        Archive, e.g. '100307_3T_rfMRI_REST_fix.zip'.
+    member : str
+        Member name, e.g.
+        '100307/MNINonLinear/Results/rfMRI_REST1_LR/rfMRI_REST1_LR_Atlas_hp2000_clean.dtseries.nii'.
+
+    Returns
+    -------
+    img : nibabel image
+    handle : contextlib.ExitStack
+        The open archive and member streams the image reads from. The caller
+        owns it and closes it (``with handle:`` or ``handle.close()``) once
+        done with the image; ``img.dataobj`` cannot be read afterwards. For
+        GIFTI files it is already closed.
+    """
+    handle = ExitStack()
+    try:
+        zip_file = handle.enter_context(ZipFile(zip_path, 'r'))
+        fileobj = handle.enter_context(zip_file.open(member))
+        if member.endswith('.gii'):
+            with handle:
+                return nib.GiftiImage.from_bytes(fileobj.read()), handle
+        if member.endswith('.gz'):
+            fileobj = handle.enter_context(gzip.GzipFile(fileobj=fileobj))
+        image_class = nib.Cifti2Image if member.endswith(('.dtseries.nii', '.dscalar.nii')) else nib.Nifti1Image
+        file_holder = FileHolder(filename=f'{zip_path}:{member}', fileobj=fileobj)
+        return image_class.from_file_map({'header': file_holder, 'image': file_holder}, mmap=False), handle
+    except BaseException:
+        handle.close()
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Selectively extract HCP archives for the pipeline")
+    parser.add_argument('--hcp-dir', default=HCP_DIR)
+    parser.add_argument('--subjects', nargs='+', help="Subject IDs (default: every directory in --hcp-dir)")
+    parser.add_argument('--subjects-file', help="File with one subject ID per line")
+    parser.add_argument('--zip-dir', help="Directory holding the archives (default: each subject directory)")
+    parser.add_argument('--workers', type=int, default=4, help="Subjects extracted concurrently")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    subjects = read_subject_ids(args.subjects_file) if args.subjects_file else args.subjects
+    if subjects is not None:
+        make_dirs(args.hcp_dir, subjects=subjects)
+    results = ingest(args.hcp_dir, subjects, zip_dir=args.zip_dir, max_workers=args.workers)
+    failed = [r['subject'] for r in results if 'error' in r]
+    logging.info(f"Ingested {len(results) - len(failed)} subjects; "
+                 f"{sum(r.get('bytes', 0) for r in results) / 1e9:.2f} GB extracted; failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+import fcntl
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from . import telemetry_utils as telemetry
+
+# Thread-count variables honoured by wb_command and the FSL tools (OpenMP) and by
+# the BLAS/ITK libraries they link; every command gets ``threads`` of each
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+
+# Environment of every command on top of the inherited one
+DEFAULT_ENV = {'FSLOUTPUTTYPE': 'NIFTI_GZ'}
+
+# Per-tool slot lock files, shared by all worker processes of a node
+DEFAULT_SLOT_DIR = os.path.join(tempfile.gettempdir(), 'hcp_exec_slots')
+
+# Lines of stderr kept in the exception and telemetry record of a failed command
+STDERR_TAIL_LINES = 20
+
+
+def tool_name(argv):
+    """Tool of a command, e.g. 'applywarp' for ['/usr/local/fsl/bin/applywarp', ...]."""
+    return os.path.basename(str(argv[0]))
+
+
+def estimate_costs(records):
+    """
+    Mean wall time per external tool and per stage from telemetry records.
+
+    Returns
+    -------
+    dict
+        Tool or stage name -> mean seconds per call, for ``Executor``'s
+        ``cost_estimates``.
+    """
+    totals = defaultdict(lambda: [0.0, 0])
+    for record in records:
+        if record.get('kind') == 'command' and record.get('returncode') == 0:
+            name = record['tool']
+        elif record.get('kind') == 'stage' and record.get('status') == 'done':
+            name = record['stage']
+        else:
+            continue
+        totals[name][0] += record['wall_s']
+        totals[name][1] += 1
+    return {name: total / count for name, (total, count) in totals.items()}
+
+
+def wait_process(proc, timeout=None, output=None):
+    """
+    Collect a process's output and reap it with ``os.wait4``, which also returns its resource usage.
+
+    ``Popen.communicate`` reaps the process without its rusage; here the
+    pipes are drained by threads while the process is polled. On a timeout
+    or an interrupt the process group (``start_new_session``) is killed and
+    reaped before the exception propagates.
+
+    Parameters
+    ----------
+    proc : subprocess.Popen
+        Started with text-mode stdout and stderr pipes.
+    timeout : float, optional
+        Seconds before ``subprocess.TimeoutExpired`` is raised.
+    output : dict, optional
+        Receives 'stdout', 'stderr' and 'rusage' (the child's, with
+        ``ru_maxrss`` its peak RSS in KB, which counts from the fork and so
+        is at least this process's RSS at the time), also when an exception
+        is raised.
+
+    Returns
+    -------
+    dict
+        ``output``; ``proc.returncode`` is set.
+    """
+    output = {} if output is None else output
+    output.update(stdout='', stderr='', rusage=None)
+
+    def drain(name, pipe):
+        output[name] = pipe.read()
+        pipe.close()
+
+    readers = [threading.Thread(target=drain, args=(name, pipe), daemon=True)
+               for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr))]
+    for reader in readers:
+        reader.start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    reaped = None
+    try:
+        while reaped is None:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                reaped = status, rusage
+            elif deadline is not None and time.monotonic() > deadline:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            else:
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+    except BaseException:
+        # Kill the whole process group so no tool outlives its run
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        reaped = os.wait4(proc.pid, 0)[1:]
+        raise
+    finally:
+        if reaped is not None:
+            proc.returncode = os.waitstatus_to_exitcode(reaped[0])
+            output['rusage'] = reaped[1]
+        for reader in readers:
+            reader.join()
+    return output
+
+
+class Executor:
+    """
+    Run external tools without a shell, with timeouts, bounded retries and per-tool concurrency limits.
+
+    Commands are argv lists, so paths are never re-parsed by a shell and long
+    file lists are passed as arguments. Every command runs in its own process
+    group with ``threads`` threads (``THREAD_ENV_VARS``) and
+    ``DEFAULT_ENV``; its stderr is logged line by line under the tool's name,
+    and its duration, exit code, attempt and peak RSS are recorded in
+    telemetry.
+
+    Concurrency limits hold across all processes of a node: a tool limited to
+    N runs only while its process holds one of N ``flock`` slot files in
+    ``slot_dir``, so pool workers queue for, e.g., applywarp instead of
+    oversubscribing the cores.
+
+    In dry-run mode nothing is executed: ``run`` and ``call`` only add a step
+    to ``plan``, linked to the earlier steps that produce its inputs, and
+    ``format_plan`` prints the resulting DAG with estimated costs.
+
+    Parameters
+    ----------
+    tool_limits : dict, optional
+        Tool name -> maximum concurrent invocations on this node.
+    threads : int
+        Threads per command.
+    env : dict, optional
+        Extra environment variables of every command.
+    timeout : float, optional
+        Seconds before a command's process group is killed (None waits forever).
+    retries : int
+        Re-runs of a failed or timed-out command before giving up.
+    retry_delay : float
+        Seconds before the first retry, doubled for every further one.
+    dry_run : bool
+        Plan instead of executing.
+    slot_dir : str
+        Directory of the slot lock files.
+    cost_estimates : dict, optional
+        Tool or stage name -> seconds per call, e.g. from ``estimate_costs``.
+    """
+
+    def __init__(self, tool_limits=None, threads=1, env=None, timeout=None, retries=0, retry_delay=10.0,
+                 dry_run=False, slot_dir=DEFAULT_SLOT_DIR, cost_estimates=None):
+        self.tool_limits = dict(tool_limits or {})
+        self.threads = int(threads)
+        self.env = {**DEFAULT_ENV, **(env or {})}
+        self.timeout = timeout
+        self.retries = int(retries)
+        self.retry_delay = retry_delay
+        self.dry_run = dry_run
+        self.slot_dir = slot_dir
+        self.cost_estimates = dict(cost_estimates or {})
+        self.plan = []
+        self._producers = {}
+
+    def command_env(self, env=None):
+        """Environment of a command: inherited, ``DEFAULT_ENV``, thread counts, then ``env``."""
+        return {
+            **os.environ, **self.env, **{name: str(self.threads) for name in THREAD_ENV_VARS}, **(env or {}),
+        }
+
+    @contextmanager
+    def slot(self, tool):
+        """Hold one of the tool's ``tool_limits`` slots on this node (no-op for unlimited tools)."""
+        limit = self.tool_limits.get(tool)
+        if not limit:
+            yield
+            return
+        os.makedirs(self.slot_dir, exist_ok=True)
+        waited = time.perf_counter()
+        while True:
+            for i in range(limit):
+                f = open(os.path.join(self.slot_dir, f'{tool}.{i}.lock'), 'w')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    f.close()
+                    continue
+                logging.debug(f"Acquired {tool} slot {i} after {time.perf_counter() - waited:.1f} s")
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                    f.close()
+                return
+            time.sleep(0.2)
+
+    def add_step(self, name, description, inputs=(), outputs=()):
+        """Add a step to ``plan`` after the steps producing its inputs; returns the step."""
+        inputs = [os.path.abspath(str(path)) for path in inputs]
+        step = {
+            'id': len(self.plan),
+            'name': name,
+            'description': description,
+            'inputs': inputs,
+            'outputs': [os.path.abspath(str(path)) for path in outputs],
+            'after': sorted({self._producers[path] for path in inputs if path in self._producers}),
+            'estimate_s': self.cost_estimates.get(name),
+        }
+        for path in step['outputs']:
+            self._producers[path] = step['id']
+        self.plan.append(step)
+        return step
+
+    def run(self, argv, inputs=(), outputs=(), timeout=None, retries=None, env=None):
+        """
+        Run one command; raise once it has failed ``retries`` + 1 times.
+
+        Parameters
+        ----------
+        argv : list
+            Program and arguments (converted to str); no shell is involved.
+        inputs, outputs : list of str, optional
+            Files the command reads and writes, which link the dry-run plan.
+        timeout, retries : optional
+            Override the executor's defaults for this command.
+        env : dict, optional
+            Extra environment variables of this command.
+
+        Returns
+        -------
+        str or None
+            The command's stdout (None in dry-run mode).
+
+        Raises
+        ------
+        subprocess.CalledProcessError
+            The command exited non-zero; ``stderr`` holds the tail of its stderr.
+        subprocess.TimeoutExpired
+            The command ran longer than ``timeout`` and was killed.
+        """
+        argv = [str(arg) for arg in argv]
+        tool = tool_name(argv)
+        if self.dry_run:
+            self.add_step(tool, ' '.join(argv), inputs, outputs)
+            return None
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logging.warning(f"Retrying {tool} in {delay:.0f} s (attempt {attempt + 1} of {retries + 1})")
+                time.sleep(delay)
+            try:
+                with self.slot(tool):
+                    return self._run_once(argv, tool, timeout, env, attempt)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+                if attempt == retries:
+                    raise
+
+    def _run_once(self, argv, tool, timeout, env, attempt):
+        start = time.perf_counter()
+        returncode, output = None, {}
+        try:
+            proc = subprocess.Popen(
+                argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                env=self.command_env(env), start_new_session=True,
+            )
+        except OSError:
+            telemetry.record_command(argv, time.perf_counter() - start, 127, attempt=attempt)
+            logging.error(f"Could not start {tool}: {' '.join(argv)}")
+            raise
+        try:
+            wait_process(proc, timeout, output)
+            returncode = proc.returncode
+        finally:
+            wall_s = time.perf_counter() - start
+            stderr = output.get('stderr') or ''
+            for line in stderr.splitlines():
+                logging.info(f"{tool}: {line}")
+            tail = '\n'.join(stderr.splitlines()[-STDERR_TAIL_LINES:])
+            rusage = output.get('rusage')
+            telemetry.record_command(
+                argv, wall_s, -signal.SIGKILL if returncode is None else returncode, attempt=attempt,
+                max_rss_mb=rusage.ru_maxrss / 1024 if rusage else None,
+                **({'stderr': tail} if returncode != 0 else {}),
+            )
+            if returncode == 0:
+                logging.info(f"Command succeeded in {wall_s:.1f} s: {' '.join(argv)}")
+            else:
+                reason = f"timed out after {wall_s:.0f} s" if returncode is None else f"exited {returncode}"
+                logging.error(f"Command {reason}: {' '.join(argv)}")
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, argv, output['stdout'], tail)
+        return output['stdout']
+
+    def call(self, name, func, *args, inputs=(), outputs=(), **kwargs):
+        """
+        Run an in-process step as telemetry stage ``name``, or plan it in dry-run mode.
+
+        Returns
+        -------
+        The result of ``func(*args, **kwargs)``, or None in dry-run mode.
+        """
+        if self.dry_run:
+            self.add_step(name, f'{name} (in process)', inputs, outputs)
+            return None
+        with telemetry.stage(name):
+            return func(*args, **kwargs)
+
+    def format_plan(self, workers=1):
+        """
+        Human-readable planned DAG with estimated costs.
+
+        Every step lists the steps it waits for. The estimated wall time is the
+        largest of the critical path, the serial total over ``workers`` and,
+        per limited tool, its total over its limit; steps without an estimate
+        count as zero.
+        """
+        finish = {}
+        by_name = defaultdict(lambda: [0, 0.0])
+        lines = []
+        for step in self.plan:
+            cost = step['estimate_s'] or 0.0
+            finish[step['id']] = cost + max((finish[i] for i in step['after']), default=0.0)
+            by_name[step['name']][0] += 1
+            by_name[step['name']][1] += cost
+            estimate = f"~{step['estimate_s']:.1f} s" if step['estimate_s'] is not None else '~? s'
+            after = f" after {', '.join(map(str, step['after']))}" if step['after'] else ''
+            lines.append(f"[{step['id']}] {estimate:>10}{after}: {step['description']}")
+        total = sum(cost for _, cost in by_name.values())
+        critical = max(finish.values(), default=0.0)
+        bounds = [critical, total / max(workers, 1)]
+        bounds += [by_name[tool][1] / limit for tool, limit in self.tool_limits.items() if tool in by_name and limit]
+        lines.append('')
+        lines.append('Step                           count   total s  limit')
+        for name, (count, cost) in sorted(by_name.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"{name:<30} {count:>5} {cost:>9.1f}  {self.tool_limits.get(name, '-')}")
+        lines.append(f"Planned steps: {len(self.plan)}, serial total ~{total:.1f} s, critical path ~{critical:.1f} s, "
+                     f"estimated wall time with {workers} workers ~{max(bounds):.1f} s")
+        return '\n'.join(lines)
@@ -0,0 +1,230 @@
+import logging
+import os
+import nibabel as nib
+import numpy as np
+from .cache_utils import ArrayCache, cache_key
+from .stream_utils import DEFAULT_STREAM_CHUNK_SIZE, iter_time_chunks
+
+# Bump to invalidate voxel-major cache entries written by older code
+VOXEL_MAJOR_VERSION = 1
+
+
+def load_coordinates(coor_path):
+    """
+    Load probtrackx seed voxel coordinates (e.g., 'coords_for_fdt_matrix2').
+
+    Returns
+    -------
+    np.ndarray
+        Integer array of shape (num_voxels, 3) with x, y, z voxel indices.
+    """
+    coordinates = np.loadtxt(coor_path, ndmin=2)
+    return coordinates[:, :3].astype(np.intp)
+
+
+def in_bounds_mask(coords, shape):
+    """Boolean mask of coordinates that fall inside a grid of the given spatial shape."""
+    return np.all((coords >= 0) & (coords < np.asarray(shape[:3])), axis=1)
+
+
+def gather_voxel_time_series(dataobj, coords_by_key, dtype=np.float32, chunk_size=None):
+    """
+    Gather the time series of several coordinate sets from one 4D image.
+
+    Only the bounding box of all in-bounds coordinates is read (through
+    ``img.dataobj`` slicing, memory-mapped for uncompressed files), and each
+    coordinate set is gathered with one vectorized fancy index.
+
+    Parameters
+    ----------
+    dataobj : nibabel ArrayProxy or np.ndarray
+        4D array-like of shape (x, y, z, num_timepoints), e.g. ``img.dataobj``
+        of 'fMRI_downsampled_3mm.nii.gz'.
+    coords_by_key : dict
+        Mapping such as {'L': coords_L, 'R': coords_R} of integer arrays of
+        shape (num_voxels, 3).
+    dtype : np.dtype
+        Output dtype.
+    chunk_size : int, optional
+        Read the bounding box in chunks of this many time points, so only one
+        chunk of it is in memory next to the outputs; ``None`` reads it at once.
+
+    Returns
+    -------
+    gathered : dict
+        Same keys as ``coords_by_key``; each value is a tuple
+        (time_series, in_bounds) where time_series has shape
+        (num_voxels, num_timepoints) with NaN rows for out-of-bounds
+        coordinates, and in_bounds is the boolean mask of valid rows.
+    """
+    shape = dataobj.shape
+    num_timepoints = shape[3] if len(shape) > 3 else 1
+    masks = {key: in_bounds_mask(coords, shape) for key, coords in coords_by_key.items()}
+    valid = [coords[masks[key]] for key, coords in coords_by_key.items() if masks[key].any()]
+
+    gathered = {
+        key: (np.full((len(coords), num_timepoints), np.nan, dtype=dtype), masks[key])
+        for key, coords in coords_by_key.items()
+    }
+    if not valid:
+        return gathered
+
+    valid = np.concatenate(valid)
+    lo = valid.min(axis=0)
+    hi = valid.max(axis=0) + 1
+    box = (slice(lo[0], hi[0]), slice(lo[1], hi[1]), slice(lo[2], hi[2]))
+    chunk_size = chunk_size or num_timepoints
+    for start in range(0, num_timepoints, chunk_size):
+        stop = min(start + chunk_size, num_timepoints)
+        if len(shape) > 3:
+            block = np.asanyarray(dataobj[box + (slice(start, stop),)])
+        else:
+            block = np.asanyarray(dataobj[box])
+        block = block.reshape(block.shape[:3] + (stop - start,))
+        for key, coords in coords_by_key.items():
+            mask = masks[key]
+            if mask.any():
+                rel = coords[mask] - lo
+                gathered[key][0][mask, start:stop] = block[rel[:, 0], rel[:, 1], rel[:, 2]]
+    return gathered
+
+
+def build_voxel_major(dataobj, out_dir, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """
+    Write the non-zero bounding box of a 4D image as a voxel-major array in ``out_dir``.
+
+    The voxels that are non-zero anywhere in the first chunk (the subcortical
+    voxels of a registered volume; the background is exactly zero) define
+    the bounding box. Their time series are written, one contiguous row per
+    voxel, to '<out_dir>/data.npy', a float32 memmap of shape
+    (num_voxels, num_timepoints). The image is read once, chunk by chunk, so
+    memory stays bounded by one chunk.
+
+    Files written
+    -------------
+    data.npy
+        float32, shape (num_voxels, num_timepoints).
+    index.npy
+        int32 grid of the bounding box: the row of every voxel in
+        ``data.npy``, or -1 for a voxel that is zero.
+    lo.npy
+        Grid position of the bounding box's first corner.
+
+    Returns
+    -------
+    int
+        Number of stored voxels.
+
+    Raises
+    ------
+    ValueError
+        A voxel that is zero throughout the first chunk is non-zero later,
+        so the cache would not be exact.
+    """
+    num_timepoints = dataobj.shape[3]
+    data = index = lo = box = stored = None
+    for start, stop, block in iter_time_chunks(dataobj, chunk_size):
+        if data is None:
+            nonzero = np.any(block != 0, axis=3)
+            voxels = np.argwhere(nonzero)
+            lo, hi = (voxels.min(axis=0), voxels.max(axis=0) + 1) if len(voxels) else (np.zeros(3, int),) * 2
+            box = tuple(slice(a, b) for a, b in zip(lo, hi))
+            stored = nonzero[box]
+            index = np.full(stored.shape, -1, dtype=np.int32)
+            index[stored] = np.arange(int(stored.sum()), dtype=np.int32)
+            data = np.lib.format.open_memmap(
+                os.path.join(out_dir, 'data.npy'), mode='w+', dtype=np.float32,
+                shape=(int(stored.sum()), num_timepoints),
+            )
+            outside = ~nonzero
+        elif np.any(block[outside] != 0):
+            raise ValueError(f"Voxels outside the cached set become non-zero at time points {start}:{stop}")
+        data[:, start:stop] = block[box][stored]
+    data.flush()
+    del data
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    np.save(os.path.join(out_dir, 'lo.npy'), np.asarray(lo, dtype=np.int64))
+    return int(stored.sum())
+
+
+def voxel_major_cache(cache_dir, image_path, max_bytes=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """
+    Voxel-major copy of a registered volume, built once and memory-mapped afterwards.
+
+    Re-extracting seed voxels from 'fMRI_downsampled_3mm.nii.gz' decompresses
+    the whole run every time, and NIfTI's time-last layout spreads each
+    voxel's time series over the entire file. The cache entry
+    (``build_voxel_major``) holds the subcortical bounding box, uncompressed
+    and one contiguous row per voxel. Any later coordinate set is then read
+    with ``gather_voxel_major`` as a few contiguous rows.
+
+    The entry is keyed by the image path and carries the image's size and
+    mtime. A changed image is rebuilt on the next call, and the
+    ``ArrayCache`` evicts the least recently used entries beyond
+    ``max_bytes``.
+
+    Returns
+    -------
+    (arrays, meta) or None
+        ``arrays`` holds the memory-mapped 'data', 'index' and 'lo', plus the
+        image's 'affine'. ``meta`` has the image 'shape'. None if the image
+        cannot be cached exactly, or its entry alone exceeds ``max_bytes``;
+        read the image directly then.
+    """
+    image_path = os.path.abspath(image_path)
+    st = os.stat(image_path)
+    fingerprint = {'source': image_path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    key = cache_key('voxel_major', VOXEL_MAJOR_VERSION, image_path)
+    cache = ArrayCache(cache_dir, max_bytes=max_bytes)
+    hit = cache.get(key, mmap_mode='r')
+    if hit is not None and all(hit[1].get(name) == value for name, value in fingerprint.items()):
+        return hit
+    with cache.lock(key):
+        hit = cache.get(key, mmap_mode='r')
+        if hit is not None and all(hit[1].get(name) == value for name, value in fingerprint.items()):
+            return hit
+        if hit is not None:
+            logging.info(f"{image_path} changed; rebuilding its voxel-major cache entry")
+            cache.invalidate(key)
+        img = nib.load(image_path, keep_file_open=True)
+        meta = dict(fingerprint, shape=[int(n) for n in img.shape])
+        try:
+            with cache.staging(key, meta) as tmp_dir:
+                meta['num_voxels'] = build_voxel_major(img.dataobj, tmp_dir, chunk_size)
+                np.save(os.path.join(tmp_dir, 'affine.npy'), img.affine)
+        except ValueError as e:
+            logging.warning(f"Not caching {image_path}: {e}")
+            return None
+        logging.info(f"Cached {meta['num_voxels']} voxels of {image_path} voxel-major in {cache_dir}")
+        return cache.get(key, mmap_mode='r')
+
+
+def gather_voxel_major(cached, coords_by_key, dtype=np.float32):
+    """
+    ``gather_voxel_time_series`` from a ``voxel_major_cache`` entry.
+
+    Each coordinate reads one contiguous row of the memory-mapped array.
+    In-bounds coordinates outside the stored voxels are zero in the image
+    and get zero rows, so the result equals gathering from the image itself.
+
+    Returns
+    -------
+    dict
+        Same as ``gather_voxel_time_series``.
+    """
+    arrays, meta = cached
+    shape = tuple(meta['shape'])
+    data, index, lo = arrays['data'], arrays['index'], arrays['lo']
+    gathered = {}
+    for key, coords in coords_by_key.items():
+        mask = in_bounds_mask(coords, shape)
+        time_series = np.full((len(coords), shape[3]), np.nan, dtype=dtype)
+        time_series[mask] = 0
+        rel = coords[mask] - lo
+        in_box = np.all((rel >= 0) & (rel < np.asarray(index.shape)), axis=1)
+        rows = np.full(len(rel), -1, dtype=np.int64)
+        rows[in_box] = index[rel[in_box, 0], rel[in_box, 1], rel[in_box, 2]]
+        found = np.flatnonzero(mask)[rows >= 0]
+        time_series[found] = data[rows[rows >= 0]]
+        gathered[key] = (time_series, mask)
+    return gathered
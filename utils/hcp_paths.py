@@ -0,0 +1,64 @@
+import os
+
+# (phase, direction) of the four resting-state runs
+RUNS = [(1, 'LR'), (1, 'RL'), (2, 'LR'), (2, 'RL')]
+HEMISPHERES = ['L', 'R']
+
+
+def results_dir(subject_dir, subject_name, phase, direction):
+    """'<subject>/<subject>_3T_rfMRI_REST_fix/<subject>/MNINonLinear/Results/rfMRI_REST{phase}_{direction}'."""
+    return os.path.join(
+        subject_dir,
+        f'{subject_name}_3T_rfMRI_REST_fix',
+        subject_name,
+        'MNINonLinear',
+        'Results',
+        f'rfMRI_REST{phase}_{direction}'
+    )
+
+
+def dtseries_path(subject_dir, subject_name, phase, direction):
+    """The run's 'rfMRI_REST{phase}_{direction}_Atlas_hp2000_clean.dtseries.nii'."""
+    return os.path.join(
+        results_dir(subject_dir, subject_name, phase, direction),
+        f'rfMRI_REST{phase}_{direction}_Atlas_hp2000_clean.dtseries.nii'
+    )
+
+
+def downsampled_path(subject_dir, subject_name, phase, direction):
+    """The run's registered 'fMRI_downsampled_3mm.nii.gz'."""
+    return os.path.join(results_dir(subject_dir, subject_name, phase, direction), 'fMRI_downsampled_3mm.nii.gz')
+
+
+def t1_ref_path(subject_dir):
+    """'<subject>/T1/T1_3mm.nii.gz'."""
+    return os.path.join(subject_dir, 'T1', 'T1_3mm.nii.gz')
+
+
+def structural_dir(subject_dir, subject_name):
+    """'<subject>/<subject>_3T_Structural_preproc/<subject>/MNINonLinear'."""
+    return os.path.join(subject_dir, f'{subject_name}_3T_Structural_preproc', subject_name, 'MNINonLinear')
+
+
+def warp_path(subject_dir, subject_name):
+    """The MNI -> ACPC warp 'xfms/standard2acpc_dc.nii.gz'."""
+    return os.path.join(structural_dir(subject_dir, subject_name), 'xfms', 'standard2acpc_dc.nii.gz')
+
+
+def label_gii_path(subject_dir, subject_name, hemisphere, parcellation):
+    """'fsaverage_LR32k/<subject>.<hemisphere>.<parcellation>.32k_fs_LR.label.gii'."""
+    return os.path.join(
+        structural_dir(subject_dir, subject_name),
+        'fsaverage_LR32k',
+        f'{subject_name}.{hemisphere}.{parcellation}.32k_fs_LR.label.gii'
+    )
+
+
+def coords_path(subject_dir, hemisphere):
+    """'<subject>/probtrackx_{hemisphere}_omatrix2/coords_for_fdt_matrix2'."""
+    return os.path.join(subject_dir, f'probtrackx_{hemisphere}_omatrix2', 'coords_for_fdt_matrix2')
+
+
+def output_dir(subject_dir, phase, direction):
+    """'<subject>/fMRI/phase{phase}_{direction}'."""
+    return os.path.join(subject_dir, 'fMRI', f'phase{phase}_{direction}')
@@ -1,84 +1,270 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nib
 import numpy as np
+from .stream_utils import time_chunks
 
+# Inspection modes: 'header' reads no data, 'stats' streams the data in time
+# chunks (or reads a sample of volumes), 'full' loads the whole image as before
+MODES = ('header', 'stats', 'full')
 
-def load_and_inspect_file(file_path):
+
+def file_type(file_path):
+    """'NIfTI' (.nii/.nii.gz, including CIFTI), 'GIFTI' (.gii) or None."""
+    name = file_path.lower()
+    if name.endswith(('.nii', '.nii.gz')):
+        return 'NIfTI'
+    if name.endswith('.gii'):
+        return 'GIFTI'
+    return None
+
+
+def array_stats(dataobj, time_axis=None, chunk_size=None, sample=None, unique=False):
+    """
+    Min, max and mean of an array-like, reading it in time chunks or sampling volumes.
+
+    Args:
+        dataobj (ArrayProxy or np.ndarray): E.g. ``img.dataobj``.
+        time_axis (int, optional): Axis to chunk or sample along (-1 for 4D
+            NIfTI, 0 for CIFTI); None reads everything at once.
+        chunk_size (int, optional): Time points per chunk (default: all at once).
+        sample (int, optional): Only read this many evenly spaced time points.
+        unique (bool): Also count the distinct values (for label or integer data).
+
+    Returns:
+        dict: "min", "max", "mean", "num_values", "num_read" (time points read,
+        or None if the array has no time axis) and "num_unique" if requested.
+    """
+    def read(start, stop):
+        return np.asarray(dataobj[start:stop] if time_axis == 0 else dataobj[..., start:stop])
+
+    if time_axis is None:
+        blocks, num_read = iter([np.asarray(dataobj)]), None
+    else:
+        num_timepoints = dataobj.shape[time_axis]
+        if sample and sample < num_timepoints:
+            indices = np.unique(np.linspace(0, num_timepoints - 1, sample).astype(int))
+            ranges = [(int(i), int(i) + 1) for i in indices]
+        else:
+            ranges = time_chunks(num_timepoints, chunk_size)
+        blocks = (read(start, stop) for start, stop in ranges)
+        num_read = sum(stop - start for start, stop in ranges)
+
+    data_min, data_max, total, count = np.inf, -np.inf, 0.0, 0
+    values = np.array([])
+    for block in blocks:
+        if block.size == 0:
+            continue
+        data_min = min(data_min, float(np.min(block)))
+        data_max = max(data_max, float(np.max(block)))
+        total += float(np.sum(block, dtype=np.float64))
+        count += block.size
+        if unique:
+            values = np.union1d(values, np.unique(block))
+    stats = {
+        "min": data_min if count else None,
+        "max": data_max if count else None,
+        "mean": total / count if count else None,
+        "num_values": count,
+        "num_read": num_read,
+    }
+    if unique:
+        stats["num_unique"] = int(values.size)
+    return stats
+
+
+def load_and_inspect_file(file_path, chunk_size=None, mode=None, sample=None, verbose=True):
     """
-    Load and comprehensively inspect NIfTI (.nii) or GIFTI (.gii) file.
+    Load and comprehensively inspect NIfTI (.nii, .nii.gz, including CIFTI) or GIFTI (.gii) file.
 
     Args:
-        file_path (str): Path to the .nii or .gii file.
+        file_path (str): Path to the .nii, .nii.gz or .gii file.
+        chunk_size (int, optional): For 4D NIfTI and CIFTI files, compute the
+            statistics over chunks of this many volumes instead of loading the
+            whole image; "data" is then the lazy ``img.dataobj``. Implies
+            ``mode='stats'``.
+        mode (str, optional): 'header' reads only the header ("data" is the
+            lazy ``img.dataobj``, no statistics); 'stats' streams the data in
+            chunks of ``chunk_size`` volumes; 'full' (the default without
+            ``chunk_size``) loads the whole image as float64.
+        sample (int, optional): In 'stats' mode, read only this many evenly
+            spaced volumes.
+        verbose (bool): Print the report.
 
     Returns:
-        dict: Dictionary containing file metadata and data array if applicable.
+        dict: Dictionary containing file metadata and data array if applicable,
+        with "path", "shape", "dtype" and "stats" (None in header mode) for
+        every file type.
     """
-    # Extract file name and extension
+    mode = mode or ('stats' if chunk_size or sample else 'full')
+    if mode not in MODES:
+        raise ValueError(f"Unknown inspection mode: {mode}; expected one of {MODES}")
+    # Extract file name and type
     file_name = os.path.basename(file_path)
-    file_extension = os.path.splitext(file_path)[-1].lower()
+    kind = file_type(file_path)
+    if kind is None:
+        raise ValueError("Unsupported file type. Please provide a .nii, .nii.gz, or .gii file.")
 
-    print(f"\n==== Loading File: {file_name} ====")
-    print(f"File Path: {file_path}")
+    if verbose:
+        print(f"\n==== Loading File: {file_name} ====")
+        print(f"File Path: {file_path}")
 
-    if file_extension in [".nii", ".nii.gz"]:
-        # Load NIfTI file
-        nii_file = nib.load(file_path)
-        header = nii_file.header
-        affine = nii_file.affine
+    if kind == "NIfTI":
+        # Load NIfTI (or CIFTI) file; only the header is read here
+        img = nib.load(file_path, keep_file_open=mode == 'stats')
+        header = img.header
+        is_cifti = isinstance(img, nib.Cifti2Image)
+        affine = None if is_cifti else img.affine
+        shape = tuple(int(n) for n in img.shape)
+        dtype = img.get_data_dtype()
 
         # Extract data
-        data_array = nii_file.get_fdata()
+        if mode == 'header':
+            data_array, stats = img.dataobj, None
+        elif mode == 'stats':
+            data_array = img.dataobj
+            time_axis = 0 if is_cifti else (-1 if len(shape) > 3 else None)
+            stats = array_stats(data_array, time_axis, chunk_size, sample, unique=dtype.kind in 'iu')
+        else:
+            data_array = img.get_fdata()
+            stats = array_stats(data_array)
 
         # Print detailed NIfTI information
-        print("\n[File Type]: NIfTI (.nii/.nii.gz)")
-        print(f"[Dimensions]: {header.get_data_shape()}")
-        print(f"[Voxel Size]: {header.get_zooms()} (in mm)")
-        print(f"[Data Type]: {header.get_data_dtype()}")
-        print(f"[Affine Transformation Matrix]:\n{affine}")
-        print(f"[Q-form Matrix]:\n{header.get_qform()}")
-        print(f"[S-form Matrix]:\n{header.get_sform()}")
-        print(f"[Intent Code]: {header['intent_code']} (Describes data purpose)")
-        print(f"[Description]: {header.get('descrip', 'No description available')}")
-        print(f"[Slice Timing Information]: {header.get('slice_duration', 'Not available')}")
-        print(f"[Data Range]: Min = {np.min(data_array):.6f}, Max = {np.max(data_array):.6f}")
+        if verbose:
+            print(f"\n[File Type]: {'CIFTI' if is_cifti else 'NIfTI'} (.nii/.nii.gz)")
+            print(f"[Dimensions]: {shape}")
+            print(f"[Data Type]: {dtype}")
+            if is_cifti:
+                print(f"[Axes]: {[type(header.get_axis(i)).__name__ for i in range(len(shape))]}")
+            else:
+                print(f"[Voxel Size]: {header.get_zooms()} (in mm)")
+                print(f"[Affine Transformation Matrix]:\n{affine}")
+                print(f"[Q-form Matrix]:\n{header.get_qform()}")
+                print(f"[S-form Matrix]:\n{header.get_sform()}")
+                print(f"[Intent Code]: {header['intent_code']} (Describes data purpose)")
+                print(f"[Description]: {header.get('descrip', 'No description available')}")
+                print(f"[Slice Timing Information]: {header.get('slice_duration', 'Not available')}")
+            if stats is not None:
+                print(f"[Data Range]: Min = {stats['min']:.6f}, Max = {stats['max']:.6f}, Mean = {stats['mean']:.6f}")
 
         return {
-            "file_type": "NIfTI",
+            "file_type": "CIFTI" if is_cifti else "NIfTI",
+            "path": file_path,
+            "shape": shape,
+            "dtype": str(dtype),
+            "zooms": None if is_cifti else tuple(float(z) for z in header.get_zooms()),
             "header": header,
             "affine": affine,
-            "data": data_array
+            "data": data_array,
+            "stats": stats,
         }
 
-    elif file_extension == ".gii":
-        # Load GIFTI file
-        gii_data = nib.load(file_path)
+    # Load GIFTI file (the data arrays are embedded in the XML, so they are always parsed)
+    gii_data = nib.load(file_path)
 
-        # Extract data arrays
-        data_arrays = [darray.data for darray in gii_data.darrays]
-        labels = [darray.metadata.get('Name', 'Unknown') for darray in gii_data.darrays]
+    # Extract data arrays
+    data_arrays = [darray.data for darray in gii_data.darrays]
+    labels = [darray.metadata.get('Name', 'Unknown') for darray in gii_data.darrays]
+    array_stats_list = [None] * len(data_arrays)
+    unique_values_list = [None] * len(data_arrays)
+    if mode != 'header':
+        for i, array in enumerate(data_arrays):
+            # One np.unique per array serves both the count and the printed values
+            unique_values_list[i] = np.unique(array)
+            array_stats_list[i] = array_stats(array)
+            array_stats_list[i]["num_unique"] = int(unique_values_list[i].size)
 
-        # Print detailed GIFTI information
+    # Print detailed GIFTI information
+    if verbose:
         print("\n[File Type]: GIFTI (.gii)")
         print(f"[Number of Data Arrays]: {len(data_arrays)}")
-        for i, (array, label) in enumerate(zip(data_arrays, labels)):
+        for i, (array, label, stats, unique_values) in enumerate(
+                zip(data_arrays, labels, array_stats_list, unique_values_list)):
             print(f"\n-- Array {i + 1} --")
             print(f"Label: {label}")
             print(f"Shape: {array.shape}")
-            print(f"Data Range: Min = {np.min(array):.6f}, Max = {np.max(array):.6f}")
-            print(f"Unique Values: {np.unique(array)[:10]}{'...' if len(np.unique(array)) > 10 else ''}")
+            if stats is not None:
+                print(f"Data Range: Min = {stats['min']:.6f}, Max = {stats['max']:.6f}")
+                print(f"Unique Values: {unique_values[:10]}{'...' if unique_values.size > 10 else ''}")
             print(f"Array Metadata: {gii_data.darrays[i].metadata}")
 
-        return {
-            "file_type": "GIFTI",
-            "data_arrays": data_arrays
-        }
+    return {
+        "file_type": "GIFTI",
+        "path": file_path,
+        "shape": (len(data_arrays),) + tuple(data_arrays[0].shape) if data_arrays else (0,),
+        "dtype": str(data_arrays[0].dtype) if data_arrays else None,
+        "data_arrays": data_arrays,
+        "stats": array_stats_list,
+    }
+
+
+def inspection_record(info):
+    """Flat, JSON-serializable summary of a ``load_and_inspect_file`` result (no header or data objects)."""
+    record = {key: info.get(key) for key in ("path", "file_type", "shape", "dtype", "zooms")}
+    if info["file_type"] == "CIFTI":
+        step = getattr(info["header"].get_axis(0), "step", None)
+        record["tr"] = float(step) if step is not None else None
+    elif info["file_type"] == "NIfTI":
+        record["tr"] = record["zooms"][3] if len(record["zooms"]) > 3 else None
+    if info["file_type"] != "GIFTI":
+        record["affine"] = info["affine"].tolist() if info["affine"] is not None else None
+        record.update(info["stats"] or {})
     else:
-        raise ValueError("Unsupported file type. Please provide a .nii, .nii.gz, or .gii file.")
+        record["num_arrays"] = len(info["data_arrays"])
+        stats = [s for s in info["stats"] if s and s["num_values"]]
+        if stats:
+            record["min"] = min(s["min"] for s in stats)
+            record["max"] = max(s["max"] for s in stats)
+            record["num_unique"] = max(s["num_unique"] for s in stats)
+    return record
+
+
+def inspect_files(file_paths, mode='header', chunk_size=None, sample=None, max_workers=8):
+    """
+    Inspect many files in parallel and return one structured record per file.
 
+    Args:
+        file_paths (list of str): NIfTI, CIFTI or GIFTI files, e.g. the paths of
+            ``DatasetCatalog.files(kind='downsampled')``.
+        mode (str): 'header', 'stats' or 'full' (see ``load_and_inspect_file``).
+        chunk_size (int, optional): Volumes per chunk in 'stats' mode.
+        sample (int, optional): Volumes sampled per file in 'stats' mode.
+        max_workers (int): Files inspected concurrently; reading and gzip
+            decompression release the GIL.
+
+    Returns:
+        list: One ``inspection_record`` dict per path, in input order; a file
+        that fails to load has only "path" and "error".
+    """
+    def inspect(file_path):
+        try:
+            return inspection_record(load_and_inspect_file(file_path, chunk_size, mode, sample, verbose=False))
+        except Exception as e:
+            return {"path": file_path, "error": repr(e)}
 
-# Example usage
-file_path = "/path/to/your/file.nii.gz"  # Replace with the actual file path
-try:
-    file_info = load_and_inspect_file(file_path)
-except ValueError as e:
-    print(e)
+    with ThreadPoolExecutor(max_workers) as pool:
+        return list(pool.map(inspect, file_paths))
+
+
+def inspect_catalog(catalog, subject=None, kind=None):
+    """
+    Print the catalogued header properties of a dataset without opening any image.
+
+    Args:
+        catalog (DatasetCatalog): Catalog from ``utils.catalog_utils``, refreshed
+            with ``catalog.refresh(hcp_dir)``.
+        subject (str, optional): Only this subject.
+        kind (str, optional): Only this kind of file ('dtseries', 'downsampled',
+            't1_ref', 'warp', 'label' or 'coords').
+
+    Returns:
+        list: The catalog records (path, subject, kind, key, size, shape, dtype,
+        tr, n_vols, affine).
+    """
+    records = catalog.files(subject=subject, kind=kind)
+    print(f"\n==== Catalog: {catalog.path} ({len(records)} files) ====")
+    for record in records:
+        details = f"shape={tuple(record['shape'])}, dtype={record['dtype']}, TR={record['tr']}, " \
+                  f"volumes={record['n_vols']}" if record['shape'] else f"{record['size']} bytes"
+        print(f"{record['subject']} {record['kind']:<12} {record['key']:<20} {details}")
+    return records
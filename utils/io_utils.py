@@ -0,0 +1,29 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Write a file atomically: yield a temporary path next to ``path`` and
+    rename it into place only if the block succeeds.
+
+    The temporary name keeps the full file name as suffix, so extension-based
+    writers (nibabel's '.nii.gz', h5py, np.save's '.npy') behave as usual,
+    and a crash never leaves a half-written file under the final name.
+
+    Example
+    -------
+    >>> with atomic_output('fMRI_downsampled_3mm.nii.gz') as tmp:
+    ...     nib.save(img, tmp)
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f'.tmp-{os.getpid()}-{uuid.uuid4().hex[:8]}-{name}')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
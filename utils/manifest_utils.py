@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from .cache_utils import file_digest
+
+MANIFEST_NAME = '.pipeline_manifest.sqlite'
+
+# Stages whose outputs a stage reads: a stale upstream stage makes it stale,
+# and a failed one leaves it nothing valid to read
+UPSTREAM_STAGES = {
+    'striatum': ['registration'],
+    'connectivity': ['striatum', 'cortex'],
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    subject TEXT NOT NULL,
+    run TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    inputs TEXT,
+    params_hash TEXT,
+    outputs TEXT,
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (subject, run, stage)
+)
+"""
+
+
+def fingerprint(paths, hash_contents=False):
+    """
+    Fingerprint files by size and mtime (and optionally SHA-256).
+
+    Missing files map to ``None`` so that their later appearance marks the
+    record stale.
+
+    Returns
+    -------
+    dict
+        path -> {'size', 'mtime_ns'[, 'sha256']} or None.
+    """
+    prints = {}
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            prints[path] = None
+            continue
+        prints[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        if hash_contents:
+            prints[path]['sha256'] = file_digest(path)
+    return prints
+
+
+def params_hash(params):
+    """Stable hash of a JSON-serializable parameter dict."""
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def stage_row(subject, run, stage, status, inputs, params, outputs=(), error=None, hash_inputs=False):
+    """
+    Manifest row of a finished stage, fingerprinted now.
+
+    Rows are plain JSON-serializable dicts, so a worker that must not write
+    the manifest itself (e.g. on another node) can fingerprint its stages
+    when they finish and hand the rows over for ``RunManifest.write``.
+
+    Parameters
+    ----------
+    status : {'done', 'failed'}
+    inputs : list of str
+        Files the stage read.
+    params : dict
+        Parameters that change the stage's outputs.
+    outputs : list of str
+        Files the stage wrote (checksummed), for a 'done' stage.
+    error : str, optional
+        Error of a 'failed' stage.
+    hash_inputs : bool
+        Fingerprint inputs by content hash.
+    """
+    return {
+        'subject': subject, 'run': run, 'stage': stage, 'status': status,
+        'inputs': fingerprint(inputs, hash_inputs), 'params_hash': params_hash(params),
+        'outputs': fingerprint(outputs, hash_contents=True) if status == 'done' else {},
+        'error': None if error is None else str(error), 'updated': time.time(),
+    }
+
+
+class RunManifest:
+    """
+    SQLite record of every (subject, run, stage) the pipeline has executed.
+
+    Each row stores the status ('done' or 'failed'), the fingerprints of the
+    stage's inputs, a hash of its parameters and the fingerprints (with
+    checksums) of its outputs. A stage is up to date when it is 'done', its
+    inputs and parameters are unchanged and its outputs are still on disk as
+    written.
+
+    Outputs are compared by size and mtime; their checksums are advisory
+    (e.g. for auditing a copied dataset) unless ``verify_outputs`` is set,
+    since re-hashing every output would read the whole dataset on each plan.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file, by default '<HCP>/.pipeline_manifest.sqlite'.
+    hash_inputs : bool
+        Fingerprint inputs by content hash instead of size and mtime.
+    verify_outputs : bool
+        Also compare the checksums of outputs whose size and mtime match.
+    """
+
+    def __init__(self, path, hash_inputs=False, verify_outputs=False):
+        self.path = path
+        self.hash_inputs = hash_inputs
+        self.verify_outputs = verify_outputs
+        with self._connect() as conn:
+            conn.execute(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def record(self, subject, run, stage):
+        """The stored row as a dict, or None."""
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                'SELECT * FROM stages WHERE subject = ? AND run = ? AND stage = ?', (subject, run, stage)
+            ).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record['inputs'] = json.loads(record['inputs'] or '{}')
+        record['outputs'] = json.loads(record['outputs'] or '{}')
+        return record
+
+    def is_up_to_date(self, subject, run, stage, inputs, params):
+        """Whether ``stage`` finished with the same inputs and parameters and its outputs are intact."""
+        record = self.record(subject, run, stage)
+        if record is None or record['status'] != 'done':
+            return False
+        if record['params_hash'] != params_hash(params):
+            return False
+        if record['inputs'] != fingerprint(inputs, self.hash_inputs):
+            return False
+        outputs = record['outputs']
+        current = fingerprint(outputs)
+        return all(
+            current[path] is not None
+            and current[path]['size'] == outputs[path]['size']
+            and current[path]['mtime_ns'] == outputs[path]['mtime_ns']
+            and (not self.verify_outputs or file_digest(path, memoize=False) == outputs[path].get('sha256'))
+            for path in outputs
+        )
+
+    def mark_done(self, subject, run, stage, inputs, params, outputs):
+        """Record a successful stage with checksums of its outputs."""
+        self.write([stage_row(subject, run, stage, 'done', inputs, params, outputs, hash_inputs=self.hash_inputs)])
+
+    def mark_failed(self, subject, run, stage, inputs, params, error):
+        """Record a failed stage; downstream stages must not consume its outputs."""
+        self.write([stage_row(subject, run, stage, 'failed', inputs, params, error=error,
+                              hash_inputs=self.hash_inputs)])
+
+    def write(self, rows):
+        """
+        Store ``stage_row`` rows in one transaction.
+
+        A row replaces the stored one of its (subject, run, stage) only if it
+        is newer, so rows handed over late (see ``stage_row``) never undo a
+        later record.
+
+        Returns
+        -------
+        int
+            Number of rows stored.
+        """
+        with self._connect() as conn:
+            return sum(conn.execute(
+                'INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (subject, run, stage) DO UPDATE SET status = excluded.status, '
+                'inputs = excluded.inputs, params_hash = excluded.params_hash, outputs = excluded.outputs, '
+                'error = excluded.error, updated = excluded.updated WHERE excluded.updated > stages.updated',
+                (row['subject'], row['run'], row['stage'], row['status'], json.dumps(row['inputs']),
+                 row['params_hash'], json.dumps(row['outputs']), row['error'], row['updated']),
+            ).rowcount for row in rows)
+
+    def summary(self):
+        """Count of (stage, status) pairs."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT stage, status, COUNT(*) FROM stages GROUP BY stage, status').fetchall()
+        return {(stage, status): count for stage, status, count in rows}
+
+
+def run_key(phase, direction):
+    """Manifest name of a run, e.g. 'phase1_LR'."""
+    return f'phase{phase}_{direction}'
+
+
+def stale_runs(manifest, tasks, stage, inputs, params):
+    """
+    Drop the runs whose ``stage`` is up to date in the manifest from a script's subject tasks.
+
+    Parameters
+    ----------
+    manifest : RunManifest
+    tasks : list of (subject, [(phase, direction), ...])
+        Subject tasks, e.g. from ``catalog_utils.group_runs``.
+    stage : str
+        Stage name, e.g. 'registration'.
+    inputs : callable
+        (subject, phase, direction) -> files the stage reads.
+    params : dict
+        Parameters that change the stage's outputs.
+
+    Returns
+    -------
+    list of (subject, [(phase, direction), ...])
+        The subjects with stale runs, and only those runs.
+    """
+    planned = []
+    total = 0
+    for subject, runs in tasks:
+        total += len(runs)
+        runs = [(phase, direction) for phase, direction in runs if not manifest.is_up_to_date(
+            subject, run_key(phase, direction), stage, inputs(subject, phase, direction), params
+        )]
+        if runs:
+            planned.append((subject, runs))
+    logging.info(f"{sum(len(runs) for _, runs in planned)} of {total} runs have a stale {stage} stage")
+    return planned
+
+
+def drop_failed_upstream(manifest, tasks, stage):
+    """
+    Drop the runs whose upstream stage (see ``UPSTREAM_STAGES``) is recorded failed.
+
+    A script that runs a single stage would otherwise read what an earlier,
+    successful upstream run left on disk.
+
+    Parameters
+    ----------
+    manifest : RunManifest
+    tasks : list of (subject, [(phase, direction), ...])
+    stage : str
+
+    Returns
+    -------
+    list of (subject, [(phase, direction), ...])
+    """
+    upstream = UPSTREAM_STAGES.get(stage, [])
+    if not upstream:
+        return tasks
+    planned = []
+    for subject, runs in tasks:
+        kept = []
+        for phase, direction in runs:
+            failed = [name for name in upstream
+                      if (manifest.record(subject, run_key(phase, direction), name) or {}).get('status') == 'failed']
+            if failed:
+                logging.warning(f"Skipping {stage} of {subject} {run_key(phase, direction)}: "
+                                f"{' and '.join(failed)} failed")
+            else:
+                kept.append((phase, direction))
+        if kept:
+            planned.append((subject, kept))
+    return planned
+
+
+def record_runs(manifest, subject, results, stage, inputs, params):
+    """
+    Record a script's per-run results of one subject.
+
+    ``results`` holds (phase, direction, outputs, error) per run: runs with
+    an error are marked failed, runs with outputs done, and runs skipped for
+    missing inputs (outputs None) are left unrecorded.
+    """
+    for phase, direction, outputs, error in results:
+        args = (subject, run_key(phase, direction), stage, inputs(subject, phase, direction), params)
+        if error is not None:
+            manifest.mark_failed(*args, error)
+        elif outputs is not None:
+            manifest.mark_done(*args, outputs)
@@ -0,0 +1,142 @@
+import threading
+from collections import OrderedDict, namedtuple
+import nibabel as nib
+import numpy as np
+import scipy.sparse as sp
+from .cache_utils import ArrayCache, cache_key, file_digest
+
+# Parcel-averaged time series with their label IDs and names.
+# data has shape (num_labels, num_timepoints); row i belongs to label_ids[i].
+ParcelTimeSeries = namedtuple('ParcelTimeSeries', ['label_ids', 'label_names', 'data'])
+
+# Operators kept per process, keyed by label file content; subjects sharing a
+# label file and the four runs of a subject reuse the same operator.
+_operator_cache = OrderedDict()
+_operator_lock = threading.Lock()
+operator_cache_size = 64
+
+# Optional ArrayCache directory (ideally node-local scratch) where operators are
+# published once and memory-mapped read-only by every worker process
+operator_cache_dir = None
+
+
+def build_parcel_operator(labels, exclude=(0,)):
+    """
+    Sparse parcel-by-vertex averaging operator.
+
+    Row i has weight 1/n_i on each of the n_i vertices carrying label
+    ``label_ids[i]``, so ``operator @ func_data`` gives every parcel's mean
+    time series in one product.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Integer label of every vertex, shape (num_vertices,).
+    exclude : tuple
+        Label IDs to leave out (0 is the unassigned/medial wall label).
+
+    Returns
+    -------
+    label_ids : np.ndarray
+        Sorted label IDs, one per operator row.
+    operator : scipy.sparse.csr_matrix
+        float32 matrix of shape (num_labels, num_vertices).
+    """
+    labels = np.asarray(labels).ravel()
+    label_ids = np.unique(labels)
+    label_ids = label_ids[~np.isin(label_ids, exclude)]
+    vertices = np.flatnonzero(np.isin(labels, label_ids))
+    rows = np.searchsorted(label_ids, labels[vertices])
+    counts = np.bincount(rows, minlength=len(label_ids))
+    operator = sp.csr_matrix(
+        ((1.0 / counts[rows]).astype(np.float32), (rows, vertices)),
+        shape=(len(label_ids), len(labels)),
+    )
+    return label_ids, operator
+
+
+def parcel_operator(label_gii_path, exclude=(0,)):
+    """
+    Averaging operator and label names for a label GIFTI, cached per process
+    and, when ``operator_cache_dir`` is set, shared across processes.
+
+    Returns
+    -------
+    (label_ids, label_names, operator)
+        See ``build_parcel_operator``; label_names come from the label table.
+    """
+    key = (file_digest(label_gii_path), tuple(exclude))
+    with _operator_lock:
+        if key in _operator_cache:
+            _operator_cache.move_to_end(key)
+            return _operator_cache[key]
+
+    entry = load_parcel_operator(key) if operator_cache_dir else None
+    if entry is None:
+        label_img = nib.load(label_gii_path)
+        labels = label_img.darrays[0].data  # shape: (num_vertices,)
+        label_ids, operator = build_parcel_operator(labels, exclude)
+        names = label_img.labeltable.get_labels_as_dict()
+        label_names = [names.get(int(lb), str(lb)) for lb in label_ids]
+        entry = (label_ids, label_names, operator)
+        if operator_cache_dir:
+            ArrayCache(operator_cache_dir).put(
+                cache_key('parcel_operator', *key),
+                {'label_ids': label_ids, 'data': operator.data, 'indices': operator.indices, 'indptr': operator.indptr},
+                {'label_names': label_names, 'shape': list(operator.shape), 'label_gii_path': label_gii_path},
+            )
+
+    with _operator_lock:
+        _operator_cache[key] = entry
+        while len(_operator_cache) > operator_cache_size:
+            _operator_cache.popitem(last=False)
+    return entry
+
+
+def load_parcel_operator(key):
+    """Memory-mapped operator published in ``operator_cache_dir``, or None."""
+    hit = ArrayCache(operator_cache_dir).get(cache_key('parcel_operator', *key), mmap_mode='r')
+    if hit is None:
+        return None
+    arrays, meta = hit
+    operator = sp.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']), copy=False
+    )
+    return arrays['label_ids'], meta['label_names'], operator
+
+
+def average_parcels(func_data, label_gii_paths, exclude=(0,)):
+    """
+    Average a surface time series over several parcellations in one pass.
+
+    The operators of all parcellations are stacked and applied as a single
+    sparse-dense product over the whole time series.
+
+    Parameters
+    ----------
+    func_data : np.ndarray
+        Surface data of shape (num_vertices, num_timepoints).
+    label_gii_paths : dict
+        Parcellation name -> label GIFTI path, e.g.
+        {'aparc': '100307.L.aparc.32k_fs_LR.label.gii',
+         'aparc.a2009s': '100307.L.aparc.a2009s.32k_fs_LR.label.gii'}.
+    exclude : tuple
+        Label IDs to leave out.
+
+    Returns
+    -------
+    dict
+        Parcellation name -> ParcelTimeSeries.
+    """
+    names = list(label_gii_paths)
+    parcellations = [parcel_operator(label_gii_paths[name], exclude) for name in names]
+    stacked = sp.vstack([operator for _, _, operator in parcellations], format='csr')
+    averaged = np.asarray(stacked @ func_data, dtype=np.float32)
+
+    result = {}
+    start = 0
+    for name, (label_ids, label_names, operator) in zip(names, parcellations):
+        stop = start + operator.shape[0]
+        result[name] = ParcelTimeSeries(label_ids, label_names, averaged[start:stop])
+        start = stop
+    return result
@@ -0,0 +1,204 @@
+import csv
+import fcntl
+import logging
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+from .io_utils import atomic_output
+from .store_utils import iter_run_dirs
+
+# Per-run QC table, one row per extracted region
+QC_TABLE = 'qc.csv'
+QC_COLUMNS = [
+    'region', 'num_rows', 'num_timepoints', 'tsnr_median', 'tsnr_mean', 'dvars_mean', 'dvars_max',
+    'global_signal_mean', 'global_signal_std', 'out_of_bounds_fraction', 'zero_variance_fraction', 'updated',
+]
+
+# Variance below this fraction of the squared mean counts as zero (float64 rounding of constant rows)
+ZERO_VARIANCE_TOLERANCE = 1e-10
+
+
+class QCAccumulator:
+    """
+    Streaming QC metrics of one region's time series, fed one block of time points at a time.
+
+    All metrics are vectorized over the rows (voxels or parcels) and need
+    only per-row sums, the last time point of the previous block and one
+    value per time point, so the data is never held or read twice.
+
+    Metrics
+    -------
+    tsnr_median, tsnr_mean
+        Temporal mean over standard deviation of every row with variance.
+    dvars_mean, dvars_max
+        Root mean square over rows of the difference between consecutive
+        time points.
+    global_signal_mean, global_signal_std
+        Mean over rows at every time point, summarized over time.
+    out_of_bounds_fraction
+        Rows outside the image (``in_bounds`` False); they are left out of
+        every other metric.
+    zero_variance_fraction
+        In-bounds rows that are constant over time.
+
+    Parameters
+    ----------
+    num_rows : int
+        Rows of the region.
+    in_bounds : np.ndarray of bool, optional
+        Rows inside the image, e.g. from ``gather_voxel_time_series``.
+    """
+
+    def __init__(self, num_rows, in_bounds=None):
+        self.num_rows = int(num_rows)
+        self.valid = np.ones(self.num_rows, dtype=bool) if in_bounds is None else np.asarray(in_bounds, dtype=bool)
+        num_valid = int(self.valid.sum())
+        self.sum = np.zeros(num_valid)
+        self.sum_squares = np.zeros(num_valid)
+        self.num_timepoints = 0
+        self.last = None
+        self.dvars = []
+        self.global_signal = []
+
+    def update(self, block):
+        """Add a block of shape (num_rows, num_timepoints_in_block)."""
+        block = np.asarray(block, dtype=np.float64)[self.valid]
+        if block.shape[1] == 0:
+            return
+        self.sum += block.sum(axis=1)
+        self.sum_squares += np.square(block).sum(axis=1)
+        self.num_timepoints += block.shape[1]
+        if block.shape[0]:
+            self.global_signal.extend(block.mean(axis=0))
+            previous = block if self.last is None else np.concatenate([self.last, block], axis=1)
+            self.dvars.extend(np.sqrt(np.mean(np.square(np.diff(previous, axis=1)), axis=0)))
+            self.last = block[:, -1:]
+
+    def result(self):
+        """QC metrics as a dict with the keys of ``QC_COLUMNS`` (except 'region' and 'updated')."""
+        n = max(self.num_timepoints, 1)
+        mean = self.sum / n
+        variance = np.maximum(self.sum_squares / n - np.square(mean), 0)
+        zero_variance = variance <= ZERO_VARIANCE_TOLERANCE * np.maximum(np.square(mean), 1)
+        std = np.sqrt(variance[~zero_variance])
+        tsnr = mean[~zero_variance] / std
+        dvars = np.asarray(self.dvars)
+        global_signal = np.asarray(self.global_signal)
+
+        def summary(func, values):
+            return float(func(values)) if values.size else float('nan')
+
+        return {
+            'num_rows': self.num_rows,
+            'num_timepoints': self.num_timepoints,
+            'tsnr_median': summary(np.median, tsnr),
+            'tsnr_mean': summary(np.mean, tsnr),
+            'dvars_mean': summary(np.mean, dvars),
+            'dvars_max': summary(np.max, dvars),
+            'global_signal_mean': summary(np.mean, global_signal),
+            'global_signal_std': summary(np.std, global_signal),
+            'out_of_bounds_fraction': float(1 - self.valid.mean()) if self.num_rows else 0.0,
+            'zero_variance_fraction': float(zero_variance.mean()) if zero_variance.size else 0.0,
+        }
+
+
+def time_series_qc(data, in_bounds=None):
+    """QC metrics (see ``QCAccumulator``) of a complete (num_rows, num_timepoints) array."""
+    accumulator = QCAccumulator(data.shape[0], in_bounds)
+    accumulator.update(data)
+    return accumulator.result()
+
+
+@contextmanager
+def _table_lock(run_dir):
+    # The striatum and cortex extractions of a run may finish at the same time
+    with open(os.path.join(run_dir, f'.{QC_TABLE}.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_qc(run_dir):
+    """QC table of a run: region -> metrics (empty if there is none)."""
+    path = os.path.join(run_dir, QC_TABLE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {
+            row['region']: {key: float(value) for key, value in row.items() if key != 'region'}
+            for row in csv.DictReader(f)
+        }
+
+
+def write_qc(run_dir, metrics_by_region):
+    """
+    Add or replace the rows of the given regions in the run's QC table ('<run_dir>/qc.csv').
+
+    Returns
+    -------
+    str
+        Path of the table.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    path = os.path.join(run_dir, QC_TABLE)
+    with _table_lock(run_dir):
+        table = load_qc(run_dir)
+        for region, metrics in metrics_by_region.items():
+            table[region] = {**metrics, 'updated': time.time()}
+        with atomic_output(path) as tmp_path, open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=QC_COLUMNS)
+            writer.writeheader()
+            for region in sorted(table):
+                writer.writerow({'region': region, **{key: table[region].get(key) for key in QC_COLUMNS[1:]}})
+    logging.info(f"Saved QC of {sorted(metrics_by_region)} to {path}")
+    return path
+
+
+def qc_failures(metrics_by_region, thresholds):
+    """
+    Whether a run fails the thresholds.
+
+    Parameters
+    ----------
+    metrics_by_region : dict
+        Region -> metrics, e.g. from ``load_qc``.
+    thresholds : dict
+        'min_<metric>' or 'max_<metric>' -> limit, e.g.
+        {'min_tsnr_median': 20, 'max_out_of_bounds_fraction': 0.1}. A limit
+        applies to every region that has the metric.
+
+    Returns
+    -------
+    list of str
+        One message per failed (region, threshold); empty if the run passes.
+    """
+    failures = []
+    for key, limit in thresholds.items():
+        bound, metric = key.split('_', 1)
+        if bound not in ('min', 'max'):
+            raise ValueError(f"QC threshold {key} must start with 'min_' or 'max_'")
+        for region, metrics in sorted(metrics_by_region.items()):
+            value = metrics.get(metric)
+            if value is None or np.isnan(value):
+                continue
+            if (bound == 'min' and value < limit) or (bound == 'max' and value > limit):
+                failures.append(f"{region} {metric} = {value:.4g} ({bound} {limit})")
+    return failures
+
+
+def collect_qc(hcp_dir, subjects=None):
+    """
+    Cohort QC table: one record per (subject, run, region) with the stored metrics.
+
+    Returns
+    -------
+    list of dict
+    """
+    records = []
+    for subject, run, run_dir in iter_run_dirs(hcp_dir, subjects):
+        for region, metrics in load_qc(run_dir).items():
+            records.append({'subject': subject, 'run': run, 'region': region, **metrics})
+    return records
@@ -0,0 +1,571 @@
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from .io_utils import atomic_output
+
+# Task states; a task is in exactly one of them
+STATES = ('pending', 'leased', 'done', 'failed')
+
+# Seconds a claimed task stays leased without a heartbeat before it is re-queued
+DEFAULT_LEASE_SECONDS = 600
+
+# Claims of a task (the first one and re-queues of expired leases) before it is marked failed
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+class TaskFailed(Exception):
+    """
+    Raised by a task handler to mark its task failed while still storing a result.
+
+    ``run_worker`` stores ``result`` with the failed task, e.g. the outcomes
+    of the parts of the task that did complete.
+    """
+
+    def __init__(self, error, result=None):
+        super().__init__(error)
+        self.result = result
+
+
+def worker_id():
+    """'<host>-<pid>' of this process, recorded with every claimed task."""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def open_queue(path, **kwargs):
+    """``SQLiteQueue`` for a '.sqlite'/'.db' path, otherwise a ``DirectoryQueue``."""
+    if path.endswith(('.sqlite', '.db')):
+        return SQLiteQueue(path, **kwargs)
+    return DirectoryQueue(path, **kwargs)
+
+
+class DirectoryQueue:
+    """
+    Task queue on a shared file system, one JSON file per task.
+
+    The state of a task is the directory its file is in
+    ('<root>/{pending,leased,done,failed}'), and every transition is a single
+    ``os.rename``, which is atomic on local file systems and NFS. A worker
+    claims a task by renaming 'pending/<id>.json' to
+    'leased/<id>~<token>.json' with a token of its own; of several workers
+    racing for a task exactly one rename succeeds. Heartbeats touch the lease
+    file. A lease whose file has not changed for ``lease_seconds`` (measured
+    with the file server's clock, so node clocks may differ) is renamed back
+    to pending by whichever worker notices first, and the slow worker finds
+    its lease gone.
+
+    Parameters
+    ----------
+    root : str
+        Queue directory, e.g. on the shared file system next to the data.
+    lease_seconds : float
+        Lease duration without heartbeat.
+    max_attempts : int
+        Claims of a task before an expired lease marks it failed.
+    """
+
+    def __init__(self, root, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = root
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        for state in STATES:
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def _dir(self, state):
+        return os.path.join(self.path, state)
+
+    def _entries(self, state):
+        # Dot files are temporary files of writers still in progress
+        try:
+            return [entry for entry in os.scandir(self._dir(state))
+                    if entry.name.endswith('.json') and not entry.name.startswith('.')]
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _task_id(name):
+        return name[:-len('.json')].removeprefix('.expired-').split('~', 1)[0]
+
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return json.load(f)
+
+    def _write(self, path, task):
+        with atomic_output(path) as tmp_path, open(tmp_path, 'w') as f:
+            json.dump(task, f)
+
+    def _now(self):
+        # Current time of the file server: the mtime of a freshly touched file
+        clock = os.path.join(self.path, '.clock')
+        with open(clock, 'a'):
+            os.utime(clock)
+        return os.stat(clock).st_mtime
+
+    def put(self, tasks):
+        """
+        Enqueue tasks (dicts with a unique, file-name-safe 'id').
+
+        A task that is already pending or leased is left alone; one that is
+        done or failed is queued again.
+
+        Returns
+        -------
+        int
+            Number of tasks queued.
+        """
+        active = {self._task_id(entry.name) for state in ('pending', 'leased') for entry in self._state_entries(state)}
+        finished = {self._task_id(entry.name): entry.path for state in ('done', 'failed')
+                    for entry in self._entries(state)}
+        queued = 0
+        for task in tasks:
+            if task['id'] in active:
+                continue
+            self._write(os.path.join(self._dir('pending'), f"{task['id']}.json"),
+                        {'id': task['id'], 'payload': task, 'attempts': 0, 'enqueued': time.time()})
+            if task['id'] in finished:
+                os.remove(finished[task['id']])
+            queued += 1
+        return queued
+
+    def claim(self, worker=None):
+        """
+        Lease one pending task.
+
+        Workers start from a random position among the oldest pending tasks
+        so that they rarely race for the same file.
+
+        Returns
+        -------
+        dict or None
+            The lease ('id', 'payload', 'attempts', 'token'), or None if
+            nothing is pending.
+        """
+        worker = worker or worker_id()
+        entries = sorted(self._entries('pending'), key=lambda entry: entry.name)
+        if not entries:
+            return None
+        head = entries[:64]
+        random.shuffle(head)
+        for entry in head + entries[64:]:
+            token = uuid.uuid4().hex[:12]
+            leased = os.path.join(self._dir('leased'), f'{self._task_id(entry.name)}~{token}.json')
+            try:
+                os.rename(entry.path, leased)
+            except FileNotFoundError:
+                continue
+            task = self._read(leased)
+            task.update(attempts=task['attempts'] + 1, worker=worker, started=time.time(), finished=None)
+            self._write(leased, task)
+            return {'id': task['id'], 'payload': task['payload'], 'attempts': task['attempts'], 'token': leased}
+        return None
+
+    def heartbeat(self, lease):
+        """Extend a lease; False if it has expired and been taken away."""
+        try:
+            os.utime(lease['token'])
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _finish(self, lease, state, **fields):
+        target = os.path.join(self._dir(state), f"{lease['id']}.json")
+        try:
+            os.rename(lease['token'], target)
+        except FileNotFoundError:
+            logging.warning(f"Lease of task {lease['id']} was lost before it finished; not marking it {state}")
+            return False
+        task = self._read(target)
+        task.update(finished=time.time(), **fields)
+        self._write(target, task)
+        return True
+
+    def complete(self, lease, result=None):
+        """Mark a leased task done; False if the lease was lost."""
+        return self._finish(lease, 'done', result=result)
+
+    def fail(self, lease, error, result=None):
+        """Mark a leased task failed (it is not retried until queued again); False if the lease was lost."""
+        return self._finish(lease, 'failed', error=str(error), result=result)
+
+    def _staged(self):
+        # Leases moved aside by ``requeue_expired``; one left behind belongs to a worker that died re-queuing it
+        try:
+            return [entry for entry in os.scandir(self._dir('pending'))
+                    if entry.name.startswith('.expired-') and entry.name.endswith('.json')]
+        except FileNotFoundError:
+            return []
+
+    def requeue_expired(self):
+        """
+        Return leases without a heartbeat for ``lease_seconds`` to pending.
+
+        A task that has already been claimed ``max_attempts`` times is marked
+        failed instead. Leases that another worker moved aside but never
+        re-queued (it died in between) are picked up the same way once they
+        are ``lease_seconds`` old.
+
+        Returns
+        -------
+        int
+            Number of expired leases.
+        """
+        now = self._now()
+        expired = 0
+        for entry in self._entries('leased') + self._staged():
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            # Renames update ctime, heartbeats mtime and ctime
+            if now - max(st.st_mtime, st.st_ctime) < self.lease_seconds:
+                continue
+            # Move it aside under a fresh name first: only one of several workers noticing the expiry wins the rename
+            task_id = self._task_id(entry.name)
+            staged = os.path.join(self._dir('pending'), f'.expired-{task_id}~{uuid.uuid4().hex[:12]}.json')
+            try:
+                os.rename(entry.path, staged)
+            except FileNotFoundError:
+                continue
+            task = self._read(staged)
+            if any(self._task_id(other.name) == task_id for state in STATES for other in self._entries(state)):
+                # A worker died after re-queuing the task but before removing its staged copy
+                os.remove(staged)
+                continue
+            logging.warning(f"Lease of task {task_id} held by {task.get('worker')} expired "
+                            f"(attempt {task['attempts']} of {self.max_attempts})")
+            if task['attempts'] >= self.max_attempts:
+                task.update(finished=time.time(), error=f"lease expired {task['attempts']} times")
+                self._write(os.path.join(self._dir('failed'), f'{task_id}.json'), task)
+            else:
+                task.update(worker=None, started=None)
+                self._write(os.path.join(self._dir('pending'), f'{task_id}.json'), task)
+            os.remove(staged)
+            expired += 1
+        return expired
+
+    def _state_entries(self, state):
+        # A lease moved aside for re-queuing is still in flight
+        return self._entries(state) + (self._staged() if state == 'leased' else [])
+
+    def counts(self):
+        """Number of tasks in every state."""
+        return {state: len(self._state_entries(state)) for state in STATES}
+
+    def records(self):
+        """
+        Every task as a dict with 'id', 'status', 'worker', 'attempts', 'enqueued', 'started', 'finished',
+        'error', 'payload' and 'result'.
+        """
+        records = []
+        for state in STATES:
+            for entry in self._state_entries(state):
+                try:
+                    task = self._read(entry.path)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue
+                records.append({
+                    'id': task['id'], 'status': state, 'worker': task.get('worker'), 'attempts': task['attempts'],
+                    'enqueued': task['enqueued'], 'started': task.get('started'), 'finished': task.get('finished'),
+                    'error': task.get('error'), 'payload': task['payload'], 'result': task.get('result'),
+                })
+        return records
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    token TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued REAL,
+    started REAL,
+    heartbeat REAL,
+    finished REAL,
+    error TEXT,
+    result TEXT
+)
+"""
+
+
+class SQLiteQueue:
+    """
+    Task queue in a local SQLite file, with the interface and semantics of ``DirectoryQueue``.
+
+    Meant for the worker processes of one machine (SQLite locking is not
+    reliable on network file systems); claims are ``BEGIN IMMEDIATE``
+    transactions, so concurrent claimers are serialized by SQLite.
+
+    Parameters
+    ----------
+    path : str
+        SQLite file.
+    lease_seconds, max_attempts
+        As in ``DirectoryQueue``.
+    """
+
+    def __init__(self, path, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self._transaction() as conn:
+            conn.execute(_SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def put(self, tasks):
+        """Enqueue tasks; see ``DirectoryQueue.put``."""
+        queued = 0
+        with self._transaction() as conn:
+            for task in tasks:
+                row = conn.execute('SELECT status FROM tasks WHERE id = ?', (task['id'],)).fetchone()
+                if row is not None and row[0] in ('pending', 'leased'):
+                    continue
+                conn.execute(
+                    'INSERT OR REPLACE INTO tasks (id, payload, status, attempts, enqueued) VALUES (?, ?, ?, 0, ?)',
+                    (task['id'], json.dumps(task), 'pending', time.time()),
+                )
+                queued += 1
+        return queued
+
+    def claim(self, worker=None):
+        """Lease the oldest pending task; see ``DirectoryQueue.claim``."""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, payload, attempts FROM tasks WHERE status = 'pending' ORDER BY enqueued, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            task_id, payload, attempts = row
+            token, now = uuid.uuid4().hex, time.time()
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, token = ?, attempts = ?, started = ?, heartbeat = ?, "
+                "finished = NULL WHERE id = ?",
+                (worker or worker_id(), token, attempts + 1, now, now, task_id),
+            )
+        return {'id': task_id, 'payload': json.loads(payload), 'attempts': attempts + 1, 'token': token}
+
+    def heartbeat(self, lease):
+        """Extend a lease; False if it has expired and been taken away."""
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE tasks SET heartbeat = ? WHERE id = ? AND token = ? AND status = 'leased'",
+                (time.time(), lease['id'], lease['token']),
+            ).rowcount
+        return bool(updated)
+
+    def _finish(self, lease, state, error=None, result=None):
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE tasks SET status = ?, finished = ?, error = ?, result = ? "
+                "WHERE id = ? AND token = ? AND status = 'leased'",
+                (state, time.time(), error, json.dumps(result, default=str), lease['id'], lease['token']),
+            ).rowcount
+        if not updated:
+            logging.warning(f"Lease of task {lease['id']} was lost before it finished; not marking it {state}")
+        return bool(updated)
+
+    def complete(self, lease, result=None):
+        """Mark a leased task done; False if the lease was lost."""
+        return self._finish(lease, 'done', result=result)
+
+    def fail(self, lease, error, result=None):
+        """Mark a leased task failed; False if the lease was lost."""
+        return self._finish(lease, 'failed', error=str(error), result=result)
+
+    def requeue_expired(self):
+        """Return expired leases to pending (or failed after ``max_attempts``); see ``DirectoryQueue``."""
+        deadline = time.time() - self.lease_seconds
+        with self._transaction() as conn:
+            failed = conn.execute(
+                "UPDATE tasks SET status = 'failed', finished = ?, error = 'lease expired ' || attempts || ' times' "
+                "WHERE status = 'leased' AND heartbeat < ? AND attempts >= ?",
+                (time.time(), deadline, self.max_attempts),
+            ).rowcount
+            requeued = conn.execute(
+                "UPDATE tasks SET status = 'pending', worker = NULL, token = NULL, started = NULL "
+                "WHERE status = 'leased' AND heartbeat < ?",
+                (deadline,),
+            ).rowcount
+        if failed or requeued:
+            logging.warning(f"Re-queued {requeued} and failed {failed} expired leases")
+        return failed + requeued
+
+    def counts(self):
+        """Number of tasks in every state."""
+        with self._transaction() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return {state: dict(rows).get(state, 0) for state in STATES}
+
+    def records(self):
+        """Every task as a dict; see ``DirectoryQueue.records``."""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, status, worker, attempts, enqueued, started, finished, error, payload, result FROM tasks'
+            ).fetchall()
+        keys = ('id', 'status', 'worker', 'attempts', 'enqueued', 'started', 'finished', 'error')
+        return [{**dict(zip(keys, row)), 'payload': json.loads(row[8]), 'result': json.loads(row[9] or 'null')}
+                for row in rows]
+
+
+@contextmanager
+def heartbeats(queue, lease, interval):
+    """Heartbeat ``lease`` every ``interval`` seconds from a background thread while the block runs."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            if not queue.heartbeat(lease):
+                logging.warning(f"Lost the lease of task {lease['id']}; it has been re-queued")
+                return
+
+    thread = threading.Thread(target=beat, name=f"heartbeat-{lease['id']}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_worker(queue, handle, worker=None, poll_seconds=10, max_tasks=None):
+    """
+    Claim and process tasks until the whole queue is finished.
+
+    Every worker pulls its next task as soon as it is free, so faster nodes
+    and processes take more tasks. Expired leases of other workers are
+    re-queued on the way. When nothing is pending but other workers still
+    hold leases, the worker waits and polls, ready to pick up a task whose
+    lease expires. It returns only when every task is done or failed.
+
+    Parameters
+    ----------
+    queue : DirectoryQueue or SQLiteQueue
+    handle : callable
+        Called with a task's payload; its return value is stored as the
+        result, and an exception marks the task failed (``TaskFailed``
+        stores its result too).
+    worker : str, optional
+        Worker name (default: '<host>-<pid>').
+    poll_seconds : float
+        Wait between polls while other workers hold the remaining tasks.
+    max_tasks : int, optional
+        Stop after this many tasks.
+
+    Returns
+    -------
+    list of (payload, result)
+        The tasks this worker completed (result None for failed tasks).
+    """
+    worker = worker or worker_id()
+    processed = []
+    while max_tasks is None or len(processed) < max_tasks:
+        queue.requeue_expired()
+        lease = queue.claim(worker)
+        if lease is None:
+            if not queue.counts()['leased']:
+                break
+            time.sleep(poll_seconds)
+            continue
+        logging.info(f"{worker} claimed task {lease['id']} (attempt {lease['attempts']})")
+        try:
+            with heartbeats(queue, lease, queue.lease_seconds / 3):
+                result = handle(lease['payload'])
+        except TaskFailed as e:
+            logging.error(f"Task {lease['id']} failed: {e}")
+            queue.fail(lease, str(e), e.result)
+            processed.append((lease['payload'], None))
+            continue
+        except Exception as e:
+            logging.exception(f"Task {lease['id']} failed")
+            queue.fail(lease, repr(e))
+            processed.append((lease['payload'], None))
+            continue
+        queue.complete(lease, result)
+        processed.append((lease['payload'], result))
+    return processed
+
+
+def progress(records, now=None):
+    """
+    Cohort-wide progress and ETA from a queue's ``records()``.
+
+    The rate is the number of finished tasks over the time since the first
+    one started; the ETA is the unfinished tasks at that rate.
+
+    Returns
+    -------
+    dict
+        'counts' per state, 'rate_per_hour', 'eta_s' (None before the first
+        finished task), per-host 'hosts' ({'done', 'failed', 'leased',
+        'mean_task_s'}) and the 'failed' task ids with their errors.
+    """
+    now = now or time.time()
+    counts = dict.fromkeys(STATES, 0)
+    hosts = defaultdict(lambda: {'done': 0, 'failed': 0, 'leased': 0, 'task_s': 0.0})
+    for record in records:
+        counts[record['status']] += 1
+        if record['worker']:
+            host = hosts[record['worker'].rsplit('-', 1)[0]]
+            if record['status'] in host:
+                host[record['status']] += 1
+            if record['status'] == 'done' and record['started'] and record['finished']:
+                host['task_s'] += record['finished'] - record['started']
+    starts = [record['started'] for record in records if record['started']]
+    finished = counts['done'] + counts['failed']
+    elapsed = now - min(starts) if starts else 0
+    rate = finished / elapsed if finished and elapsed > 0 else None
+    remaining = counts['pending'] + counts['leased']
+    return {
+        'counts': counts,
+        'rate_per_hour': rate * 3600 if rate else None,
+        'eta_s': remaining / rate if rate else None,
+        'hosts': {
+            name: {'done': host['done'], 'failed': host['failed'], 'leased': host['leased'],
+                   'mean_task_s': host['task_s'] / host['done'] if host['done'] else None}
+            for name, host in sorted(hosts.items())
+        },
+        'failed': {record['id']: record['error'] for record in records if record['status'] == 'failed'},
+    }
+
+
+def format_progress(summary):
+    """Human-readable text of ``progress`` output."""
+    counts = summary['counts']
+    total = sum(counts.values())
+    lines = [
+        f"Tasks: {total} ({', '.join(f'{state} {counts[state]}' for state in STATES)}), "
+        f"{100 * (counts['done'] + counts['failed']) / max(total, 1):.1f}% finished"
+    ]
+    if summary['eta_s'] is not None:
+        lines.append(f"Rate: {summary['rate_per_hour']:.1f} tasks/h, ETA: {summary['eta_s'] / 3600:.2f} h")
+    if summary['hosts']:
+        lines.append('')
+        lines.append('Host                            done  failed  leased  mean task s')
+        for name, host in summary['hosts'].items():
+            mean = f"{host['mean_task_s']:.1f}" if host['mean_task_s'] is not None else '-'
+            lines.append(f"{name:<30} {host['done']:>5} {host['failed']:>7} {host['leased']:>7} {mean:>12}")
+    for task_id, error in sorted(summary['failed'].items())[:20]:
+        lines.append(f"  failed {task_id}: {error}")
+    return '\n'.join(lines)
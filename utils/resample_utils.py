@@ -0,0 +1,141 @@
+import logging
+import nibabel as nib
+import numpy as np
+
+
+def fsl_voxel_to_mm(shape, zooms, affine):
+    """
+    Matrix from voxel indices to FSL "scaled voxel" millimetre coordinates.
+
+    FSL tools (flirt, applywarp) work in voxel * pixdim coordinates, with the
+    x axis reversed when the image has a neurological (positive determinant)
+    voxel-to-world matrix.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Spatial shape (x, y, z) of the image.
+    zooms : tuple of float
+        Voxel sizes in mm.
+    affine : np.ndarray
+        4x4 voxel-to-world matrix, only used for its orientation.
+
+    Returns
+    -------
+    np.ndarray
+        4x4 voxel-to-FSL-mm matrix.
+    """
+    vox2mm = np.diag([float(zooms[0]), float(zooms[1]), float(zooms[2]), 1.0])
+    if np.linalg.det(affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        vox2mm = vox2mm @ flip
+    return vox2mm
+
+
+def isotropic_grid(shape, zooms, affine, voxel_size):
+    """
+    Output grid of ``flirt -ref img -in img -applyisoxfm <voxel_size>``.
+
+    The field of view of the input is kept and divided into isotropic voxels
+    of ``voxel_size`` mm, the way flirt resamples its reference volume.
+
+    Returns
+    -------
+    out_shape : tuple of int
+        Spatial shape of the isotropic grid.
+    out_affine : np.ndarray
+        4x4 voxel-to-world matrix of the isotropic grid.
+    out_to_in : np.ndarray
+        4x4 matrix from output voxel indices to (fractional) input voxel indices.
+    """
+    out_shape = tuple(
+        max(1, int(np.floor(n * z / voxel_size + 0.5))) for n, z in zip(shape[:3], zooms[:3])
+    )
+    in_vox2mm = fsl_voxel_to_mm(shape, zooms, affine)
+    out_vox2mm = fsl_voxel_to_mm(out_shape, (voxel_size,) * 3, affine)
+    out_to_in = np.linalg.inv(in_vox2mm) @ out_vox2mm
+    out_affine = affine @ out_to_in
+    return out_shape, out_affine, out_to_in
+
+
+def nearest_axis_indices(shape, out_shape, out_to_in):
+    """
+    Nearest input index along each axis for every output index.
+
+    ``out_to_in`` only scales and shifts each axis independently, so the
+    nearest-neighbour lookup is separable into three 1D index arrays.
+    Indices falling outside the input field of view are -1.
+    """
+    indices = []
+    for axis in range(3):
+        coords = out_to_in[axis, axis] * np.arange(out_shape[axis]) + out_to_in[axis, 3]
+        idx = np.floor(coords + 0.5).astype(np.intp)
+        idx[(idx < 0) | (idx >= shape[axis])] = -1
+        indices.append(idx)
+    return indices
+
+
+def resample_isotropic_nearest(data, affine, zooms, voxel_size=3.0):
+    """
+    Nearest-neighbour isotropic resampling of a 3D or 4D array in one gather.
+
+    Equivalent to running ``flirt -applyisoxfm <voxel_size> -interp
+    nearestneighbour`` on every volume and merging the results, but the time
+    axis is carried along by a single fancy-index gather.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Array of shape (x, y, z) or (x, y, z, num_timepoints).
+    affine : np.ndarray
+        4x4 voxel-to-world matrix of ``data``.
+    zooms : tuple of float
+        Voxel sizes of ``data`` in mm.
+    voxel_size : float
+        Output isotropic voxel size in mm.
+
+    Returns
+    -------
+    resampled : np.ndarray
+        Array on the isotropic grid, same dtype as ``data``; voxels outside
+        the input field of view are zero.
+    out_affine : np.ndarray
+        4x4 voxel-to-world matrix of ``resampled``.
+    """
+    out_shape, out_affine, out_to_in = isotropic_grid(data.shape, zooms, affine, voxel_size)
+    ix, iy, iz = nearest_axis_indices(data.shape, out_shape, out_to_in)
+    valid_x, valid_y, valid_z = ix >= 0, iy >= 0, iz >= 0
+
+    resampled = np.zeros(out_shape + data.shape[3:], dtype=data.dtype)
+    resampled[np.ix_(valid_x, valid_y, valid_z)] = data[np.ix_(ix[valid_x], iy[valid_y], iz[valid_z])]
+    return resampled, out_affine
+
+
+def resample_image_isotropic(img, voxel_size=3.0):
+    """
+    Resample a NIfTI image onto an isotropic grid with nearest neighbour.
+
+    Parameters
+    ----------
+    img : nib.Nifti1Image
+        3D or 4D image (e.g., the applywarp output 'Atlas_in_T1w_all.nii.gz').
+    voxel_size : float
+        Output isotropic voxel size in mm.
+
+    Returns
+    -------
+    nib.Nifti1Image
+        Resampled image with the header of ``img`` (TR and units preserved).
+    """
+    data = np.asanyarray(img.dataobj)
+    zooms = img.header.get_zooms()
+    resampled, out_affine = resample_isotropic_nearest(data, img.affine, zooms, voxel_size)
+
+    header = img.header.copy()
+    header.set_data_dtype(resampled.dtype)
+    out_img = nib.Nifti1Image(resampled, out_affine, header)
+    out_img.header.set_zooms((voxel_size,) * 3 + tuple(zooms[3:]))
+    logging.info(f"Resampled {data.shape} to {resampled.shape} at {voxel_size} mm")
+    return out_img
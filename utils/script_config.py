@@ -0,0 +1,58 @@
+import os
+from multiprocessing import cpu_count
+from . import telemetry_utils as telemetry
+from .catalog_utils import CATALOG_NAME
+from .exec_utils import Executor, estimate_costs
+from .manifest_utils import MANIFEST_NAME
+
+# Settings shared by the three stand-alone scripts (registration, striatum and
+# cortex extraction); each script keeps only the settings of its own stage
+
+# Set the root directory for HCP data
+hcp_dir = '/home/test/lmq/data/HCP'
+
+# Worker processes per script
+num_workers = 5
+
+# Run manifest shared with pipeline.py (None disables it): runs whose inputs and
+# parameters are unchanged since the last successful run of a script's stage are
+# skipped unless force is set
+manifest_file = os.path.join(hcp_dir, MANIFEST_NAME)
+force = False
+
+# Dataset catalog used to plan the runs (None lists the directories instead)
+catalog_file = os.path.join(hcp_dir, CATALOG_NAME)
+
+# Per-stage and per-command telemetry (JSON lines; None disables) and an optional
+# Prometheus textfile rewritten with the batch summary
+telemetry_file = os.path.join(hcp_dir, '.telemetry', 'telemetry.jsonl')
+prometheus_file = None
+
+# External tools: concurrent invocations per tool on this node (shared by all
+# workers), threads per invocation, and timeout (s) and retries per command
+tool_limits = {'applywarp': 2, 'wb_command': 2}
+command_threads = max(1, cpu_count() // num_workers)
+command_timeout = 3 * 3600
+command_retries = 1
+
+# Executor of this process, created by command_executor()
+_executor = None
+
+
+def command_executor(dry_run=False):
+    """
+    The executor of this process's external commands, configured from the settings above on first use.
+
+    Parameters
+    ----------
+    dry_run : bool
+        Plan the commands instead of running them, with costs estimated from
+        ``telemetry_file``; only the first call of a process decides.
+    """
+    global _executor
+    if _executor is None:
+        _executor = Executor(
+            tool_limits, threads=command_threads, timeout=command_timeout, retries=command_retries, dry_run=dry_run,
+            cost_estimates=estimate_costs(telemetry.load_records(telemetry_file)) if dry_run and telemetry_file else None,
+        )
+    return _executor
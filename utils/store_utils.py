@@ -0,0 +1,386 @@
+import json
+import logging
+import os
+import platform
+import time
+import nibabel as nib
+import numpy as np
+from .io_utils import atomic_output
+
+try:
+    import h5py
+except ImportError:  # optional: the NPY backend needs only NumPy
+    h5py = None
+
+# Rows per HDF5 chunk; each chunk holds complete time series so one region's
+# voxel or parcel can be read without touching the rest of the array.
+CHUNK_ROWS = 128
+COMPRESSION_LEVEL = 4
+COHORT_INDEX = 'cohort_index.json'
+
+
+def resolve_backend(backend='auto'):
+    """Map 'auto' to 'hdf5' when h5py is installed and 'npy' otherwise."""
+    if backend == 'auto':
+        return 'hdf5' if h5py is not None else 'npy'
+    if backend == 'hdf5' and h5py is None:
+        raise ImportError("The 'hdf5' output backend requires h5py (pip install h5py); use 'npy' instead")
+    if backend not in ('hdf5', 'npy', 'csv'):
+        raise ValueError(f"Unsupported output backend: {backend}")
+    return backend
+
+
+def provenance(**sources):
+    """Provenance record: creation time, host, library versions and the given sources/parameters."""
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': platform.node(),
+        'numpy': np.__version__,
+        'nibabel': nib.__version__,
+        **sources,
+    }
+
+
+class TimeSeriesWriter:
+    """
+    Incrementally store one region's time series of one run.
+
+    The array is preallocated with its final shape (an HDF5 dataset or an
+    '.npy' memmap in a temporary file) and filled one block of time points at
+    a time, so a run can be written while it is being computed. ``close``
+    renames the files into place; ``abort`` (or an exception inside a
+    ``with`` block) removes them. The CSV backend cannot be written by
+    columns and keeps the array in memory until ``close``.
+
+    Parameters
+    ----------
+    run_dir, region, label_ids, label_names, coords, meta, backend
+        As in ``write_time_series``.
+    shape : tuple of int
+        Final shape (num_rows, num_timepoints).
+
+    Example
+    -------
+    >>> with TimeSeriesWriter(run_dir, 'striatum_L', (num_voxels, num_timepoints)) as writer:
+    ...     for start, stop in time_chunks(num_timepoints, 100):
+    ...         writer.write(start, compute_block(start, stop))
+    """
+
+    def __init__(self, run_dir, region, shape, label_ids=None, label_names=None, coords=None,
+                 meta=None, backend='auto'):
+        self.backend = resolve_backend(backend)
+        self.region = region
+        self.run_dir = run_dir
+        self.shape = tuple(int(n) for n in shape)
+        self.label_ids = label_ids
+        self.label_names = label_names
+        self.coords = coords
+        self.meta = dict(meta or {})
+        os.makedirs(run_dir, exist_ok=True)
+
+        extension = 'h5' if self.backend == 'hdf5' else self.backend
+        self.path = os.path.join(run_dir, f'{region}.{extension}')
+        self._output = atomic_output(self.path)
+        tmp_path = self._output.__enter__()
+        if self.backend == 'hdf5':
+            self._file = h5py.File(tmp_path, 'w')
+            # Empty arrays cannot be chunked
+            storage = {}
+            if self.shape[0] and self.shape[1]:
+                storage = {
+                    'chunks': (min(CHUNK_ROWS, self.shape[0]), self.shape[1]),
+                    'compression': 'gzip',
+                    'compression_opts': COMPRESSION_LEVEL,
+                    'shuffle': True,
+                }
+            self._data = self._file.create_dataset('time_series', shape=self.shape, dtype=np.float32, **storage)
+        elif self.backend == 'npy':
+            self._data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=self.shape)
+        else:
+            self._data = np.empty(self.shape, dtype=np.float32)
+        self._tmp_path = tmp_path
+        self.closed = False
+
+    def write(self, start, block):
+        """Store ``block`` (num_rows, num_timepoints_in_block) at time points ``start:start + block.shape[1]``."""
+        block = np.asarray(block, dtype=np.float32)
+        self._data[:, start:start + block.shape[1]] = block
+
+    def close(self):
+        """Finish the files and rename them into place; returns the array path."""
+        self.closed = True
+        if self.backend == 'hdf5':
+            f = self._file
+            if self.label_ids is not None:
+                f.create_dataset('label_ids', data=np.asarray(self.label_ids))
+            if self.label_names is not None:
+                f.create_dataset('label_names', data=np.asarray(self.label_names, dtype=h5py.string_dtype()))
+            if self.coords is not None:
+                f.create_dataset('coords', data=np.asarray(self.coords, dtype=np.int32))
+            f.attrs['meta'] = json.dumps(self.meta)
+            f.close()
+            self._output.__exit__(None, None, None)
+        else:
+            if self.backend == 'npy':
+                self._data.flush()
+                del self._data
+            else:
+                np.savetxt(self._tmp_path, self._data, delimiter=",")
+            self._output.__exit__(None, None, None)
+            meta = dict(self.meta)
+            if self.label_ids is not None:
+                meta['label_ids'] = np.asarray(self.label_ids).tolist()
+            if self.label_names is not None:
+                meta['label_names'] = list(self.label_names)
+            if self.coords is not None:
+                with atomic_output(os.path.join(self.run_dir, f'{self.region}.coords.npy')) as tmp_path:
+                    np.save(tmp_path, np.asarray(self.coords, dtype=np.int32))
+            with atomic_output(os.path.join(self.run_dir, f'{self.region}.json')) as tmp_path, \
+                    open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+        logging.info(f"Saved {self.region} time series to {self.path} with shape {self.shape}")
+        return self.path
+
+    def abort(self):
+        """Discard everything written so far; does nothing once closed."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.backend == 'hdf5':
+            self._file.close()
+        elif self.backend == 'npy':
+            del self._data
+        error = RuntimeError(f"Aborted writing {self.path}")
+        try:
+            self._output.__exit__(RuntimeError, error, None)
+        except RuntimeError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def write_time_series(run_dir, region, data, label_ids=None, label_names=None, coords=None,
+                      meta=None, backend='auto'):
+    """
+    Store one region's time series of one run as a float32 array.
+
+    Parameters
+    ----------
+    run_dir : str
+        Output directory of the run (e.g., '<subject>/fMRI/phase1_LR').
+    region : str
+        Region name, e.g. 'striatum_L' or 'cortex_L_aparc.a2009s'.
+    data : np.ndarray
+        Array of shape (num_rows, num_timepoints).
+    label_ids, label_names : sequence, optional
+        One label per row (parcel-averaged regions).
+    coords : np.ndarray, optional
+        Voxel coordinates of shape (num_rows, 3) (voxel-level regions).
+    meta : dict, optional
+        Extra metadata such as ``provenance(...)`` and masks converted to lists.
+    backend : {'auto', 'hdf5', 'npy', 'csv'}
+        'hdf5' writes '<region>.h5' (chunked, gzip-compressed); 'npy' and
+        'csv' write '<region>.npy' or '<region>.csv' plus '<region>.json'.
+
+    Returns
+    -------
+    str
+        Path of the written array file.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    with TimeSeriesWriter(run_dir, region, data.shape, label_ids=label_ids, label_names=label_names,
+                          coords=coords, meta=meta, backend=backend) as writer:
+        writer.write(0, data)
+    return writer.path
+
+
+def load_time_series(run_dir, region):
+    """
+    Open one region's time series lazily.
+
+    Returns
+    -------
+    data : h5py.Dataset or np.memmap
+        Array-like of shape (num_rows, num_timepoints); slicing reads only
+        the requested rows.
+    meta : dict
+        Stored metadata with 'label_ids', 'label_names' and 'coords' when present.
+    """
+    h5_path = os.path.join(run_dir, f'{region}.h5')
+    if os.path.exists(h5_path):
+        if h5py is None:
+            raise ImportError(f"Reading {h5_path} requires h5py")
+        f = h5py.File(h5_path, 'r')
+        meta = json.loads(f.attrs.get('meta', '{}'))
+        if 'label_ids' in f:
+            meta['label_ids'] = f['label_ids'][()].tolist()
+        if 'label_names' in f:
+            meta['label_names'] = [name.decode() if isinstance(name, bytes) else name for name in f['label_names'][()]]
+        if 'coords' in f:
+            meta['coords'] = f['coords'][()]
+        return f['time_series'], meta
+
+    npy_path = os.path.join(run_dir, f'{region}.npy')
+    csv_path = os.path.join(run_dir, f'{region}.csv')
+    if os.path.exists(npy_path):
+        data = np.load(npy_path, mmap_mode='r')
+    elif os.path.exists(csv_path):
+        data = np.loadtxt(csv_path, delimiter=",", ndmin=2, dtype=np.float32)
+    else:
+        raise FileNotFoundError(f"No stored time series for {region} in {run_dir}")
+    with open(os.path.join(run_dir, f'{region}.json')) as f:
+        meta = json.load(f)
+    coords_path = os.path.join(run_dir, f'{region}.coords.npy')
+    if os.path.exists(coords_path):
+        meta['coords'] = np.load(coords_path)
+    return data, meta
+
+
+def list_regions(run_dir):
+    """
+    Names of the regions stored in a run directory.
+
+    Hidden files are skipped, among them the '.tmp-*' files of writes in
+    progress (or left behind by a killed worker, see ``atomic_output``).
+    """
+    regions = set()
+    for name in os.listdir(run_dir):
+        if name.startswith('.'):
+            continue
+        if name.endswith('.h5'):
+            regions.add(name[:-3])
+        elif name.endswith('.npy') and not name.endswith('.coords.npy'):
+            regions.add(name[:-4])
+        elif name.endswith('.csv') and os.path.exists(os.path.join(run_dir, name[:-4] + '.json')):
+            regions.add(name[:-4])
+    return sorted(regions)
+
+
+def close_store(data):
+    """Close the HDF5 file behind an array returned by ``load_time_series`` (no-op for other backends)."""
+    if h5py is not None and isinstance(data, h5py.Dataset):
+        data.file.close()
+
+
+def iter_run_dirs(hcp_dir, subjects=None):
+    """Yield (subject, run, run_dir) for every '<subject>/fMRI/<run>' directory."""
+    for subject in sorted(subjects or os.listdir(hcp_dir)):
+        fmri_dir = os.path.join(hcp_dir, subject, 'fMRI')
+        if not os.path.isdir(fmri_dir):
+            continue
+        for run in sorted(os.listdir(fmri_dir)):
+            run_dir = os.path.join(fmri_dir, run)
+            if os.path.isdir(run_dir):
+                yield subject, run, run_dir
+
+
+def consolidate_cohort(hcp_dir, cohort_path, regions=None, subjects=None, backend='auto'):
+    """
+    Gather every subject's per-run stores into one cohort-level store.
+
+    With HDF5 the cohort store is a single file laid out as
+    '/<region>/<subject>/<run>'. With NPY it is a directory holding one
+    '<region>.npy' with all runs concatenated along the rows, plus
+    'cohort_index.json' with the row range of every (subject, run). The
+    '<region>.npy' is preallocated as a memmap and filled one run at a time,
+    so memory use does not grow with the cohort.
+
+    Parameters
+    ----------
+    hcp_dir : str
+        HCP root directory.
+    cohort_path : str
+        Output '.h5' file (HDF5) or directory (NPY).
+    regions : list of str, optional
+        Regions to include; all stored regions by default.
+    subjects : list of str, optional
+        Subjects to include; all by default.
+    """
+    backend = resolve_backend(backend)
+    entries = {}
+    for subject, run, run_dir in iter_run_dirs(hcp_dir, subjects):
+        for region in list_regions(run_dir):
+            if regions is None or region in regions:
+                entries.setdefault(region, []).append((subject, run, run_dir))
+
+    if backend == 'hdf5':
+        with h5py.File(cohort_path, 'w') as out:
+            for region, runs in entries.items():
+                for subject, run, run_dir in runs:
+                    data, meta = load_time_series(run_dir, region)
+                    dataset = out.create_dataset(
+                        f'{region}/{subject}/{run}', data=data[()],
+                        chunks=True, compression='gzip', compression_opts=COMPRESSION_LEVEL, shuffle=True,
+                    )
+                    if 'label_ids' in meta:
+                        dataset.attrs['label_ids'] = meta['label_ids']
+                    close_store(data)
+        logging.info(f"Consolidated {len(entries)} regions into {cohort_path}")
+        return cohort_path
+
+    os.makedirs(cohort_path, exist_ok=True)
+    index = {}
+    for region, runs in entries.items():
+        # Shapes and label ids first, so the output can be preallocated
+        shapes, dtypes, label_ids = [], [], []
+        for _, _, run_dir in runs:
+            data, meta = load_time_series(run_dir, region)
+            shapes.append(data.shape)
+            dtypes.append(data.dtype)
+            label_ids.append(meta.get('label_ids'))
+            close_store(data)
+        num_timepoints = {shape[1] for shape in shapes}
+        if len(num_timepoints) > 1:
+            raise ValueError(f"Runs of {region} have different lengths {sorted(num_timepoints)}; use the HDF5 backend")
+        offsets = np.cumsum([0] + [shape[0] for shape in shapes])
+        with atomic_output(os.path.join(cohort_path, f'{region}.npy')) as tmp_path:
+            out = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.result_type(*dtypes), shape=(int(offsets[-1]), num_timepoints.pop())
+            )
+            for (_, _, run_dir), start, stop in zip(runs, offsets[:-1], offsets[1:]):
+                data, _ = load_time_series(run_dir, region)
+                out[start:stop] = data[:]
+                close_store(data)
+            out.flush()
+            del out
+        index[region] = [
+            {'subject': subject, 'run': run, 'start': int(start), 'stop': int(stop), 'label_ids': ids}
+            for (subject, run, _), ids, start, stop in zip(runs, label_ids, offsets[:-1], offsets[1:])
+        ]
+    with atomic_output(os.path.join(cohort_path, COHORT_INDEX)) as tmp_path, open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    logging.info(f"Consolidated {len(entries)} regions into {cohort_path}")
+    return cohort_path
+
+
+def load_cohort_region(cohort_path, region):
+    """
+    Read one region across all subjects from a consolidated cohort store.
+
+    Returns
+    -------
+    dict
+        (subject, run) -> lazily read array of shape (num_rows, num_timepoints).
+    """
+    if os.path.isdir(cohort_path):
+        with open(os.path.join(cohort_path, COHORT_INDEX)) as f:
+            index = json.load(f)[region]
+        data = np.load(os.path.join(cohort_path, f'{region}.npy'), mmap_mode='r')
+        return {(e['subject'], e['run']): data[e['start']:e['stop']] for e in index}
+
+    if h5py is None:
+        raise ImportError(f"Reading {cohort_path} requires h5py")
+    f = h5py.File(cohort_path, 'r')
+    return {
+        (subject, run): dataset
+        for subject, runs in f[region].items()
+        for run, dataset in runs.items()
+    }
@@ -0,0 +1,132 @@
+import logging
+import nibabel as nib
+import numpy as np
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import seek_tell
+from .io_utils import atomic_output
+
+# Time points per chunk in streaming mode; peak memory per worker scales with
+# this instead of with the run length.
+DEFAULT_STREAM_CHUNK_SIZE = 100
+
+
+def time_chunks(num_timepoints, chunk_size):
+    """(start, stop) ranges covering ``num_timepoints`` in chunks of ``chunk_size``."""
+    chunk_size = chunk_size or num_timepoints or 1
+    return [(start, min(start + chunk_size, num_timepoints)) for start in range(0, num_timepoints, chunk_size)]
+
+
+def iter_time_chunks(dataobj, chunk_size, time_axis=-1, dtype=np.float32):
+    """
+    Read an array-like in consecutive blocks along its time axis.
+
+    Parameters
+    ----------
+    dataobj : nibabel ArrayProxy or np.ndarray
+        E.g. ``img.dataobj`` of a 4D NIfTI (time last) or of a CIFTI dense
+        time series (time first, ``time_axis=0``). Only the requested block is
+        read; for '.gz' files load the image with ``keep_file_open=True`` so
+        that consecutive blocks continue decompression instead of restarting.
+    chunk_size : int
+        Time points per block.
+    time_axis : {0, -1}
+        Position of the time axis.
+
+    Yields
+    ------
+    (start, stop, block)
+        ``block`` holds time points start:stop as ``dtype``.
+    """
+    num_timepoints = dataobj.shape[time_axis]
+    for start, stop in time_chunks(num_timepoints, chunk_size):
+        if time_axis == 0:
+            block = dataobj[start:stop]
+        else:
+            block = dataobj[..., start:stop]
+        yield start, stop, np.asarray(block, dtype=dtype)
+
+
+class NiftiStreamWriter:
+    """
+    Write a 4D NIfTI file one block of time points at a time.
+
+    NIfTI stores voxels in Fortran order with time slowest, so consecutive
+    time blocks are consecutive byte ranges and can be appended (through
+    gzip for '.nii.gz') without holding the whole run. The header matches
+    ``utils.cifti_utils.save_volume`` and the file is renamed into place on
+    ``close``.
+
+    Parameters
+    ----------
+    path : str
+        Output path ('.nii' or '.nii.gz').
+    shape : tuple of int
+        Final shape (x, y, z, num_timepoints).
+    affine : np.ndarray
+        4x4 voxel-to-world matrix.
+    tr : float, optional
+        Repetition time in seconds.
+    """
+
+    def __init__(self, path, shape, affine, tr=None, dtype=np.float32):
+        self.path = path
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        # A zero-strided placeholder gives nibabel the shape and dtype without allocating the data
+        img = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype=self.dtype), self.shape), affine)
+        img.header.set_xyzt_units('mm', 'sec')
+        if tr is not None:
+            zooms = img.header.get_zooms()
+            img.header.set_zooms(zooms[:3] + (tr,))
+        img.update_header()
+        header = img.header
+        header.set_slope_inter(None, None)
+
+        self._output = atomic_output(path)
+        self._file = ImageOpener(self._output.__enter__(), 'wb')
+        header.write_to(self._file)
+        seek_tell(self._file, header.get_data_offset(), write0=True)
+        self.num_written = 0
+        self.closed = False
+
+    def write(self, block):
+        """Append the next block of shape (x, y, z, num_timepoints_in_block)."""
+        block = np.asarray(block, dtype=self.dtype)
+        if block.shape[:3] != self.shape[:3] or self.num_written + block.shape[3] > self.shape[3]:
+            raise ValueError(f"Block of shape {block.shape} does not fit {self.path} of shape {self.shape} "
+                             f"after {self.num_written} time points")
+        self._file.write(block.tobytes(order='F'))
+        self.num_written += block.shape[3]
+
+    def close(self):
+        """Check that every time point was written and rename the file into place."""
+        if self.num_written != self.shape[3]:
+            self.abort()
+            raise ValueError(f"Only {self.num_written} of {self.shape[3]} time points written to {self.path}")
+        self.closed = True
+        self._file.close()
+        self._output.__exit__(None, None, None)
+        logging.info(f"Saved volume to {self.path}")
+        return self.path
+
+    def abort(self):
+        """Discard the partial file; does nothing once closed."""
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        error = RuntimeError(f"Aborted writing {self.path}")
+        try:
+            self._output.__exit__(RuntimeError, error, None)
+        except RuntimeError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
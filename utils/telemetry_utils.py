@@ -0,0 +1,366 @@
+import glob
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from .io_utils import atomic_output
+
+# Telemetry settings of the current process; see ``configure``
+_settings = {'jsonl_path': None}
+# Per-thread state: tags (subject, phase, direction, ...) attached to every
+# record, and the names of the stages currently open, outermost first
+_local = threading.local()
+# Peak RSS bookkeeping of the stages open in this process, in all threads: the
+# process-wide high-water mark is reset when a stage starts, so the value reached
+# until then is folded into every stage still open first
+_peaks_lock = threading.Lock()
+_open_peaks = []
+
+
+def _state():
+    if not hasattr(_local, 'tags'):
+        _local.tags = {}
+        _local.open_stages = []
+    return _local
+
+
+def host_path(jsonl_path, host=None):
+    """Per-host sibling of a telemetry file, e.g. 'telemetry.node07.jsonl' for 'telemetry.jsonl'."""
+    stem, ext = os.path.splitext(jsonl_path)
+    return f'{stem}.{host or socket.gethostname()}{ext}'
+
+
+def configure(jsonl_path=None, per_host=False):
+    """
+    Send telemetry records of this process to a JSON-lines file.
+
+    Every process (including pool workers) appends whole lines to the same
+    file, so one file collects a whole batch. ``None`` disables recording.
+    With ``per_host`` the records go to the host's own sibling file
+    (``host_path``) instead: appends from several NFS clients to one file
+    can interleave, so every node of a multi-node batch writes its own.
+    ``load_records`` reads a file together with its per-host siblings.
+    """
+    if jsonl_path and per_host:
+        jsonl_path = host_path(jsonl_path)
+    _settings['jsonl_path'] = jsonl_path
+    if jsonl_path:
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+
+
+def io_counters():
+    """(read_bytes, write_bytes, rchar, wchar) of this process from /proc/self/io; zeros elsewhere."""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return tuple(int(fields[key]) for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'))
+    except OSError:
+        return 0, 0, 0, 0
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process over its whole lifetime in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_high_water_mb():
+    """Resident set size high-water mark (VmHWM) of this process in MB, or None where /proc is missing."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_rss_high_water():
+    """Reset VmHWM to the current RSS (Linux: write 5 to /proc/self/clear_refs); False where unsupported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _open_stage_peaks():
+    """Start tracking the peak RSS of a stage; returns its record for ``_close_stage_peaks``."""
+    peaks = {'thread': threading.get_ident(), 'rss_mb': 0.0, 'children_rss_mb': None, 'per_stage': False}
+    with _peaks_lock:
+        high_water = rss_high_water_mb()
+        if high_water is not None:
+            for other in _open_peaks:
+                other['rss_mb'] = max(other['rss_mb'], high_water)
+            peaks['per_stage'] = reset_rss_high_water()
+        _open_peaks.append(peaks)
+    return peaks
+
+
+def _close_stage_peaks(peaks):
+    """Stop tracking a stage; returns its peak RSS in MB and whether it covers the stage alone."""
+    with _peaks_lock:
+        _open_peaks[:] = [other for other in _open_peaks if other is not peaks]
+        if not peaks['per_stage']:
+            return peak_rss_mb(), False
+        return max(peaks['rss_mb'], rss_high_water_mb()), True
+
+
+def emit(record):
+    """Append one record (with the current tags, host and pid) to the JSON-lines file."""
+    record = {'time': time.time(), 'host': socket.gethostname(), 'pid': os.getpid(), **_state().tags, **record}
+    logging.debug(f"Telemetry: {record}")
+    if _settings['jsonl_path']:
+        with open(_settings['jsonl_path'], 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def tagged(**tags):
+    """Attach tags such as subject/phase/direction to every record of this thread inside the block."""
+    state = _state()
+    previous = dict(state.tags)
+    state.tags.update(tags)
+    try:
+        yield
+    finally:
+        state.tags = previous
+
+
+@contextmanager
+def stage(name, **tags):
+    """
+    Record wall and CPU time, peak RSS and bytes read/written of a block.
+
+    Subprocess CPU time spent inside the block is included. The record is
+    emitted with status 'failed' if the block raises. Stages may nest (e.g.
+    'write_volume' inside 'registration'); nested records name their
+    ``parent`` and are left out of per-subject totals. CPU time, RSS and I/O
+    are process-wide, so with several worker threads per process they include
+    the other threads' work.
+
+    ``peak_rss_mb`` is the peak of the block alone: the high-water mark is
+    reset when the block starts (``reset_rss_high_water``), so a long-lived
+    pool worker does not report the largest run it has ever processed for
+    every later stage. Where the reset is unsupported it falls back to the
+    process's lifetime peak (``peak_rss_scope`` 'process' instead of
+    'stage'). ``children_peak_rss_mb`` is the largest peak RSS of the
+    external commands run by this thread inside the block (None if none ran).
+
+    Example
+    -------
+    >>> with stage('registration', subject='100307', phase=1, direction='LR'):
+    ...     register_run(...)
+    """
+    io_before = io_counters()
+    cpu_before = time.process_time()
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall_before = time.perf_counter()
+    open_stages = _state().open_stages
+    parent = open_stages[-1] if open_stages else None
+    open_stages.append(name)
+    peaks = _open_stage_peaks()
+    status = 'done'
+    try:
+        with tagged(**tags):
+            yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        open_stages.pop()
+        peak_mb, per_stage = _close_stage_peaks(peaks)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_after = io_counters()
+        with tagged(**tags):
+            emit({
+                'kind': 'stage',
+                'stage': name,
+                'parent': parent,
+                'status': status,
+                'wall_s': time.perf_counter() - wall_before,
+                'cpu_s': time.process_time() - cpu_before
+                         + (children.ru_utime + children.ru_stime)
+                         - (children_before.ru_utime + children_before.ru_stime),
+                'peak_rss_mb': peak_mb,
+                'peak_rss_scope': 'stage' if per_stage else 'process',
+                'children_peak_rss_mb': peaks['children_rss_mb'],
+                'bytes_read': io_after[2] - io_before[2],
+                'bytes_written': io_after[3] - io_before[3],
+                'disk_bytes_read': io_after[0] - io_before[0],
+                'disk_bytes_written': io_after[1] - io_before[1],
+            })
+
+
+def record_command(command, wall_s, returncode, max_rss_mb=None, **extra):
+    """
+    Record one external command invocation (tool name, duration, exit code).
+
+    ``max_rss_mb`` is the command's own peak RSS (its ``ru_maxrss``); it also
+    raises the ``children_peak_rss_mb`` of the stages open in this thread.
+    """
+    argv = command if isinstance(command, (list, tuple)) else command.split()
+    if max_rss_mb is not None:
+        thread = threading.get_ident()
+        with _peaks_lock:
+            for peaks in _open_peaks:
+                if peaks['thread'] == thread:
+                    peaks['children_rss_mb'] = max(peaks['children_rss_mb'] or 0.0, max_rss_mb)
+    open_stages = _state().open_stages
+    emit({
+        'kind': 'command',
+        'stage': open_stages[-1] if open_stages else None,
+        'tool': os.path.basename(argv[0]) if argv else '',
+        'command': ' '.join(map(str, argv)),
+        'wall_s': wall_s,
+        'returncode': returncode,
+        'max_rss_mb': max_rss_mb,
+        **extra,
+    })
+
+
+def load_records(jsonl_path):
+    """All records of a telemetry JSON-lines file and its per-host siblings (torn lines are skipped)."""
+    records = []
+    stem, ext = os.path.splitext(jsonl_path)
+    for path in [jsonl_path] + sorted(glob.glob(f'{glob.escape(stem)}.*{ext}')):
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+    return records
+
+
+def summarize(records, top=10):
+    """
+    Aggregate telemetry into a report of where the time goes.
+
+    Returns
+    -------
+    dict
+        'stages': per stage count, failures, total/mean wall and CPU time,
+        max peak RSS of the stage and of its external commands, and bytes;
+        'tools': per external tool count, wall time and max peak RSS;
+        'slowest_subjects' and 'slowest_runs': the ``top`` subjects and
+        (subject, phase, direction, stage) records by wall time.
+    """
+    stages = defaultdict(lambda: defaultdict(float))
+    tools = defaultdict(lambda: defaultdict(float))
+    subjects = defaultdict(float)
+    stage_records = []
+    for record in records:
+        if record.get('kind') == 'stage':
+            agg = stages[record['stage']]
+            agg['count'] += 1
+            agg['failed'] += record.get('status') == 'failed'
+            agg['wall_s'] += record['wall_s']
+            agg['cpu_s'] += record['cpu_s']
+            agg['bytes_read'] += record['bytes_read']
+            agg['bytes_written'] += record['bytes_written']
+            agg['max_peak_rss_mb'] = max(agg['max_peak_rss_mb'], record['peak_rss_mb'])
+            agg['max_children_peak_rss_mb'] = max(agg['max_children_peak_rss_mb'],
+                                                  record.get('children_peak_rss_mb') or 0)
+            if 'subject' in record and not record.get('parent'):
+                subjects[record['subject']] += record['wall_s']
+            stage_records.append(record)
+        elif record.get('kind') == 'command':
+            tools[record['tool']]['count'] += 1
+            tools[record['tool']]['wall_s'] += record['wall_s']
+            tools[record['tool']]['failed'] += record['returncode'] != 0
+            tools[record['tool']]['max_rss_mb'] = max(tools[record['tool']]['max_rss_mb'],
+                                                      record.get('max_rss_mb') or 0)
+    for agg in stages.values():
+        agg['mean_wall_s'] = agg['wall_s'] / agg['count']
+    slowest_runs = sorted(stage_records, key=lambda r: r['wall_s'], reverse=True)[:top]
+    return {
+        'stages': {name: dict(agg) for name, agg in sorted(stages.items(), key=lambda kv: -kv[1]['wall_s'])},
+        'tools': {name: dict(agg) for name, agg in sorted(tools.items(), key=lambda kv: -kv[1]['wall_s'])},
+        'slowest_subjects': sorted(subjects.items(), key=lambda kv: kv[1], reverse=True)[:top],
+        'slowest_runs': [
+            {key: r.get(key) for key in ('subject', 'phase', 'direction', 'stage', 'wall_s', 'peak_rss_mb')}
+            for r in slowest_runs
+        ],
+    }
+
+
+def format_summary(summary):
+    """Human-readable text of ``summarize`` output."""
+    lines = ['Stage                          runs  failed   total s    mean s     CPU s  peak MB  tools MB'
+             '       read MB    written MB']
+    for name, agg in summary['stages'].items():
+        lines.append(
+            f"{name:<30} {int(agg['count']):>5} {int(agg['failed']):>7} {agg['wall_s']:>9.1f} {agg['mean_wall_s']:>9.2f} "
+            f"{agg['cpu_s']:>9.1f} {agg['max_peak_rss_mb']:>8.0f} {agg['max_children_peak_rss_mb']:>9.0f} "
+            f"{agg['bytes_read'] / 1e6:>13.1f} {agg['bytes_written'] / 1e6:>13.1f}"
+        )
+    if summary['tools']:
+        lines.append('')
+        lines.append('Tool                           calls  failed   total s  peak MB')
+        for name, agg in summary['tools'].items():
+            lines.append(f"{name:<30} {int(agg['count']):>5} {int(agg['failed']):>7} {agg['wall_s']:>9.1f} "
+                         f"{agg['max_rss_mb']:>8.0f}")
+    lines.append('')
+    lines.append('Slowest subjects: ' + ', '.join(f"{s} ({t:.1f} s)" for s, t in summary['slowest_subjects']))
+    for r in summary['slowest_runs']:
+        lines.append(f"  {r['subject']} REST{r['phase']}_{r['direction']} {r['stage']}: {r['wall_s']:.1f} s, "
+                     f"{r['peak_rss_mb']:.0f} MB")
+    return '\n'.join(lines)
+
+
+def write_prometheus(summary, path):
+    """
+    Write ``summarize`` output as a Prometheus node_exporter textfile.
+
+    The file is replaced atomically, as the textfile collector requires.
+    """
+    lines = [
+        '# HELP hcp_stage_seconds_total Wall time spent per pipeline stage.',
+        '# TYPE hcp_stage_seconds_total counter',
+    ]
+    lines += [f'hcp_stage_seconds_total{{stage="{name}"}} {agg["wall_s"]}' for name, agg in summary['stages'].items()]
+    lines += ['# HELP hcp_stage_runs_total Stage executions.', '# TYPE hcp_stage_runs_total counter']
+    lines += [f'hcp_stage_runs_total{{stage="{name}"}} {int(agg["count"])}' for name, agg in summary['stages'].items()]
+    lines += ['# HELP hcp_stage_failures_total Failed stage executions.', '# TYPE hcp_stage_failures_total counter']
+    lines += [f'hcp_stage_failures_total{{stage="{name}"}} {int(agg["failed"])}'
+              for name, agg in summary['stages'].items()]
+    lines += ['# HELP hcp_stage_peak_rss_megabytes Largest peak RSS per stage.',
+              '# TYPE hcp_stage_peak_rss_megabytes gauge']
+    lines += [f'hcp_stage_peak_rss_megabytes{{stage="{name}"}} {agg["max_peak_rss_mb"]}'
+              for name, agg in summary['stages'].items()]
+    lines += ['# HELP hcp_command_peak_rss_megabytes Largest peak RSS per external tool.',
+              '# TYPE hcp_command_peak_rss_megabytes gauge']
+    lines += [f'hcp_command_peak_rss_megabytes{{tool="{name}"}} {agg["max_rss_mb"]}'
+              for name, agg in summary['tools'].items()]
+    lines += ['# HELP hcp_stage_bytes_total Bytes read and written per stage.', '# TYPE hcp_stage_bytes_total counter']
+    for name, agg in summary['stages'].items():
+        lines.append(f'hcp_stage_bytes_total{{stage="{name}",direction="read"}} {int(agg["bytes_read"])}')
+        lines.append(f'hcp_stage_bytes_total{{stage="{name}",direction="write"}} {int(agg["bytes_written"])}')
+    lines += ['# HELP hcp_command_seconds_total Wall time spent in external tools.',
+              '# TYPE hcp_command_seconds_total counter']
+    lines += [f'hcp_command_seconds_total{{tool="{name}"}} {agg["wall_s"]}' for name, agg in summary['tools'].items()]
+    with atomic_output(path) as tmp_path, open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def report(jsonl_path, prometheus_path=None, since=None, top=10):
+    """
+    Summarize a telemetry file, optionally only records after ``since`` (epoch seconds).
+
+    Writes the Prometheus textfile if ``prometheus_path`` is given and returns
+    the human-readable summary.
+    """
+    records = [r for r in load_records(jsonl_path) if since is None or r.get('time', 0) >= since]
+    summary = summarize(records, top=top)
+    if prometheus_path:
+        write_prometheus(summary, prometheus_path)
+    return format_summary(summary)
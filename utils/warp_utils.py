@@ -0,0 +1,451 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+import numpy as np
+import scipy.sparse as sp
+from .cache_utils import ArrayCache, cache_key, file_digest
+from .resample_utils import fsl_voxel_to_mm, isotropic_grid, nearest_axis_indices
+
+# Bump when the operator construction changes so stale cache entries are not reused
+SAMPLING_OPERATOR_VERSION = 1
+
+
+def load_fsl_warp(warp_path):
+    """
+    Load an FSL displacement-field warp (e.g., 'standard2acpc_dc.nii.gz').
+
+    Returns
+    -------
+    field : np.ndarray
+        float32 array of shape (x, y, z, 3) in FSL mm.
+    warp_vox2mm : np.ndarray
+        4x4 voxel-to-FSL-mm matrix of the warp grid.
+    """
+    img = nib.load(warp_path)
+    field = np.asanyarray(img.dataobj).astype(np.float32, copy=False)
+    field = field.reshape(field.shape[:3] + (3,))
+    warp_vox2mm = fsl_voxel_to_mm(field.shape, img.header.get_zooms(), img.affine)
+    return field, warp_vox2mm
+
+
+def trilinear_weights(coords, shape):
+    """
+    Flat indices and weights of the 8 neighbours of fractional voxel coordinates.
+
+    Points outside the grid get zero weights, matching applywarp's zero padding.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        Array of shape (num_points, 3) in voxel units.
+    shape : tuple of int
+        Spatial shape of the sampled grid.
+
+    Returns
+    -------
+    idx : np.ndarray
+        Flat (C-order) indices of shape (num_points, 8).
+    weights : np.ndarray
+        float32 weights of shape (num_points, 8).
+    """
+    shape = np.asarray(shape[:3])
+    inside = np.all((coords >= 0) & (coords <= shape - 1), axis=1)
+    base = np.clip(np.floor(coords), 0, np.maximum(shape - 2, 0)).astype(np.intp)
+    frac = np.clip(coords - base, 0, 1)
+
+    idx = np.empty((coords.shape[0], 8), dtype=np.intp)
+    weights = np.empty((coords.shape[0], 8), dtype=np.float32)
+    for corner in range(8):
+        offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+        corner_idx = np.minimum(base + offset, shape - 1)
+        idx[:, corner] = np.ravel_multi_index(corner_idx.T, tuple(shape))
+        weights[:, corner] = np.prod(np.where(offset, frac, 1 - frac), axis=1)
+    weights[~inside] = 0
+    return idx, weights
+
+
+def nearest_weights(coords, shape):
+    """Flat index (num_points, 1) and unit weight of the nearest voxel; zero outside."""
+    shape = np.asarray(shape[:3])
+    nearest = np.floor(coords + 0.5).astype(np.intp)
+    inside = np.all((nearest >= 0) & (nearest < shape), axis=1)
+    nearest = np.clip(nearest, 0, shape - 1)
+    idx = np.ravel_multi_index(nearest.T, tuple(shape))[:, None]
+    weights = inside.astype(np.float32)[:, None]
+    return idx, weights
+
+
+def sample_field(field, coords):
+    """Trilinearly sample a vector field (x, y, z, c) at voxel coordinates (n, 3)."""
+    idx, weights = trilinear_weights(coords, field.shape[:3])
+    flat = field.reshape(-1, field.shape[3])
+    return np.einsum('nk,nkc->nc', weights, flat[idx])
+
+
+def warp_coordinates(ref_voxels, ref_vox2mm, field, warp_vox2mm, in_vox2mm, relative=True):
+    """
+    Map reference voxels to input voxel coordinates through an FSL warp.
+
+    Follows applywarp: the reference voxel is taken to FSL mm, the warp is
+    sampled there, and the (relative or absolute) result is taken to input
+    voxel coordinates.
+
+    Parameters
+    ----------
+    ref_voxels : np.ndarray
+        Integer array of shape (num_points, 3) on the reference grid.
+    ref_vox2mm, warp_vox2mm, in_vox2mm : np.ndarray
+        4x4 voxel-to-FSL-mm matrices of the reference, warp and input grids.
+    field : np.ndarray
+        Warp field of shape (x, y, z, 3).
+    relative : bool
+        Whether the warp holds displacements (``--rel``) or positions (``--abs``).
+
+    Returns
+    -------
+    np.ndarray
+        Input voxel coordinates of shape (num_points, 3).
+    """
+    homogeneous = np.column_stack([ref_voxels, np.ones(len(ref_voxels))])
+    ref_mm = homogeneous @ ref_vox2mm.T
+    warp_voxels = (ref_mm @ np.linalg.inv(warp_vox2mm).T)[:, :3]
+    displacement = sample_field(field, warp_voxels)
+    in_mm = displacement + ref_mm[:, :3] if relative else displacement
+    in_mm = np.column_stack([in_mm, np.ones(len(in_mm))])
+    return (in_mm @ np.linalg.inv(in_vox2mm).T)[:, :3]
+
+
+def build_sampling_operator(in_shape, in_affine, in_zooms, ref_img, warp_path,
+                            voxel_size=3.0, interp='trilinear', relative=True, in_voxels=None):
+    """
+    Compose a warp and an isotropic nearest-neighbour downsample into one operator.
+
+    The result replaces ``applywarp --ref --warp`` followed by ``flirt
+    -applyisoxfm``: row ``o`` of the operator holds the interpolation
+    weights of the input voxels that end up in output voxel ``o``.
+
+    Parameters
+    ----------
+    in_shape, in_affine, in_zooms
+        Spatial shape, voxel-to-world matrix and voxel sizes of the input
+        volume (the subcortical volume of the dense time series).
+    ref_img : nib.Nifti1Image
+        Reference image passed to applywarp (e.g., 'T1_3mm.nii.gz'); only its
+        header is used.
+    warp_path : str
+        FSL displacement-field warp (e.g., 'standard2acpc_dc.nii.gz').
+    voxel_size : float or None
+        Isotropic downsampling of the reference grid; ``None`` keeps it.
+    interp : {'trilinear', 'nearest'}
+        Interpolation of the input volume.
+    relative : bool
+        Whether the warp holds relative displacements.
+    in_voxels : np.ndarray, optional
+        Ascending flat indices of the only input voxels that can be non-zero
+        (e.g. ``cifti_utils.volume_columns``); the operator keeps just their
+        columns, dropping weights that would multiply zeros.
+
+    Returns
+    -------
+    operator : scipy.sparse.csr_matrix
+        Matrix of shape (num_output_voxels, num_input_voxels), or
+        (num_output_voxels, len(in_voxels)).
+    out_shape : tuple of int
+        Spatial shape of the output grid.
+    out_affine : np.ndarray
+        4x4 voxel-to-world matrix of the output grid.
+    """
+    ref_shape = ref_img.shape[:3]
+    ref_zooms = ref_img.header.get_zooms()[:3]
+    ref_vox2mm = fsl_voxel_to_mm(ref_shape, ref_zooms, ref_img.affine)
+
+    if voxel_size:
+        out_shape, out_affine, out_to_ref = isotropic_grid(ref_shape, ref_zooms, ref_img.affine, voxel_size)
+        axis_indices = nearest_axis_indices(ref_shape, out_shape, out_to_ref)
+    else:
+        out_shape, out_affine = tuple(ref_shape), ref_img.affine
+        axis_indices = [np.arange(n) for n in ref_shape]
+
+    # Output voxels whose nearest reference voxel lies inside the reference grid
+    grid = np.meshgrid(*axis_indices, indexing='ij')
+    ref_voxels = np.column_stack([g.ravel() for g in grid])
+    out_rows = np.flatnonzero(np.all(ref_voxels >= 0, axis=1))
+    ref_voxels = ref_voxels[out_rows]
+
+    field, warp_vox2mm = load_fsl_warp(warp_path)
+    in_vox2mm = fsl_voxel_to_mm(in_shape, in_zooms, in_affine)
+    coords = warp_coordinates(ref_voxels, ref_vox2mm, field, warp_vox2mm, in_vox2mm, relative=relative)
+    del field
+
+    if interp == 'trilinear':
+        idx, weights = trilinear_weights(coords, in_shape)
+    elif interp == 'nearest':
+        idx, weights = nearest_weights(coords, in_shape)
+    else:
+        raise ValueError(f"Unsupported interpolation: {interp}")
+
+    rows = np.repeat(out_rows, idx.shape[1])
+    operator = sp.csr_matrix(
+        (weights.ravel(), (rows, idx.ravel())),
+        shape=(int(np.prod(out_shape)), int(np.prod(in_shape[:3]))),
+    )
+    if in_voxels is not None:
+        operator = operator[:, in_voxels]
+    operator.eliminate_zeros()
+    return operator, tuple(out_shape), out_affine
+
+
+def cached_sampling_operator(cache_dir, in_shape, in_affine, in_zooms, ref_path, warp_path,
+                             voxel_size=3.0, interp='trilinear', relative=True, max_bytes=None,
+                             local_cache_dir=None, mmap=True, in_voxels=None):
+    """
+    ``build_sampling_operator`` backed by an on-disk ``ArrayCache``.
+
+    The entry is keyed by the content hashes of the reference and warp files,
+    the input grid and the parameters, so it is computed once per subject and
+    reused for all of its runs; editing either file invalidates it. Workers
+    missing the same entry wait for the one that builds it, so the warp field
+    is loaded once.
+
+    Parameters
+    ----------
+    local_cache_dir : str, optional
+        Node-local scratch directory; entries of ``cache_dir`` (e.g. on NFS)
+        are copied there once and memory-mapped from there.
+    mmap : bool
+        Memory-map the operator arrays read-only instead of loading them, so
+        all workers on a node share one copy through the page cache.
+    in_voxels : np.ndarray, optional
+        Input voxels to keep, see ``build_sampling_operator``; part of the key.
+
+    Returns
+    -------
+    Same as ``build_sampling_operator``.
+    """
+    key = cache_key(
+        'sampling_operator', SAMPLING_OPERATOR_VERSION,
+        file_digest(ref_path), file_digest(warp_path),
+        tuple(in_shape[:3]), np.asarray(in_affine, dtype=np.float64), tuple(float(z) for z in in_zooms[:3]),
+        voxel_size, interp, relative, None if in_voxels is None else np.asarray(in_voxels, dtype=np.int64),
+    )
+    mmap_mode = 'r' if mmap else None
+    cache = ArrayCache(cache_dir, max_bytes=max_bytes)
+    local = ArrayCache(local_cache_dir, max_bytes=max_bytes) if local_cache_dir else cache
+    hit = local.get(key, mmap_mode=mmap_mode)
+    if hit is None:
+        with cache.lock(key):
+            hit = cache.get(key, mmap_mode='r')
+            if hit is None:
+                built = build_sampling_operator(
+                    in_shape, in_affine, in_zooms, nib.load(ref_path), warp_path,
+                    voxel_size=voxel_size, interp=interp, relative=relative, in_voxels=in_voxels,
+                )
+                operator, out_shape, out_affine = built
+                cache.put(
+                    key,
+                    {'data': operator.data, 'indices': operator.indices, 'indptr': operator.indptr,
+                     'out_affine': np.asarray(out_affine)},
+                    {'shape': list(operator.shape), 'out_shape': list(out_shape),
+                     'ref_path': ref_path, 'warp_path': warp_path},
+                )
+                logging.info(f"Cached sampling operator {key[:12]} for {warp_path}")
+                hit = cache.get(key, mmap_mode='r')
+                if hit is None:
+                    # The entry alone exceeds max_bytes and was evicted as soon as it was published
+                    logging.warning(f"Sampling operator {key[:12]} does not fit in {cache_dir}; using it uncached")
+                    return built
+        if local is not cache:
+            local.put(key, *hit)
+            local_hit = local.get(key, mmap_mode=mmap_mode)
+            if local_hit is not None:
+                hit = local_hit
+
+    arrays, meta = hit
+    operator = sp.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']), copy=False
+    )
+    return operator, tuple(meta['out_shape']), np.asarray(arrays['out_affine'])
+
+
+def sample_time_chunks(operator, read_chunk, num_timepoints, out_shape, chunk_size=None, num_threads=1):
+    """
+    Apply a sampling operator to a time series read in chunks of time points.
+
+    The chunks are spread over a thread pool (the sparse product releases the
+    GIL), so only one input chunk per thread is held in memory at a time.
+
+    Parameters
+    ----------
+    operator : scipy.sparse.csr_matrix
+        Operator from ``build_sampling_operator``.
+    read_chunk : callable
+        ``read_chunk(start, stop)`` returns the input of time points
+        ``start:stop`` as a float32 array of shape (operator.shape[1], stop - start).
+    num_timepoints : int
+        Length of the time series.
+    out_shape : tuple of int
+        Spatial shape of the output grid.
+    chunk_size : int, optional
+        Time points per chunk; ``None`` processes the whole run at once.
+    num_threads : int
+        Worker threads.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape out_shape + (num_timepoints,).
+    """
+    chunk_size = chunk_size or num_timepoints
+    out = np.empty((operator.shape[0], num_timepoints), dtype=np.float32)
+
+    def sample_chunk(start):
+        stop = min(start + chunk_size, num_timepoints)
+        out[:, start:stop] = operator @ read_chunk(start, stop)
+
+    starts = range(0, num_timepoints, chunk_size)
+    if num_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(pool.map(sample_chunk, starts))
+    else:
+        for start in starts:
+            sample_chunk(start)
+    return out.reshape(tuple(out_shape) + (num_timepoints,))
+
+
+def apply_sampling_operator(operator, volume, out_shape, chunk_size=None, num_threads=1):
+    """
+    Apply a sampling operator to every time point of a 4D volume.
+
+    Parameters
+    ----------
+    operator : scipy.sparse.csr_matrix
+        Operator from ``build_sampling_operator`` over the whole input grid.
+    volume : np.ndarray or nibabel ArrayProxy
+        4D array-like of shape (x, y, z, num_timepoints) on the operator's
+        input grid; passing ``img.dataobj`` reads each chunk lazily.
+    out_shape, chunk_size, num_threads
+        See ``sample_time_chunks``.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape out_shape + (num_timepoints,).
+    """
+    def read_chunk(start, stop):
+        return np.asanyarray(volume[..., start:stop], dtype=np.float32).reshape(-1, stop - start)
+
+    return sample_time_chunks(operator, read_chunk, volume.shape[-1], out_shape, chunk_size, num_threads)
+
+
+def apply_dense_sampling_operator(operator, data, columns, out_shape, chunk_size=None, num_threads=1):
+    """
+    Apply a sampling operator straight to the volumetric grayordinates of a dense time series.
+
+    Replaces scattering the run into its 4D volume
+    (``cifti_utils.volume_time_series``, 91x109x91 voxels per time point) and
+    applying the full operator: each chunk of time points only takes the
+    grayordinate columns the operator was restricted to, so no dense 4D input
+    is ever built.
+
+    Parameters
+    ----------
+    operator : scipy.sparse.csr_matrix
+        Operator built with ``in_voxels`` set to the ``flat_voxels`` of
+        ``cifti_utils.volume_columns``.
+    data : np.ndarray or nibabel ArrayProxy
+        Dense time series of shape (num_timepoints, num_grayordinates);
+        passing the ``open_dense_time_series`` proxy reads each chunk lazily.
+    columns : np.ndarray
+        The matching ``columns`` of ``cifti_utils.volume_columns``.
+    out_shape, chunk_size, num_threads
+        See ``sample_time_chunks``.
+
+    Returns
+    -------
+    np.ndarray
+        float32 array of shape out_shape + (num_timepoints,).
+    """
+    def read_chunk(start, stop):
+        chunk = np.asanyarray(data[start:stop], dtype=np.float32)[:, columns]
+        return np.ascontiguousarray(chunk.T)
+
+    return sample_time_chunks(operator, read_chunk, data.shape[0], out_shape, chunk_size, num_threads)
+
+
+def apply_warp(in_path, ref_path, warp_path, out_path=None, interp='trilinear', relative=True,
+               chunk_size=100, num_threads=4):
+    """
+    In-process replacement for ``applywarp --ref --in --warp --out``.
+
+    Parameters
+    ----------
+    in_path : str
+        4D input volume (e.g., the separated 'rfMRI_REST1_LR.nii.gz').
+    ref_path : str
+        Reference image defining the output grid (e.g., 'T1_3mm.nii.gz').
+    warp_path : str
+        FSL displacement-field warp (e.g., 'standard2acpc_dc.nii.gz').
+    out_path : str, optional
+        Where to write the warped image.
+    interp : {'trilinear', 'nearest'}
+        Interpolation, as applywarp's ``--interp``.
+    relative : bool
+        ``--rel`` (True) or ``--abs`` (False) warp convention.
+    chunk_size, num_threads
+        Time chunking of the resampling, see ``apply_sampling_operator``.
+
+    Returns
+    -------
+    nib.Nifti1Image
+        Warped image on the reference grid.
+    """
+    in_img = nib.load(in_path)
+    ref_img = nib.load(ref_path)
+    operator, out_shape, out_affine = build_sampling_operator(
+        in_img.shape[:3], in_img.affine, in_img.header.get_zooms()[:3], ref_img, warp_path,
+        voxel_size=None, interp=interp, relative=relative,
+    )
+    warped = apply_sampling_operator(operator, in_img.dataobj, out_shape, chunk_size, num_threads)
+
+    out_img = nib.Nifti1Image(warped, out_affine, ref_img.header)
+    out_img.header.set_data_dtype(np.float32)
+    out_img.header.set_zooms(ref_img.header.get_zooms()[:3] + in_img.header.get_zooms()[3:4])
+    if out_path is not None:
+        nib.save(out_img, out_path)
+        logging.info(f"Saved warped image to {out_path}")
+    return out_img
+
+
+def compare_with_applywarp(native_img, fsl_path, tolerance=1e-3):
+    """
+    Voxelwise difference between a native warp result and real applywarp output.
+
+    Parameters
+    ----------
+    native_img : nib.Nifti1Image
+        Output of ``apply_warp``.
+    fsl_path : str
+        applywarp output for the same input, reference and warp.
+    tolerance : float
+        Absolute difference above which a value counts as mismatched.
+
+    Returns
+    -------
+    report : dict
+        'max_abs_diff', 'mean_abs_diff', 'rmse', 'correlation',
+        'mismatch_fraction' and 'num_values'.
+    """
+    fsl_img = nib.load(fsl_path)
+    if fsl_img.shape != native_img.shape:
+        raise ValueError(f"Shape mismatch: native {native_img.shape} vs applywarp {fsl_img.shape}")
+    native = np.asanyarray(native_img.dataobj, dtype=np.float32).ravel()
+    fsl = np.asanyarray(fsl_img.dataobj, dtype=np.float32).ravel()
+    diff = np.abs(native - fsl)
+    return {
+        'max_abs_diff': float(diff.max()),
+        'mean_abs_diff': float(diff.mean()),
+        'rmse': float(np.sqrt(np.mean(diff.astype(np.float64) ** 2))),
+        'correlation': float(np.corrcoef(native, fsl)[0, 1]),
+        'mismatch_fraction': float(np.mean(diff > tolerance)),
+        'num_values': int(diff.size),
+    }
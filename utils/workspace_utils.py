@@ -0,0 +1,156 @@
+import errno
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+from .io_utils import atomic_output
+
+# Bytes copied per read while compressing or copying a finished output
+COPY_BUFFER_SIZE = 16 * 1024 ** 2
+
+
+def directory_bytes(path):
+    """Total size of the files below ``path``."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def gzip_file(src, dst, compresslevel=1):
+    """Compress ``src`` into ``dst`` (renamed into place when complete) at the given gzip level."""
+    with open(src, 'rb') as f_in, atomic_output(dst) as tmp_path:
+        with gzip.open(tmp_path, 'wb', compresslevel=compresslevel) as f_out:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+    return dst
+
+
+class Workspace:
+    """
+    Private scratch directory of one job for its intermediate files, removed when the job ends.
+
+    Every job gets its own directory under ``root``, which is ideally a fast
+    node-local disk or a tmpfs. Concurrent jobs therefore never share file
+    names, e.g. fslsplit's 'volume_' prefix, and the shared results directory
+    only ever receives finished outputs (``publish``). Intermediates are
+    plain NIfTI unless ``compress`` is set. Writing them gzipped costs CPU
+    time, and they are read back once and deleted.
+
+    The quota guard refuses to start a job, or stops one, with
+    ``OSError(ENOSPC)``:
+    - ``reserve`` (called before a job starts) fails if the job's estimated
+      peak size exceeds ``max_bytes``, or would leave less than
+      ``min_free_bytes`` free on the scratch file system.
+    - ``check`` (called after each step) fails if the directory's actual size
+      exceeds ``max_bytes``, or free space drops below ``min_free_bytes``.
+
+    Parameters
+    ----------
+    root : str, optional
+        Parent of the job directories (default: the system temporary directory).
+    name : str
+        Prefix of the job directory name, e.g. '100307_REST1_LR'.
+    compress : bool
+        Write intermediates as '.nii.gz' (``image`` names, ``fsl_env``).
+    max_bytes : int, optional
+        Size limit of the job directory.
+    min_free_bytes : int
+        Free space to leave on the scratch file system.
+    keep_on_failure : bool
+        Keep the directory of a failed job for inspection.
+
+    Example
+    -------
+    >>> with Workspace('/dev/shm', '100307_REST1_LR') as workspace:
+    ...     workspace.reserve(estimated_bytes)
+    ...     warped = workspace.image('Atlas_in_T1w_all')
+    ...     ...
+    ...     workspace.publish(workspace.image('fMRI_downsampled_3mm'), merged_output)
+    """
+
+    def __init__(self, root=None, name='job', compress=False, max_bytes=None, min_free_bytes=0,
+                 keep_on_failure=False):
+        self.root = root or tempfile.gettempdir()
+        self.name = name
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.keep_on_failure = keep_on_failure
+        self.path = None
+
+    @property
+    def extension(self):
+        """'.nii.gz' or '.nii' for intermediate images."""
+        return '.nii.gz' if self.compress else '.nii'
+
+    @property
+    def fsl_env(self):
+        """Environment that makes FSL tools write intermediates in the workspace's format."""
+        return {'FSLOUTPUTTYPE': 'NIFTI_GZ' if self.compress else 'NIFTI'}
+
+    def file(self, name):
+        """Path of a file in the workspace."""
+        return os.path.join(self.path, name)
+
+    def image(self, stem):
+        """Path of an intermediate image, e.g. 'Atlas_in_T1w_all' -> '<workspace>/Atlas_in_T1w_all.nii'."""
+        return self.file(stem + self.extension)
+
+    def free_bytes(self):
+        """Free space on the workspace's file system."""
+        return shutil.disk_usage(self.path or self.root).free
+
+    def reserve(self, num_bytes):
+        """Fail before starting if an estimated peak of ``num_bytes`` does not fit the quota."""
+        if self.max_bytes is not None and num_bytes > self.max_bytes:
+            raise OSError(errno.ENOSPC, f"Job needs ~{num_bytes / 1e9:.1f} GB of scratch, more than the limit of "
+                                        f"{self.max_bytes / 1e9:.1f} GB", self.path)
+        free = self.free_bytes()
+        if free - num_bytes < self.min_free_bytes:
+            raise OSError(errno.ENOSPC, f"Job needs ~{num_bytes / 1e9:.1f} GB of scratch but only "
+                                        f"{free / 1e9:.1f} GB are free (keeping {self.min_free_bytes / 1e9:.1f} GB)",
+                          self.path)
+
+    def check(self):
+        """Fail if the workspace has outgrown ``max_bytes`` or the file system is nearly full."""
+        if self.max_bytes is not None:
+            used = directory_bytes(self.path)
+            if used > self.max_bytes:
+                raise OSError(errno.ENOSPC, f"Workspace uses {used / 1e9:.1f} GB, more than the limit of "
+                                            f"{self.max_bytes / 1e9:.1f} GB", self.path)
+        if self.free_bytes() < self.min_free_bytes:
+            raise OSError(errno.ENOSPC, f"Less than {self.min_free_bytes / 1e9:.1f} GB free on scratch", self.path)
+
+    def publish(self, src, dst, compresslevel=1):
+        """
+        Move a finished image from the workspace to its final path.
+
+        An uncompressed image published as '.nii.gz' is gzipped at
+        ``compresslevel`` on the way; anything else is copied as is. The final
+        file appears atomically.
+        """
+        if dst.endswith('.gz') and not src.endswith('.gz'):
+            gzip_file(src, dst, compresslevel)
+        else:
+            with atomic_output(dst) as tmp_path:
+                shutil.copyfile(src, tmp_path)
+        os.remove(src)
+        logging.info(f"Published {dst}")
+        return dst
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f'{self.name}.', dir=self.root)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.keep_on_failure:
+            logging.warning(f"Keeping the workspace of the failed job: {self.path}")
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+        return False